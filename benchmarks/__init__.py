@@ -0,0 +1,4 @@
+"""Офлайн-бенчмарки бота на имитации Google Sheets.
+
+Запуск: python -m benchmarks.run --rows 1000 10000 100000
+"""
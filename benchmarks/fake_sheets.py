@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""In-memory имитация gspread Spreadsheet/Worksheet для бенчмарков.
+
+Поддерживает те методы, которыми пользуется bot.py, считает вызовы по листам
+и операциям и умеет имитировать сетевую задержку и ошибки квоты (429).
+"""
+import itertools
+import random
+import re
+import threading
+import time
+from collections import Counter
+
+import gspread
+
+
+class FakeResponse:
+    """Ответ Google API с ошибкой - то, что gspread кладет в APIError"""
+
+    def __init__(self, status_code, message):
+        self.status_code = status_code
+        self.text = message
+
+    def json(self):
+        return {"error": {"code": self.status_code, "message": self.text, "status": "RESOURCE_EXHAUSTED"}}
+
+
+class FakeBackend:
+    """Общие настройки и счетчики для всех листов одной таблицы"""
+
+    def __init__(self, latency=0.0, latency_per_1k_rows=0.0, quota_error_rate=0.0, seed=None):
+        self.latency = latency
+        self.latency_per_1k_rows = latency_per_1k_rows
+        self.quota_error_rate = quota_error_rate
+        self.random = random.Random(seed)
+        self.calls = Counter()          # (лист, операция) -> количество
+        self.quota_errors = 0
+        self._lock = threading.Lock()
+
+    def call(self, title, operation, rows=0):
+        """Учесть вызов API: задержка, счетчик и, возможно, ошибка квоты"""
+        with self._lock:
+            self.calls[(title, operation)] += 1
+            fail = self.quota_error_rate and self.random.random() < self.quota_error_rate
+            if fail:
+                self.quota_errors += 1
+        delay = self.latency + self.latency_per_1k_rows * rows / 1000
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise gspread.exceptions.APIError(FakeResponse(429, "Quota exceeded (fake)"))
+
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+
+class FakeWorksheet:
+    """Лист с API gspread.Worksheet (только используемые ботом методы)"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, backend, title, rows=None, cols=26):
+        self.backend = backend
+        self.id = next(self._ids)
+        self.title = title
+        self.rows = [list(map(str, row)) for row in rows or []]
+        self.col_count = cols
+
+    def _width(self):
+        return max((len(row) for row in self.rows), default=0)
+
+    def get_all_values(self):
+        self.backend.call(self.title, 'get_all_values', len(self.rows))
+        width = self._width()
+        return [row + [""] * (width - len(row)) for row in self.rows]
+
+    def get_all_records(self):
+        self.backend.call(self.title, 'get_all_records', len(self.rows))
+        if not self.rows:
+            return []
+        headers = self.rows[0]
+        records = []
+        for row in self.rows[1:]:
+            row = row + [""] * (len(headers) - len(row))
+            records.append(dict(zip(headers, gspread.utils.numericise_all(row[:len(headers)]))))
+        return records
+
+    def get_values(self, range_name=None):
+        values = self._read(range_name)
+        self.backend.call(self.title, 'get_values', len(values))
+        return values
+
+    def _read(self, range_name):
+        first_row, first_col, last_row, last_col = self._parse_range(range_name)
+        return [row[first_col - 1:last_col] for row in self.rows[first_row - 1:last_row]]
+
+    def _write(self, range_name, values):
+        first_row, first_col, _, _ = self._parse_range(range_name)
+        for r, row in enumerate(values):
+            for c, value in enumerate(row):
+                self._set(first_row + r, first_col + c, value)
+
+    get = get_values
+
+    def row_values(self, row):
+        self.backend.call(self.title, 'row_values', 1)
+        return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    def _parse_range(self, range_name):
+        if not range_name:
+            return 1, 1, len(self.rows), self.col_count
+        start, _, end = range_name.split('!')[-1].partition(':')
+        if start.isdigit():
+            # Диапазон из целых строк, например 1:1
+            return int(start), 1, int(end or start), self.col_count
+        first_row, first_col = gspread.utils.a1_to_rowcol(start if re.search(r'\d', start) else start + "1")
+        if not end:
+            return first_row, first_col, first_row, first_col
+        if re.search(r'\d', end):
+            last_row, last_col = gspread.utils.a1_to_rowcol(end)
+        else:
+            last_row, last_col = len(self.rows), gspread.utils.a1_to_rowcol(end + "1")[1]
+        return first_row, first_col, last_row, last_col
+
+    def _updated_range(self, first_row, count, width):
+        last_col = re.sub(r'\d', '', gspread.utils.rowcol_to_a1(1, max(width, 1)))
+        return {'updates': {'updatedRange': f"'{self.title}'!A{first_row}:{last_col}{first_row + count - 1}"}}
+
+    def append_row(self, values, value_input_option='RAW', **kwargs):
+        return self.append_rows([values], value_input_option=value_input_option)
+
+    def append_rows(self, values, value_input_option='RAW', **kwargs):
+        self.backend.call(self.title, 'append_rows', len(values))
+        first_row = len(self.rows) + 1
+        self.rows.extend([str(v) for v in row] for row in values)
+        return self._updated_range(first_row, len(values), max(len(row) for row in values))
+
+    def _set(self, row, col, value):
+        while len(self.rows) < row:
+            self.rows.append([])
+        cells = self.rows[row - 1]
+        while len(cells) < col:
+            cells.append("")
+        cells[col - 1] = str(value)
+
+    def update_cell(self, row, col, value):
+        self.backend.call(self.title, 'update_cell', 1)
+        self._set(row, col, value)
+
+    def batch_update(self, data, value_input_option='RAW', **kwargs):
+        self.backend.call(self.title, 'batch_update', len(data))
+        for item in data:
+            self._write(item['range'], item['values'])
+
+    def add_cols(self, cols):
+        self.backend.call(self.title, 'add_cols')
+        self.col_count += cols
+
+
+class FakeSpreadsheet:
+    """Таблица с API gspread.Spreadsheet"""
+
+    def __init__(self, backend, title="Fitness bot (benchmark)"):
+        self.backend = backend
+        self.title = title
+        self._worksheets = {}
+
+    def worksheet(self, title):
+        self.backend.call(self.title, 'worksheet')
+        if title not in self._worksheets:
+            raise gspread.WorksheetNotFound(title)
+        return self._worksheets[title]
+
+    def worksheets(self):
+        self.backend.call(self.title, 'worksheets')
+        return list(self._worksheets.values())
+
+    def _split_range(self, range_name):
+        title, _, cells = range_name.rpartition('!')
+        return self._worksheets[title.strip("'")], cells
+
+    def values_batch_get(self, ranges, params=None):
+        self.backend.call(self.title, 'values_batch_get', len(ranges))
+        value_ranges = []
+        for range_name in ranges:
+            worksheet, cells = self._split_range(range_name)
+            values = [row for row in worksheet._read(cells) if any(row)]
+            value_ranges.append({'range': range_name, 'values': values} if values else {'range': range_name})
+        return {'valueRanges': value_ranges}
+
+    def values_batch_update(self, params=None, body=None):
+        self.backend.call(self.title, 'values_batch_update', len(body['data']))
+        for item in body['data']:
+            worksheet, cells = self._split_range(item['range'])
+            worksheet._write(cells, item['values'])
+
+    def batch_update(self, body):
+        """Поддерживаются запросы addSheet и appendDimension (COLUMNS)"""
+        self.backend.call(self.title, 'batch_update', len(body['requests']))
+        for request in body['requests']:
+            if 'addSheet' in request:
+                properties = request['addSheet']['properties']
+                self.seed_worksheet(properties['title'], cols=properties['gridProperties']['columnCount'])
+            elif 'appendDimension' in request:
+                dimension = request['appendDimension']
+                worksheet = next(w for w in self._worksheets.values() if w.id == dimension['sheetId'])
+                worksheet.col_count += dimension['length']
+        return {'replies': [{} for _ in body['requests']]}
+
+    def add_worksheet(self, title, rows=1000, cols=26, **kwargs):
+        self.backend.call(self.title, 'add_worksheet')
+        return self.seed_worksheet(title, cols=int(cols))
+
+    def seed_worksheet(self, title, rows=None, cols=26):
+        """Создать лист с данными в обход API (без задержки, ошибок и счетчиков)"""
+        worksheet = FakeWorksheet(self.backend, title, rows, cols)
+        self._worksheets[title] = worksheet
+        return worksheet
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""Бенчмарк обработчиков бота на имитации Google Sheets.
+
+Настоящие cmd_profile, save_payment_to_sheets, update_payment_status и admin_stats
+выполняются против листов заданного размера; для каждой операции выводятся
+перцентили времени, время первого (холодного) вызова и число запросов к Sheets API -
+отдельно во время обработчика и при последующей отправке изменений (flush).
+
+Пример: python -m benchmarks.run --rows 1000 10000 100000 --iterations 200 --latency 0.05
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+# Конфигурация бота читается при импорте - задаем ее до import bot
+os.environ.setdefault("BOT_TOKEN", "123456:ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghi")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ.setdefault("LOCAL_DB_PATH", ":memory:")
+os.environ.setdefault("LOCAL_DB_SYNCHRONOUS", "OFF")
+os.environ.setdefault("FSM_STORAGE", "memory")
+os.environ.setdefault("SHEETS_READS_PER_MINUTE", "1000000")
+os.environ.setdefault("SHEETS_WRITES_PER_MINUTE", "1000000")
+os.environ.setdefault("SHEETS_RETRY_BASE_DELAY", "0.01")
+os.environ.setdefault("SHEETS_RETRY_MAX_DELAY", "0.1")
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+from benchmarks.fake_sheets import FakeBackend, FakeSpreadsheet  # noqa: E402
+
+FIRST_USER_ID = 100000
+PAYMENT_AMOUNT = 8000
+OPERATIONS = ("cmd_profile", "save_payment_to_sheets", "update_payment_status", "admin_stats")
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.username = f"user{user_id}"
+        self.full_name = f"User {user_id}"
+
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+
+class FakeMessage:
+    """Минимальный aiogram Message: обработчикам нужны from_user, chat и answer"""
+
+    def __init__(self, user_id):
+        self.from_user = FakeUser(user_id)
+        self.chat = FakeChat(user_id)
+        self.text = ""
+        self.answers = []
+
+    async def answer(self, text, **kwargs):
+        self.answers.append(text)
+
+
+def seed_spreadsheet(backend, rows, seed):
+    """Таблица с rows строк в листах пользователей, платежей и посещений"""
+    rnd = random.Random(seed)
+    spreadsheet = FakeSpreadsheet(backend)
+    users = max(1, rows // 10)
+    today = datetime.now()
+
+    sheet = spreadsheet.seed_worksheet("Пользователи", cols=15)
+    sheet.rows.append(list(bot.USERS_HEADERS))
+    for i in range(rows):
+        user_id = FIRST_USER_ID + i
+        sheet.rows.append([
+            str(user_id), f"user{user_id}", f"User {user_id}", "+996700000000", "Пн-Ср-Пт",
+            "2024-01-01", "0", "0", "", "", "", rnd.choice(("active", "active", "inactive")), ""
+        ])
+
+    sheet = spreadsheet.seed_worksheet("История_платежей", cols=13)
+    sheet.rows.append(list(bot.PAYMENTS_HEADERS))
+    for i in range(rows):
+        date = today - timedelta(days=rnd.randrange(120))
+        status = rnd.choice(("confirmed", "confirmed", "confirmed", "rejected", "pending"))
+        timestamp = date.strftime("%Y-%m-%d %H:%M:%S")
+        decided = status != "pending"
+        sheet.rows.append([
+            timestamp, "User", str(FIRST_USER_ID + rnd.randrange(users)),
+            str(PAYMENT_AMOUNT), rnd.choice(("cash", "transfer")), status, "", "",
+            "1" if decided else "", timestamp if decided else "", "0", "", bot.new_payment_id()
+        ])
+
+    sheet = spreadsheet.seed_worksheet("Посещения", cols=10)
+    sheet.rows.append(list(bot.ATTENDANCE_HEADERS))
+    for i in range(rows):
+        date = today - timedelta(days=rnd.randrange(60))
+        sheet.rows.append([
+            date.strftime("%Y-%m-%d"), "User", str(FIRST_USER_ID + rnd.randrange(users)),
+            rnd.choice(("attended", "attended", "free_day", "sick_day")), "", "1", ""
+        ])
+
+    sheet = spreadsheet.seed_worksheet("Настройки", cols=3)
+    sheet.rows.append(["parameter", "value", "description"])
+    for key, value in bot.DEFAULT_SETTINGS.items():
+        sheet.rows.append([key, str(value), ""])
+    return spreadsheet, users
+
+
+def attach_spreadsheet(spreadsheet):
+    """Подключить таблицу к боту так же, как init_google_services"""
+    bot.local_store = bot.LocalStore(os.environ["LOCAL_DB_PATH"])
+    bot.sheets_mirror = bot.SheetsMirror(bot.local_store)
+    worksheets, _ = bot.bootstrap_spreadsheet(bot.sheets_quota.wrap(spreadsheet))
+    bot.users_sheet, bot.payments_sheet, bot.attendance_sheet, bot.settings_sheet = (
+        bot.sheets_mirror.attach(worksheets[title]) for title in bot.SHEETS_SCHEMA
+    )
+    for title in bot.SHEETS_SCHEMA:
+        bot.sheets_mirror.pull(title)
+    bot.invalidate_caches()
+
+
+class OperationStats:
+    def __init__(self):
+        self.seconds = []
+        self.handler_calls = []
+        self.flush_calls = []
+        self.failures = 0
+
+    def percentile(self, q):
+        ordered = sorted(self.seconds)
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+async def measure(backend, stats, func, *args):
+    """Выполнить операцию как один апдейт (с разбивкой времени, как в middleware),
+    затем отправить накопленные изменения в таблицу"""
+    timing_token = bot.update_timing.set(bot.UpdateTiming())
+    calls_before = backend.total_calls()
+    started = time.perf_counter()
+    try:
+        result = await func(*args)
+    finally:
+        elapsed = time.perf_counter() - started
+        bot.update_timing.reset(timing_token)
+    calls_after = backend.total_calls()
+    await bot.run_sheets(bot.sheets_mirror.flush_once)
+    stats.seconds.append(elapsed)
+    stats.handler_calls.append(calls_after - calls_before)
+    stats.flush_calls.append(backend.total_calls() - calls_after)
+    if result is False:
+        stats.failures += 1
+    return result
+
+
+async def run_size(rows, args):
+    backend = FakeBackend(args.latency, args.latency_per_1k_rows, args.quota_error_rate, args.seed)
+    retries_before = bot.sheets_quota.retries
+    spreadsheet, users = seed_spreadsheet(backend, rows, args.seed)
+
+    started = time.perf_counter()
+    await bot.run_sheets(attach_spreadsheet, spreadsheet)
+    load_seconds = time.perf_counter() - started
+    load_calls = backend.total_calls()
+
+    rnd = random.Random(args.seed)
+    results = {name: OperationStats() for name in OPERATIONS}
+    for _ in range(args.iterations):
+        user_id = FIRST_USER_ID + rnd.randrange(users)
+        await measure(backend, results["cmd_profile"], bot.cmd_profile, FakeMessage(user_id))
+        payment_id = await measure(
+            backend, results["save_payment_to_sheets"], bot.save_payment_to_sheets, user_id, PAYMENT_AMOUNT, "cash"
+        )
+        await measure(
+            backend, results["update_payment_status"], bot.update_payment_status,
+            user_id, PAYMENT_AMOUNT, "confirmed", bot.ADMIN_ID, payment_id or None
+        )
+        await measure(backend, results["admin_stats"], bot.admin_stats, FakeMessage(bot.ADMIN_ID))
+
+    return load_seconds, load_calls, backend, bot.sheets_quota.retries - retries_before, results
+
+
+def print_report(rows, load_seconds, load_calls, backend, retries, results):
+    print(f"\n=== {rows} строк в листе ===")
+    print(f"Загрузка листов: {load_seconds * 1000:.1f} мс, запросов к Sheets: {load_calls}")
+    print(f"{'операция':<24} {'первый':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9} "
+          f"{'Sheets/оп':>10} {'flush/оп':>9} {'ошибок':>7}")
+    for name, stats in results.items():
+        if not stats.seconds:
+            continue
+        print(
+            f"{name:<24} "
+            f"{stats.seconds[0] * 1000:>7.2f}мс "
+            f"{stats.percentile(0.50) * 1000:>7.2f}мс "
+            f"{stats.percentile(0.95) * 1000:>7.2f}мс "
+            f"{stats.percentile(0.99) * 1000:>7.2f}мс "
+            f"{max(stats.seconds) * 1000:>7.2f}мс "
+            f"{statistics.mean(stats.handler_calls):>10.2f} "
+            f"{statistics.mean(stats.flush_calls):>9.2f} "
+            f"{stats.failures:>7}"
+        )
+    print("Запросы к Sheets API по листам:")
+    for (title, operation), count in sorted(backend.calls.items()):
+        print(f"  {title}.{operation}: {count}")
+    if backend.quota_errors:
+        print(f"Имитированных ошибок квоты (429): {backend.quota_errors}, повторов: {retries}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк обработчиков бота на имитации Google Sheets")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="размеры листов (строк)")
+    parser.add_argument("--iterations", type=int, default=100, help="повторов каждой операции")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка одного запроса к Sheets, с")
+    parser.add_argument("--latency-per-1k-rows", type=float, default=0.0,
+                        help="дополнительная задержка на каждую 1000 прочитанных/записанных строк, с")
+    parser.add_argument("--quota-error-rate", type=float, default=0.0,
+                        help="доля запросов, завершающихся ошибкой 429")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(argv)
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+    for rows in args.rows:
+        print_report(rows, *await run_size(rows, args))
+    bot.sheets_executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
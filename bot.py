@@ -5,24 +5,132 @@ import os
 import re
 import json
 import hashlib
+import hmac
+import base64
+import struct
+import heapq
+import itertools
+import random
+import sqlite3
+import bisect
+import copy
+import threading
+import time
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 import gspread
+import requests
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
-from aiogram import Bot, Dispatcher, Router, F
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, BotCommand, MenuButtonCommands
+from aiogram import Bot, Dispatcher, Router, F, BaseMiddleware
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, BotCommand, MenuButtonCommands, BufferedInputFile
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
 from dotenv import load_dotenv
 from aiohttp import web
 
-print("📦 Импорты загружены успешно")
-
 # Загружаем переменные из .env файла (для локальной разработки)
 load_dotenv()
-print("🔧 .env файл загружен")
+
+# Логирование: LOG_LEVEL - общий уровень, LOG_LEVELS - уровни подсистем
+# ("sheets=DEBUG,payments=WARNING,aiogram=WARNING"), LOG_FORMAT=json - по строке JSON на запись
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_DEBUG_SAMPLE = int(os.getenv("LOG_DEBUG_SAMPLE", 100))     # построчный debug: каждая N-я строка
+
+# Идентификатор апдейта Telegram, в рамках которого сделана запись в лог
+log_request_id = contextvars.ContextVar("log_request_id", default="-")
+
+class RequestIdFilter(logging.Filter):
+    """Добавляет в каждую запись request_id текущего апдейта"""
+    
+    def filter(self, record):
+        record.request_id = log_request_id.get()
+        return True
+
+class JsonLogFormatter(logging.Formatter):
+    """Запись лога одной строкой JSON"""
+    
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class SampledDebug:
+    """Построчный debug-вывод в циклах: пишется только каждая n-я строка"""
+    
+    def __init__(self, log, every):
+        self.log = log
+        self.every = max(1, every)
+        self.count = 0
+    
+    def __call__(self, msg, *args):
+        self.count += 1
+        if self.count % self.every == 1 or self.every == 1:
+            self.log.debug(msg, *args)
+
+def sampled_debug(log):
+    """SampledDebug для цикла или None, если DEBUG выключен (тогда цикл не делает лишней работы)"""
+    return SampledDebug(log, LOG_DEBUG_SAMPLE) if log.isEnabledFor(logging.DEBUG) else None
+
+LOG_SUBSYSTEMS = ("sheets", "settings", "users", "payments", "telegram", "handlers", "web")
+
+def parse_log_level(value):
+    """Уровень логирования по имени (DEBUG, INFO, ...) или числу; None, если не распознан"""
+    value = value.strip().upper()
+    if value.isdigit():
+        return int(value)
+    level = logging.getLevelName(value)
+    return level if isinstance(level, int) else None
+
+def setup_logging():
+    """Настроить вывод логов; некорректные LOG_LEVEL/LOG_LEVELS пропускаются с предупреждением"""
+    handler = logging.StreamHandler()
+    handler.addFilter(RequestIdFilter())
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"))
+    root_level = parse_log_level(LOG_LEVEL)
+    logging.basicConfig(level=root_level or logging.INFO, handlers=[handler], force=True)
+    if root_level is None:
+        logger.warning("⚠️ Неизвестный LOG_LEVEL=%r, используем INFO", LOG_LEVEL)
+    for item in filter(None, (part.strip() for part in LOG_LEVELS.split(","))):
+        name, _, level = item.partition("=")
+        name, level = name.strip(), parse_log_level(level)
+        if not name or level is None:
+            logger.warning("⚠️ Некорректная запись LOG_LEVELS %r пропущена (нужно имя=УРОВЕНЬ)", item)
+            continue
+        target = logger.getChild(name) if name in LOG_SUBSYSTEMS else logging.getLogger(name)
+        target.setLevel(level)
+
+logger = logging.getLogger(__name__)
+sheets_logger = logger.getChild("sheets")
+settings_logger = logger.getChild("settings")
+users_logger = logger.getChild("users")
+payments_logger = logger.getChild("payments")
+telegram_logger = logger.getChild("telegram")
+handlers_logger = logger.getChild("handlers")
+web_logger = logger.getChild("web")
+
+setup_logging()
 
 # Настройки из переменных окружения (поддержка и локальной разработки, и Render)
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -31,33 +139,39 @@ GOOGLE_CREDENTIALS_FILE = os.getenv("GOOGLE_CREDENTIALS_FILE")
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
 GOOGLE_CREDENTIALS_JSON = os.getenv("GOOGLE_CREDENTIALS")
 
+# Ключ подписи кнопок платежей (по умолчанию - токен бота)
+CALLBACK_SECRET = os.getenv("CALLBACK_SECRET")
+
+# Режим получения обновлений: polling или webhook (через веб-сервер healthcheck)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL") or os.getenv("RENDER_EXTERNAL_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()
+
 # Настройки оплаты
 PAYMENT_PHONE = "+996995311919"  # Замените на ваш номер телефона
 QR_CODE_PATH = "qr_code.jpg"        # Путь к QR коду в репозитории
 
-print(f"🔑 BOT_TOKEN: {'✅ Загружен' if BOT_TOKEN else '❌ Отсутствует'}")
-print(f"👨‍💼 ADMIN_ID: {'✅ ' + str(ADMIN_ID) if ADMIN_ID else '❌ Отсутствует'}")
-print(f"📊 GOOGLE_CREDENTIALS_FILE: {'✅ ' + str(GOOGLE_CREDENTIALS_FILE) if GOOGLE_CREDENTIALS_FILE else '❌ Отсутствует'}")
-print(f"📊 GOOGLE_CREDENTIALS_JSON: {'✅ Переменная окружения' if GOOGLE_CREDENTIALS_JSON else '❌ Отсутствует'}")
-print(f"📋 SPREADSHEET_ID: {'✅ Загружен' if SPREADSHEET_ID else '❌ Отсутствует'}")
-print(f"💳 PAYMENT_PHONE: {PAYMENT_PHONE}")
-print(f"📷 QR_CODE_PATH: {QR_CODE_PATH}")
-print(f"📷 QR код статус: {'✅ Найден' if os.path.exists(QR_CODE_PATH) else '❌ Файл не найден'}")
+logger.info("🔑 BOT_TOKEN: %s", '✅ Загружен' if BOT_TOKEN else '❌ Отсутствует')
+logger.info("👨‍💼 ADMIN_ID: %s", '✅ ' + str(ADMIN_ID) if ADMIN_ID else '❌ Отсутствует')
+logger.info("📊 GOOGLE_CREDENTIALS_FILE: %s", '✅ ' + str(GOOGLE_CREDENTIALS_FILE) if GOOGLE_CREDENTIALS_FILE else '❌ Отсутствует')
+logger.info("📊 GOOGLE_CREDENTIALS_JSON: %s", '✅ Переменная окружения' if GOOGLE_CREDENTIALS_JSON else '❌ Отсутствует')
+logger.info("📋 SPREADSHEET_ID: %s", '✅ Загружен' if SPREADSHEET_ID else '❌ Отсутствует')
+logger.info("💳 PAYMENT_PHONE: %s", PAYMENT_PHONE)
+logger.info("📷 QR_CODE_PATH: %s", QR_CODE_PATH)
+logger.info("📷 QR код статус: %s", '✅ Найден' if os.path.exists(QR_CODE_PATH) else '❌ Файл не найден')
 if os.path.exists(QR_CODE_PATH):
-    print(f"📷 QR код размер: {os.path.getsize(QR_CODE_PATH)} байт")
+    logger.info("📷 QR код размер: %s байт", os.path.getsize(QR_CODE_PATH))
 
 # Проверяем обязательные переменные
 if not BOT_TOKEN:
-    print("❌ КРИТИЧЕСКАЯ ОШИБКА: BOT_TOKEN не найден в переменных окружения!")
+    logger.error("❌ КРИТИЧЕСКАЯ ОШИБКА: BOT_TOKEN не найден в переменных окружения!")
     exit(1)
 
 if not ADMIN_ID:
-    print("❌ КРИТИЧЕСКАЯ ОШИБКА: ADMIN_ID не найден в переменных окружения!")
+    logger.error("❌ КРИТИЧЕСКАЯ ОШИБКА: ADMIN_ID не найден в переменных окружения!")
     exit(1)
 
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
 # Состояния
 class RegistrationStates(StatesGroup):
     waiting_for_name = State()
@@ -79,6 +193,87 @@ class AdminStates(StatesGroup):
     editing_schedule_text = State()
     editing_rules_text = State()
 
+# Колонки листов (порядок важен - код обращается к ячейкам по номеру колонки)
+USERS_HEADERS = [
+    "telegram_id", "username", "name", "phone", "schedule",
+    "registration_date", "total_sessions", "current_sessions",
+    "last_payment_date", "last_payment_amount", "next_payment_due",
+    "status", "notes"
+]
+
+PAYMENTS_HEADERS = [
+    "timestamp", "name", "telegram_id", "amount", "payment_type", "status",
+    "photo_file_id", "drive_photo_link", "confirmed_by",
+    "confirmation_date", "sessions_period", "notes", "payment_id"
+]
+
+ATTENDANCE_HEADERS = [
+    "date", "name", "telegram_id", "status", "reason",
+    "session_number", "payment_period"
+]
+
+SETTINGS_HEADERS = ["parameter", "value", "description"]
+
+# Листы таблицы: название -> (заголовки, строк и колонок у нового листа)
+SHEETS_SCHEMA = {
+    "Пользователи": (USERS_HEADERS, 1000, 15),
+    "История_платежей": (PAYMENTS_HEADERS, 1000, 13),
+    "Посещения": (ATTENDANCE_HEADERS, 1000, 10),
+    "Настройки": (SETTINGS_HEADERS, 20, 3),
+}
+
+# Настройки кэширования данных из Google Sheets (секунды)
+USERS_CACHE_TTL = int(os.getenv("USERS_CACHE_TTL", 900))          # полная перезагрузка индекса
+USERS_TAIL_REFRESH = int(os.getenv("USERS_TAIL_REFRESH", 60))     # догрузка новых строк
+SETTINGS_CACHE_TTL = int(os.getenv("SETTINGS_CACHE_TTL", 300))    # снимок листа настроек
+PAYMENTS_CACHE_TTL = int(os.getenv("PAYMENTS_CACHE_TTL", 900))
+PAYMENTS_TAIL_REFRESH = int(os.getenv("PAYMENTS_TAIL_REFRESH", 60))
+ATTENDANCE_CACHE_TTL = int(os.getenv("ATTENDANCE_CACHE_TTL", 3600))
+ATTENDANCE_TAIL_REFRESH = int(os.getenv("ATTENDANCE_TAIL_REFRESH", 60))
+
+# Локальная база (основное хранилище) и синхронизация с Google Sheets
+LOCAL_DB_PATH = os.getenv("LOCAL_DB_PATH", "fitness_bot.db")
+MIRROR_FLUSH_INTERVAL = float(os.getenv("MIRROR_FLUSH_INTERVAL", 2))   # отправка изменений в Sheets
+MIRROR_PULL_INTERVAL = int(os.getenv("MIRROR_PULL_INTERVAL", 300))     # подтягивание ручных правок из Sheets
+MIRROR_BATCH_SIZE = int(os.getenv("MIRROR_BATCH_SIZE", 500))
+MIRROR_LAG_WARNING = int(os.getenv("MIRROR_LAG_WARNING", 60))         # предупреждение о задержке отправки
+MIRROR_MAX_ATTEMPTS = int(os.getenv("MIRROR_MAX_ATTEMPTS", 5))         # после стольких отказов изменение откладывается
+# FULL - запись в журнал подтверждается только после fsync (пользователю отвечаем после нее)
+LOCAL_DB_SYNCHRONOUS = os.getenv("LOCAL_DB_SYNCHRONOUS", "FULL")
+
+# Хранилище состояний диалогов (FSM): sqlite - переживает перезапуски, memory - как раньше
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+FSM_DB_PATH = os.getenv("FSM_DB_PATH", "fitness_bot_fsm.db")
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", 7 * 24 * 3600))      # брошенные диалоги удаляются
+FSM_WRITE_DELAY = float(os.getenv("FSM_WRITE_DELAY", 0.2))          # окно объединения записей
+
+# Квоты Google Sheets API (запросов в минуту) и повторы при ошибках 429/5xx
+SHEETS_READS_PER_MINUTE = int(os.getenv("SHEETS_READS_PER_MINUTE", 60))
+SHEETS_WRITES_PER_MINUTE = int(os.getenv("SHEETS_WRITES_PER_MINUTE", 60))
+SHEETS_MAX_RETRIES = int(os.getenv("SHEETS_MAX_RETRIES", 5))
+SHEETS_RETRY_BASE_DELAY = float(os.getenv("SHEETS_RETRY_BASE_DELAY", 1))
+SHEETS_RETRY_MAX_DELAY = float(os.getenv("SHEETS_RETRY_MAX_DELAY", 32))
+
+# Размер пула потоков для блокирующих вызовов gspread
+SHEETS_MAX_WORKERS = int(os.getenv("SHEETS_MAX_WORKERS", 4))
+
+# Лимиты отправки сообщений в Telegram
+TELEGRAM_SEND_CONCURRENCY = int(os.getenv("TELEGRAM_SEND_CONCURRENCY", 8))
+TELEGRAM_MESSAGES_PER_SECOND = float(os.getenv("TELEGRAM_MESSAGES_PER_SECOND", 25))    # общий лимит ~30/с
+TELEGRAM_CHAT_MESSAGES_PER_SECOND = float(os.getenv("TELEGRAM_CHAT_MESSAGES_PER_SECOND", 1))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", 10))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", 3))
+
+# Платежей на одной странице списка ожидающих подтверждения
+PENDING_PAGE_SIZE = int(os.getenv("PENDING_PAGE_SIZE", 5))
+
+# Апдейты, обработка которых дольше (секунды), пишутся в лог с разбивкой времени
+SLOW_UPDATE_THRESHOLD = float(os.getenv("SLOW_UPDATE_THRESHOLD", 1.0))
+
+# Повторное подключение к Google Sheets, если при запуске не удалось (секунды, пауза удваивается)
+SHEETS_INIT_RETRY_DELAY = float(os.getenv("SHEETS_INIT_RETRY_DELAY", 30))
+SHEETS_INIT_RETRY_MAX_DELAY = float(os.getenv("SHEETS_INIT_RETRY_MAX_DELAY", 600))
+
 # Глобальные переменные для Google Sheets
 sheets_client = None
 drive_service = None
@@ -87,6 +282,16 @@ payments_sheet = None
 attendance_sheet = None
 settings_sheet = None
 
+# Состояние бота для /readyz (только чтение из памяти)
+bot_identity = None                 # результат bot.get_me() при запуске
+bot_started_at = time.time()
+last_update_at = None               # время последнего апдейта от Telegram
+sheets_state = "starting"           # starting - идет подключение к Google Sheets, ready, failed
+sheets_ready_at = None
+SHEETS_STATE_TEXT = {"starting": "⏳ Подключаются", "ready": "✅ Подключены", "failed": "❌ Недоступны"}
+SHEETS_STARTING_MESSAGE = "⏳ Бот запускается и загружает данные. Попробуйте через минуту."
+READY_MAX_SYNC_AGE = int(os.getenv("READY_MAX_SYNC_AGE", 300))      # синхронизация с Google Sheets старше - не готов
+
 # Настройки по умолчанию
 DEFAULT_SETTINGS = {
     'min_payment': 1000,
@@ -130,20 +335,96 @@ DEFAULT_SETTINGS = {
 • Все действия требуют подтверждения администратора'''
 }
 
+def default_sheet_rows(title):
+    """Содержимое нового листа: заголовки и, для настроек, значения по умолчанию"""
+    rows = [list(SHEETS_SCHEMA[title][0])]
+    if title == "Настройки":
+        rows += [[key, value, ""] for key, value in DEFAULT_SETTINGS.items()]
+    return rows
+
+def check_sheet_header(title, header):
+    """Сравнить строку заголовков листа с колонками, к которым код обращается по номеру.
+    
+    Возвращает номер первой пустой колонки из ожидаемых (ее и следующие можно дописать)
+    или None, если дописывать нечего. Если колонка занята другим заголовком - ValueError:
+    код пишет в колонки по номеру и испортил бы такой лист.
+    """
+    expected = SHEETS_SCHEMA[title][0]
+    header = [str(cell).strip() for cell in header]
+    conflicts = [
+        (col, name, header[col - 1]) for col, name in enumerate(expected, start=1)
+        if col <= len(header) and header[col - 1] and header[col - 1] != name
+    ]
+    for col, name, actual in conflicts:
+        sheets_logger.error("❌ Лист '%s': в колонке %s заголовок '%s', ожидается '%s'", title, col, actual, name)
+    if conflicts:
+        raise ValueError(f"колонки листа '{title}' не совпадают с ожидаемыми")
+    return next((col for col, name in enumerate(expected, start=1) if col > len(header) or not header[col - 1]), None)
+
+def bootstrap_spreadsheet(spreadsheet):
+    """Найти листы бота, создать недостающие и проверить колонки - пакетными запросами.
+    
+    Для существующей таблицы это два чтения: список листов и строки заголовков.
+    Недостающие листы и колонки добавляются одним batch_update, заголовки и настройки
+    по умолчанию записываются одним values_batch_update. Если раскладка колонок
+    существующего листа не совпадает с ожидаемой, ничего не пишется и бросается ValueError.
+    Возвращает ({название: лист}, множество созданных листов).
+    """
+    worksheets = {worksheet.title: worksheet for worksheet in spreadsheet.worksheets()}
+    created = [title for title in SHEETS_SCHEMA if title not in worksheets]
+    structure, values, added = [], [], []
+    
+    for title in created:
+        _, rows, cols = SHEETS_SCHEMA[title]
+        structure.append({"addSheet": {"properties": {
+            "title": title, "gridProperties": {"rowCount": rows, "columnCount": cols}
+        }}})
+        values.append({"range": f"'{title}'!A1", "values": default_sheet_rows(title)})
+    
+    existing = [title for title in SHEETS_SCHEMA if title in worksheets]
+    if existing:
+        response = spreadsheet.values_batch_get([f"'{title}'!1:1" for title in existing])
+        headers = [(value_range.get("values") or [[]])[0] for value_range in response.get("valueRanges", [])]
+        broken = []
+        for title, header in zip(existing, headers):
+            try:
+                first_col = check_sheet_header(title, header)
+            except ValueError:
+                broken.append(title)
+                continue
+            if first_col is None:
+                continue
+            # Лист создан старой версией бота - дописываем новые колонки (например, payment_id)
+            expected = SHEETS_SCHEMA[title][0]
+            worksheet = worksheets[title]
+            if worksheet.col_count < len(expected):
+                structure.append({"appendDimension": {
+                    "sheetId": worksheet.id, "dimension": "COLUMNS", "length": len(expected) - worksheet.col_count
+                }})
+            values.append({"range": f"'{title}'!{column_letter(first_col)}1", "values": [expected[first_col - 1:]]})
+            added.append((title, ", ".join(expected[first_col - 1:])))
+        if broken:
+            raise ValueError(f"раскладка колонок не совпадает с ожидаемой: {', '.join(broken)} - исправьте заголовки в таблице")
+    
+    if structure:
+        spreadsheet.batch_update({"requests": structure})
+    if created:
+        worksheets = {worksheet.title: worksheet for worksheet in spreadsheet.worksheets()}
+        sheets_logger.info("✅ Созданы листы: %s", ", ".join(created))
+    if values:
+        spreadsheet.values_batch_update(body={"valueInputOption": "RAW", "data": values})
+    for title, columns in added:
+        sheets_logger.info("✅ Лист '%s': добавлены колонки %s", title, columns)
+    
+    return {title: sheets_quota.wrap(worksheets[title]) for title in SHEETS_SCHEMA}, set(created)
+
 def init_google_services():
     """Инициализация Google Services (адаптированная для Render.com)"""
     global sheets_client, drive_service, users_sheet, payments_sheet, attendance_sheet, settings_sheet
     
-    # Инициализируем переменные как None
-    sheets_client = None
-    drive_service = None
-    users_sheet = None
-    payments_sheet = None
-    attendance_sheet = None
-    settings_sheet = None
-    
+    # Листы подменяются только в конце: до этого обработчики работают с локальной базой
     try:
-        print("🔄 Инициализация Google Services...")
+        sheets_logger.info("🔄 Инициализация Google Services...")
         
         scope = [
             'https://spreadsheets.google.com/feeds',
@@ -155,141 +436,1477 @@ def init_google_services():
         creds = None
         
         if GOOGLE_CREDENTIALS_JSON:
-            print("🔑 Используем credentials из переменной окружения (Render.com)...")
+            sheets_logger.info("🔑 Используем credentials из переменной окружения (Render.com)...")
             try:
                 creds_dict = json.loads(GOOGLE_CREDENTIALS_JSON)
                 creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
-                print("✅ JSON credentials успешно загружены")
+                sheets_logger.info("✅ JSON credentials успешно загружены")
             except json.JSONDecodeError as e:
-                print(f"❌ Ошибка парсинга JSON credentials: {e}")
+                sheets_logger.error("❌ Ошибка парсинга JSON credentials: %s", e)
                 return False
             except Exception as e:
-                print(f"❌ Ошибка создания credentials из JSON: {e}")
+                sheets_logger.error("❌ Ошибка создания credentials из JSON: %s", e)
                 return False
                 
         elif GOOGLE_CREDENTIALS_FILE and os.path.exists(GOOGLE_CREDENTIALS_FILE):
-            print("🔑 Используем credentials из файла (локальная разработка)...")
+            sheets_logger.info("🔑 Используем credentials из файла (локальная разработка)...")
             try:
                 creds = Credentials.from_service_account_file(GOOGLE_CREDENTIALS_FILE, scopes=scope)
-                print("✅ Файл credentials успешно загружен")
+                sheets_logger.info("✅ Файл credentials успешно загружен")
             except Exception as e:
-                print(f"❌ Ошибка загрузки файла credentials: {e}")
+                sheets_logger.error("❌ Ошибка загрузки файла credentials: %s", e)
                 return False
         else:
-            print("❌ Google credentials не найдены!")
-            print("💡 Для Render.com: установите переменную GOOGLE_CREDENTIALS_JSON")
-            print("💡 Для локальной разработки: установите GOOGLE_CREDENTIALS_FILE в .env")
+            sheets_logger.error("❌ Google credentials не найдены!")
+            sheets_logger.info("💡 Для Render.com: установите переменную GOOGLE_CREDENTIALS_JSON")
+            sheets_logger.info("💡 Для локальной разработки: установите GOOGLE_CREDENTIALS_FILE в .env")
             return False
         
         if not creds:
-            print("❌ Не удалось создать credentials")
+            sheets_logger.error("❌ Не удалось создать credentials")
             return False
         
         # Инициализация Sheets
-        print("📊 Подключение к Google Sheets...")
+        sheets_logger.info("📊 Подключение к Google Sheets...")
         sheets_client = gspread.authorize(creds)
         
         # Инициализация Drive
-        print("☁️ Подключение к Google Drive...")
+        sheets_logger.info("☁️ Подключение к Google Drive...")
         drive_service = build('drive', 'v3', credentials=creds)
         
         if not SPREADSHEET_ID:
-            print("❌ SPREADSHEET_ID не указан в переменных окружения!")
+            sheets_logger.error("❌ SPREADSHEET_ID не указан в переменных окружения!")
             return False
             
-        print(f"📋 Открытие таблицы ID: {SPREADSHEET_ID}")
-        spreadsheet = sheets_client.open_by_key(SPREADSHEET_ID)
-        
-        # Получаем или создаем листы
-        try:
-            users_sheet = spreadsheet.worksheet("Пользователи")
-            print("✅ Лист 'Пользователи' найден")
-        except gspread.WorksheetNotFound:
-            users_sheet = spreadsheet.add_worksheet(title="Пользователи", rows="1000", cols="15")
-            users_sheet.append_row([
-                "telegram_id", "username", "name", "phone", "schedule", 
-                "registration_date", "total_sessions", "current_sessions", 
-                "last_payment_date", "last_payment_amount", "next_payment_due", 
-                "status", "notes"
-            ])
-            print("✅ Лист 'Пользователи' создан")
-        
-        try:
-            payments_sheet = spreadsheet.worksheet("История_платежей")
-            print("✅ Лист 'История_платежей' найден")
-        except gspread.WorksheetNotFound:
-            payments_sheet = spreadsheet.add_worksheet(title="История_платежей", rows="1000", cols="12")
-            payments_sheet.append_row([
-                "timestamp", "name", "telegram_id", "amount", "payment_type", "status", 
-                "photo_file_id", "drive_photo_link", "confirmed_by", 
-                "confirmation_date", "sessions_period", "notes"
-            ])
-            print("✅ Лист 'История_платежей' создан")
-        
-        try:
-            attendance_sheet = spreadsheet.worksheet("Посещения")
-            print("✅ Лист 'Посещения' найден")
-        except gspread.WorksheetNotFound:
-            attendance_sheet = spreadsheet.add_worksheet(title="Посещения", rows="1000", cols="10")
-            attendance_sheet.append_row([
-                "date", "name", "telegram_id", "status", "reason", 
-                "session_number", "payment_period"
-            ])
-            print("✅ Лист 'Посещения' создан")
-        
-        try:
-            settings_sheet = spreadsheet.worksheet("Настройки")
-            print("✅ Лист 'Настройки' найден")
-        except gspread.WorksheetNotFound:
-            settings_sheet = spreadsheet.add_worksheet(title="Настройки", rows="20", cols="3")
-            settings_sheet.append_row(["parameter", "value", "description"])
-            for key, value in DEFAULT_SETTINGS.items():
-                settings_sheet.append_row([key, value, ""])
-            print("✅ Лист 'Настройки' создан с значениями по умолчанию")
-        
-        # Тестируем доступ
-        print("🧪 Тестирование доступа...")
-        test_users = users_sheet.get_all_values()
-        print(f"✅ Тест успешен! Найдено строк в таблице: {len(test_users)}")
-        
-        print("🎉 Google Services успешно инициализированы!")
+        sheets_logger.info("📋 Открытие таблицы ID: %s", SPREADSHEET_ID)
+        spreadsheet = sheets_quota.wrap(sheets_client.open_by_key(SPREADSHEET_ID))
+        
+        # Листы ищутся, создаются и проверяются несколькими пакетными запросами
+        worksheets, created = bootstrap_spreadsheet(spreadsheet)
+        
+        # Локальная база - основное хранилище, Google Sheets - ее зеркало
+        sheets_logger.info("💾 Синхронизация локальной базы с Google Sheets...")
+        local_sheets = [sheets_mirror.attach(worksheets[title]) for title in SHEETS_SCHEMA]
+        for title in SHEETS_SCHEMA:
+            # Содержимое только что созданного листа известно - не перечитываем его
+            known = [[str(value) for value in row] for row in default_sheet_rows(title)] if title in created else None
+            sheets_mirror.pull(title, known)
+            sheets_logger.info("✅ '%s': %s строк в локальной базе", title, local_store.row_count(title))
+        users_sheet, payments_sheet, attendance_sheet, settings_sheet = local_sheets
+        
+        # Листы могли смениться - сбрасываем кэши
+        invalidate_caches()
+        
+        sheets_logger.info("🎉 Google Services успешно инициализированы!")
         return True
         
     except Exception as e:
-        print(f"❌ Ошибка инициализации Google Services: {e}")
-        print(f"🔍 Тип ошибки: {type(e).__name__}")
+        sheets_logger.error("❌ Ошибка инициализации Google Services (%s): %s", type(e).__name__, e)
         
         if "PERMISSION_DENIED" in str(e):
-            print("❌ Ошибка доступа! Проверьте:")
-            print("   1. Правильность ID таблицы")
-            print("   2. Что таблица расшарена для сервисного аккаунта")
-            print("   3. Что включены Google Sheets и Drive API")
+            sheets_logger.error(
+                "❌ Ошибка доступа! Проверьте: 1) правильность ID таблицы, "
+                "2) что таблица расшарена для сервисного аккаунта, 3) что включены Google Sheets и Drive API"
+            )
         elif "INVALID_ARGUMENT" in str(e):
-            print("❌ Неверные аргументы! Проверьте:")
-            print("   1. Корректность JSON credentials")
-            print("   2. Что JSON не поврежден")
+            sheets_logger.error(
+                "❌ Неверные аргументы! Проверьте: 1) корректность JSON credentials, 2) что JSON не поврежден"
+            )
         
         return False
 
+def attach_local_sheets():
+    """Открыть листы из локальной базы, оставшейся с прошлого запуска.
+    
+    Пока Google Sheets подключаются, обработчики отвечают из этих данных, а изменения
+    копятся в outbox и уйдут в таблицу после подключения. False - локальная база пуста.
+    """
+    global users_sheet, payments_sheet, attendance_sheet, settings_sheet
+    if not all(local_store.row_count(title) for title in SHEETS_SCHEMA):
+        return False
+    users_sheet, payments_sheet, attendance_sheet, settings_sheet = (LocalWorksheet(local_store, title) for title in SHEETS_SCHEMA)
+    invalidate_caches()
+    return True
+
+async def connect_google_services():
+    """Фоновое подключение к Google Sheets - бот начинает отвечать, не дожидаясь таблицы.
+    
+    Если подключиться не удалось, попытки повторяются с растущей паузой.
+    """
+    global sheets_state, sheets_ready_at
+    delay = SHEETS_INIT_RETRY_DELAY
+    while True:
+        started = time.monotonic()
+        if await run_sheets(init_google_services):
+            sheets_state = "ready"
+            sheets_ready_at = time.time()
+            sheets_logger.info("✅ Google Sheets подключены за %.1f с", time.monotonic() - started)
+            asyncio.create_task(sheets_mirror.run())
+            return
+        if sheets_state == "starting":
+            sheets_state = "failed"
+            logger.warning("⚠️ Google Sheets недоступны, работаем в упрощенном режиме")
+            await notify_admin_on_error("Google Sheets недоступны на Render.com")
+        sheets_logger.info("🔄 Повторное подключение к Google Sheets через %.0f с", delay)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, SHEETS_INIT_RETRY_MAX_DELAY)
+
+# МЕТРИКИ В ФОРМАТЕ PROMETHEUS (отдаются на /metrics)
+
+class Metric:
+    """Метрика с метками; значения хранятся в памяти процесса"""
+    
+    kind = None
+    
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._collect = collect     # функция -> {значения меток: значение}, вызывается при выгрузке
+        self._values = {}
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+    
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+    
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+    
+    def _samples(self):
+        if self._collect is not None:
+            values = self._collect()
+        else:
+            with self._lock:
+                values = dict(self._values)
+        for key, value in values.items():
+            yield "", self._labels(key if isinstance(key, tuple) else (key,)), value
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self._samples():
+            lines.append(f"{self.name}{suffix}{labels} {value}")
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+    
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+class Gauge(Metric):
+    kind = "gauge"
+    
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+    
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+    
+    def _samples(self):
+        with self._lock:
+            values = {key: (list(state[0]), state[1], state[2]) for key, state in self._values.items()}
+        for key, (counts, total, count) in values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield "_bucket", self._labels(key, [("le", bound)]), cumulative
+            yield "_bucket", self._labels(key, [("le", "+Inf")]), count
+            yield "_sum", self._labels(key), round(total, 6)
+            yield "_count", self._labels(key), count
+
+metrics_registry = []
+
+def render_metrics():
+    """Все метрики в текстовом формате Prometheus"""
+    parts = []
+    for metric in metrics_registry:
+        try:
+            parts.append(metric.render())
+        except Exception as e:
+            web_logger.warning("⚠️ Ошибка выгрузки метрики %s: %s", metric.name, e)
+    return "\n".join(parts) + "\n"
+
+HANDLER_SECONDS = Histogram(
+    "fitness_bot_handler_seconds", "Время работы обработчика", ("handler", "event")
+)
+HANDLER_ERRORS = Counter(
+    "fitness_bot_handler_errors_total", "Необработанные исключения в обработчиках", ("handler",)
+)
+SHEETS_CALLS = Counter(
+    "fitness_bot_sheets_api_calls_total", "Вызовы Google Sheets API", ("worksheet", "operation", "result")
+)
+SHEETS_SECONDS = Histogram(
+    "fitness_bot_sheets_api_seconds", "Время вызова Google Sheets API (без ожидания квоты)", ("worksheet", "operation")
+)
+SHEETS_DEAD_OPS = Counter(
+    "fitness_bot_sheets_dead_ops_total", "Изменения, отложенные после MIRROR_MAX_ATTEMPTS отказов Google Sheets", ("worksheet",)
+)
+TELEGRAM_CALLS = Counter(
+    "fitness_bot_telegram_api_calls_total", "Вызовы Telegram Bot API", ("method", "result")
+)
+TELEGRAM_SECONDS = Histogram(
+    "fitness_bot_telegram_api_seconds", "Время вызова Telegram Bot API", ("method",)
+)
+CACHE_REQUESTS = Counter(
+    "fitness_bot_cache_requests_total", "Обращения к кэшам", ("cache", "result")
+)
+
+def cache_hit_ratios():
+    totals = {}
+    with CACHE_REQUESTS._lock:
+        for (cache, result), n in CACHE_REQUESTS._values.items():
+            hits, count = totals.get(cache, (0, 0))
+            totals[cache] = (hits + (n if result == 'hit' else 0), count + n)
+    return {(cache,): round(hits / count, 4) for cache, (hits, count) in totals.items() if count}
+
+Gauge("fitness_bot_cache_hit_ratio", "Доля попаданий в кэш с момента запуска", ("cache",), collect=cache_hit_ratios)
+
+EVENT_LOOP_LAG = Histogram(
+    "fitness_bot_event_loop_lag_seconds", "Задержка event loop (опоздание таймера)",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+)
+EVENT_LOOP_LAG_INTERVAL = 0.5
+
+async def monitor_event_loop_lag():
+    """Фоновая задача: насколько позже срабатывает таймер event loop"""
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.observe(max(0.0, time.monotonic() - started - EVENT_LOOP_LAG_INTERVAL))
+
+class UpdateTiming:
+    """Из чего складывается время обработки одного апдейта"""
+    
+    def __init__(self):
+        self.handler = None
+        self.sheets_seconds = 0.0      # ожидание операций с таблицей (run_sheets)
+        self.sheets_calls = 0
+        self.sheets_api_calls = 0       # из них реальных запросов к Google Sheets API
+        self.telegram_seconds = 0.0
+        self.telegram_calls = 0
+        self._lock = threading.Lock()
+    
+    def add(self, **deltas):
+        with self._lock:
+            for name, value in deltas.items():
+                setattr(self, name, getattr(self, name) + value)
+
+update_timing = contextvars.ContextVar("update_timing", default=None)
+
+UPDATE_SECONDS = Histogram(
+    "fitness_bot_update_seconds", "Время обработки апдейта по составляющим", ("part",)
+)
+SLOW_UPDATES = Counter(
+    "fitness_bot_slow_updates_total", "Апдейты дольше SLOW_UPDATE_THRESHOLD", ("handler",)
+)
+
+# Все вызовы gspread синхронные (HTTP), поэтому из async-обработчиков
+# они выполняются в отдельном пуле потоков и не блокируют event loop
+sheets_executor = ThreadPoolExecutor(max_workers=SHEETS_MAX_WORKERS, thread_name_prefix="sheets")
+
+async def run_sheets(func, *args, **kwargs):
+    """Выполнить блокирующую операцию с Google Sheets в пуле потоков"""
+    loop = asyncio.get_running_loop()
+    # Копируем контекст, чтобы contextvars были доступны внутри потока
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    timing = update_timing.get()
+    if timing is None:
+        return await loop.run_in_executor(sheets_executor, call)
+    started = time.monotonic()
+    try:
+        return await loop.run_in_executor(sheets_executor, call)
+    finally:
+        timing.add(sheets_seconds=time.monotonic() - started, sheets_calls=1)
+
+# Приоритеты запросов к Google Sheets API (меньше - важнее)
+PRIORITY_HIGH = 0       # запись изменений (подтверждения платежей и т.п.)
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2        # фоновые перечитывания листов
+
+sheets_priority = contextvars.ContextVar("sheets_priority", default=PRIORITY_NORMAL)
+
+@contextmanager
+def sheets_priority_scope(priority):
+    """Выполнить запросы к Google Sheets внутри блока с заданным приоритетом"""
+    token = sheets_priority.set(priority)
+    try:
+        yield
+    finally:
+        sheets_priority.reset(token)
+
+class TokenBucket:
+    """Токен-бакет: per_minute запросов в минуту с равномерным пополнением"""
+    
+    def __init__(self, per_minute, capacity=None):
+        self.capacity = float(capacity if capacity is not None else per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+    
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def seconds_until_token(self):
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    
+    def drain(self):
+        """Обнулить бакет - после 429 даем квоте восстановиться"""
+        self.refill()
+        self.tokens = min(self.tokens, 0.0)
+
+class SheetsQuota:
+    """Ограничение частоты запросов к Google Sheets API и повторы при ошибках.
+    
+    Чтение и запись считаются отдельными бакетами (как и квоты Google).
+    Ожидающие токена запросы обслуживаются по приоритету, а внутри одного
+    приоритета - по очереди. Ошибки 429/5xx и сетевые сбои повторяются
+    с экспоненциальной задержкой со случайным разбросом.
+    """
+    
+    READ_METHODS = {
+        'get_all_values', 'get_all_records', 'get_values', 'get', 'row_values',
+        'col_values', 'worksheet', 'worksheets', 'fetch_sheet_metadata', 'values_batch_get'
+    }
+    WRITE_METHODS = {
+        'append_row', 'append_rows', 'update_cell', 'update', 'batch_update',
+        'add_worksheet', 'add_rows', 'add_cols', 'values_batch_update', 'clear'
+    }
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+    
+    def __init__(self, reads_per_minute, writes_per_minute):
+        self._buckets = {'read': TokenBucket(reads_per_minute), 'write': TokenBucket(writes_per_minute)}
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._seq = itertools.count()
+        self.calls = {'read': 0, 'write': 0}
+        self.retries = 0
+        self.rate_limited = 0
+        self.throttled_seconds = 0.0
+    
+    def wrap(self, target):
+        """Обернуть gspread Spreadsheet/Worksheet"""
+        return QuotaAwareProxy(target, self)
+    
+    def acquire(self, kind, priority):
+        """Дождаться токена; первыми обслуживаются запросы с высшим приоритетом"""
+        started = time.monotonic()
+        with self._cond:
+            ticket = (priority, next(self._seq), kind)
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    bucket = self._buckets[kind]
+                    bucket.refill()
+                    first = min(t for t in self._waiting if t[2] == kind)
+                    if first == ticket and bucket.tokens >= 1:
+                        bucket.tokens -= 1
+                        self.calls[kind] += 1
+                        break
+                    self._cond.wait(bucket.seconds_until_token() if first == ticket else 1.0)
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+        self.throttled_seconds += time.monotonic() - started
+    
+    def call(self, kind, func, *args, **kwargs):
+        """Вызвать метод gspread с учетом квоты и повторами"""
+        priority = sheets_priority.get()
+        labels = {'worksheet': getattr(getattr(func, '__self__', None), 'title', ''), 'operation': func.__name__}
+        for attempt in range(SHEETS_MAX_RETRIES + 1):
+            self.acquire(kind, priority)
+            started = time.monotonic()
+            timing = update_timing.get()
+            if timing is not None:
+                timing.add(sheets_api_calls=1)
+            try:
+                result = func(*args, **kwargs)
+                SHEETS_SECONDS.observe(time.monotonic() - started, **labels)
+                SHEETS_CALLS.inc(result='ok', **labels)
+                return result
+            except gspread.exceptions.APIError as e:
+                SHEETS_SECONDS.observe(time.monotonic() - started, **labels)
+                SHEETS_CALLS.inc(result='error', **labels)
+                status = getattr(e.response, 'status_code', None)
+                if status not in self.RETRY_STATUS_CODES or attempt == SHEETS_MAX_RETRIES:
+                    raise
+                if status == 429:
+                    self.rate_limited += 1
+                    with self._cond:
+                        self._buckets[kind].drain()
+                sheets_logger.warning("⚠️ Google Sheets ответил %s, повтор #%s", status, attempt + 1)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                SHEETS_CALLS.inc(result='error', **labels)
+                if attempt == SHEETS_MAX_RETRIES:
+                    raise
+                sheets_logger.warning("⚠️ Сетевая ошибка Google Sheets (%s), повтор #%s", type(e).__name__, attempt + 1)
+            self.retries += 1
+            time.sleep(random.uniform(0, min(SHEETS_RETRY_MAX_DELAY, SHEETS_RETRY_BASE_DELAY * 2 ** attempt)))
+    
+    def stats(self):
+        """Оставшийся бюджет запросов и счетчики"""
+        with self._cond:
+            for bucket in self._buckets.values():
+                bucket.refill()
+            return {
+                'reads_remaining': int(self._buckets['read'].tokens),
+                'writes_remaining': int(self._buckets['write'].tokens),
+                'reads': self.calls['read'],
+                'writes': self.calls['write'],
+                'retries': self.retries,
+                'rate_limited': self.rate_limited,
+                'waiting': len(self._waiting),
+                'throttled_seconds': round(self.throttled_seconds, 3),
+            }
+
+class QuotaAwareProxy:
+    """Обертка над объектом gspread: методы чтения/записи идут через SheetsQuota"""
+    
+    def __init__(self, target, quota):
+        self._target = target
+        self._quota = quota
+    
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name in SheetsQuota.READ_METHODS:
+            kind = 'read'
+        elif name in SheetsQuota.WRITE_METHODS:
+            kind = 'write'
+        else:
+            return attr
+        
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            result = self._quota.call(kind, attr, *args, **kwargs)
+            if isinstance(result, gspread.Worksheet):
+                return self._quota.wrap(result)
+            return result
+        return call
+
+sheets_quota = SheetsQuota(SHEETS_READS_PER_MINUTE, SHEETS_WRITES_PER_MINUTE)
+
+def row_from_append_response(response):
+    """Номер строки, в которую gspread записал append_row (None если не удалось определить)"""
+    try:
+        updated_range = response['updates']['updatedRange']
+        match = re.search(r'![A-Z]+(\d+)', updated_range)
+        return int(match.group(1)) if match else None
+    except (KeyError, TypeError):
+        return None
+
+def append_indexed_row(sheet, index, row):
+    """Дописать строку в лист и учесть ее в индексе листа (вызывать через run_sheets)"""
+    response = sheet.append_row(row)
+    index.note_appended(row_from_append_response(response), row)
+    return response
+
+def column_letter(col):
+    """Буква колонки по ее номеру (1 -> A)"""
+    return re.sub(r'\d', '', gspread.utils.rowcol_to_a1(1, col))
+
+class CellBatch:
+    """Изменения ячеек одного листа, которые отправляются одним batch_update.
+    
+    Соседние ячейки объединяются в диапазоны: например, confirmed_by и
+    confirmation_date одной строки уходят как один диапазон I5:J5.
+    """
+    
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+        self._cells = {}
+    
+    def __len__(self):
+        return len(self._cells)
+    
+    def set(self, row, col, value):
+        self._cells[(row, col)] = value
+        return self
+    
+    def ranges(self):
+        """Список диапазонов для batch_update с объединением смежных ячеек"""
+        # Горизонтальные отрезки подряд идущих колонок в каждой строке
+        runs = []
+        for row, col in sorted(self._cells):
+            if runs and runs[-1]['row'] == row and runs[-1]['end'] == col - 1:
+                runs[-1]['end'] = col
+                runs[-1]['values'][0].append(self._cells[(row, col)])
+            else:
+                runs.append({'row': row, 'start': col, 'end': col, 'values': [[self._cells[(row, col)]]]})
+        
+        # Одинаковые отрезки в соседних строках склеиваем в прямоугольник
+        blocks = []
+        for run in sorted(runs, key=lambda r: (r['start'], r['end'], r['row'])):
+            last = blocks[-1] if blocks else None
+            if (last and last['start'] == run['start'] and last['end'] == run['end']
+                    and last['row'] + len(last['values']) == run['row']):
+                last['values'].extend(run['values'])
+            else:
+                blocks.append(run)
+        
+        data = []
+        for block in blocks:
+            first = gspread.utils.rowcol_to_a1(block['row'], block['start'])
+            last = gspread.utils.rowcol_to_a1(block['row'] + len(block['values']) - 1, block['end'])
+            data.append({'range': f"{first}:{last}", 'values': block['values']})
+        return data
+    
+    def commit(self):
+        """Отправить все изменения одним запросом (как update_cell - USER_ENTERED)"""
+        if not self._cells:
+            return None
+        response = self.worksheet.batch_update(self.ranges(), value_input_option='USER_ENTERED')
+        self._cells = {}
+        return response
+
+def local_cell_value(value):
+    """Значение ячейки в том виде, в каком его вернет Google Sheets"""
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def encode_row(values):
+    """JSON строки для локальной базы; пустые ячейки в конце отбрасываются, как это делает Sheets API"""
+    values = [local_cell_value(v) for v in values]
+    while values and values[-1] == "":
+        values.pop()
+    return json.dumps(values, ensure_ascii=False)
+
+def parse_a1_range(range_name):
+    """'A5:M' / 'I5:J6' / 'F5' -> (первая строка, первая колонка, последняя строка или None, последняя колонка или None)"""
+    range_name = range_name.split('!')[-1]
+    match = re.fullmatch(r"([A-Z]+)(\d+)(?::([A-Z]+)(\d*))?", range_name)
+    if not match:
+        raise ValueError(f"Неподдерживаемый диапазон: {range_name}")
+    first_row, first_col = gspread.utils.a1_to_rowcol(match.group(1) + match.group(2))
+    if match.group(3) is None:
+        return first_row, first_col, first_row, first_col
+    last_col = gspread.utils.a1_to_rowcol(match.group(3) + "1")[1]
+    last_row = int(match.group(4)) if match.group(4) else None
+    return first_row, first_col, last_row, last_col
+
+class LocalStore:
+    """Локальная SQLite база (WAL) - основное хранилище данных бота.
+    
+    Листы хранятся построчно с теми же номерами строк, что и в Google Sheets.
+    Каждое изменение в той же транзакции попадает в outbox, откуда его
+    забирает SheetsMirror и переносит в таблицу.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"PRAGMA synchronous={LOCAL_DB_SYNCHRONOUS}")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sheet_rows (
+                sheet TEXT NOT NULL,
+                row INTEGER NOT NULL,
+                cells TEXT NOT NULL,
+                PRIMARY KEY (sheet, row)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sheet TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                dead_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            ) WITHOUT ROWID;
+        """)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(outbox)")}
+        if 'attempts' not in columns:
+            # База от предыдущей версии - добавляем счетчик попыток отправки
+            self._conn.execute("ALTER TABLE outbox ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+            self._conn.execute("ALTER TABLE outbox ADD COLUMN dead_at REAL")
+    
+    def get_meta(self, key):
+        """Служебное значение (не зеркалируется в Google Sheets)"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+    
+    def set_meta(self, key, value):
+        with self._lock:
+            if value is None:
+                self._conn.execute("DELETE FROM meta WHERE key = ?", (key,))
+            else:
+                self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+    
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+    
+    def row_count(self, sheet):
+        with self._lock:
+            result = self._conn.execute("SELECT MAX(row) FROM sheet_rows WHERE sheet = ?", (sheet,)).fetchone()
+            return result[0] or 0
+    
+    def get_rows(self, sheet, first_row=1, last_row=None):
+        """Строки листа начиная с first_row; пропущенные строки возвращаются пустыми"""
+        with self._lock:
+            last = last_row if last_row is not None else self.row_count(sheet)
+            stored = dict(self._conn.execute(
+                "SELECT row, cells FROM sheet_rows WHERE sheet = ? AND row BETWEEN ? AND ?",
+                (sheet, first_row, last)
+            ).fetchall())
+        return [json.loads(stored[row]) if row in stored else [] for row in range(first_row, last + 1)]
+    
+    def append_rows(self, sheet, rows, value_input_option='RAW'):
+        """Дописать строки в конец листа; возвращает номер первой записанной строки"""
+        with self.transaction() as conn:
+            first_row = self.row_count(sheet) + 1
+            conn.executemany(
+                "INSERT INTO sheet_rows (sheet, row, cells) VALUES (?, ?, ?)",
+                [(sheet, first_row + i, encode_row(row)) for i, row in enumerate(rows)]
+            )
+            self._enqueue(conn, sheet, 'append', {
+                'row': first_row, 'values': rows, 'value_input_option': value_input_option
+            })
+        return first_row
+    
+    def update_cells(self, sheet, cells, value_input_option='USER_ENTERED'):
+        """Записать ячейки [(row, col, value), ...]"""
+        with self.transaction() as conn:
+            touched = {}
+            for row, col, value in cells:
+                if row not in touched:
+                    touched[row] = self.get_rows(sheet, row, row)[0]
+                values = touched[row]
+                values.extend([""] * (col - len(values)))
+                values[col - 1] = value
+            conn.executemany(
+                "INSERT OR REPLACE INTO sheet_rows (sheet, row, cells) VALUES (?, ?, ?)",
+                [(sheet, row, encode_row(values)) for row, values in touched.items()]
+            )
+            self._enqueue(conn, sheet, 'update', {
+                'cells': [list(cell) for cell in cells], 'value_input_option': value_input_option
+            })
+    
+    def _enqueue(self, conn, sheet, kind, payload):
+        conn.execute(
+            "INSERT INTO outbox (sheet, kind, payload, created_at) VALUES (?, ?, ?, ?)",
+            (sheet, kind, json.dumps(payload, ensure_ascii=False, default=str), time.time())
+        )
+    
+    def pending_ops(self, limit):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, sheet, kind, payload FROM outbox WHERE dead_at IS NULL ORDER BY id LIMIT ?", (limit,)
+            ).fetchall()
+        return [(op_id, sheet, kind, json.loads(payload)) for op_id, sheet, kind, payload in rows]
+    
+    def ack(self, op_ids):
+        """Удалить из outbox операции, уже перенесенные в Google Sheets"""
+        with self.transaction() as conn:
+            conn.executemany("DELETE FROM outbox WHERE id = ?", [(op_id,) for op_id in op_ids])
+    
+    def fail(self, op_id, max_attempts):
+        """Учесть отказ Google Sheets принять операцию; возвращает число попыток.
+        
+        После max_attempts операция откладывается (dead_at) и больше не отправляется -
+        она остается в outbox для разбора вручную.
+        """
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE outbox SET attempts = attempts + 1, "
+                "dead_at = CASE WHEN attempts + 1 >= ? THEN ? END WHERE id = ?",
+                (max_attempts, time.time(), op_id)
+            )
+            row = conn.execute("SELECT attempts FROM outbox WHERE id = ?", (op_id,)).fetchone()
+        return row[0] if row else 0
+    
+    def has_pending(self, sheet):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM outbox WHERE sheet = ? AND dead_at IS NULL LIMIT 1", (sheet,)
+            ).fetchone() is not None
+    
+    def backlog(self):
+        """(количество несинхронизированных операций, время самой старой из них)"""
+        with self._lock:
+            count, oldest = self._conn.execute(
+                "SELECT COUNT(*), MIN(created_at) FROM outbox WHERE dead_at IS NULL"
+            ).fetchone()
+        return count, oldest
+    
+    def replace_if_idle(self, sheet, values):
+        """Заменить лист данными из Google Sheets, если нет неотправленных изменений.
+        
+        Возвращает True, если локальные данные изменились.
+        """
+        encoded = [encode_row(row) for row in values]
+        with self.transaction() as conn:
+            if self.has_pending(sheet):
+                return False
+            current = [cells for _, cells in conn.execute(
+                "SELECT row, cells FROM sheet_rows WHERE sheet = ? ORDER BY row", (sheet,)
+            ).fetchall()]
+            if current == encoded:
+                return False
+            conn.execute("DELETE FROM sheet_rows WHERE sheet = ?", (sheet,))
+            conn.executemany(
+                "INSERT INTO sheet_rows (sheet, row, cells) VALUES (?, ?, ?)",
+                [(sheet, row, cells) for row, cells in enumerate(encoded, start=1)]
+            )
+            return True
+
+class LocalWorksheet:
+    """Лист из локальной базы с тем же API, что и gspread.Worksheet.
+    
+    Чтение и запись идут в SQLite, изменения уходят в Google Sheets через SheetsMirror.
+    """
+    
+    def __init__(self, store, title):
+        self.store = store
+        self.title = title
+    
+    def get_all_values(self):
+        return self.store.get_rows(self.title)
+    
+    def get_all_records(self):
+        values = self.get_all_values()
+        if not values:
+            return []
+        headers = values[0]
+        return [
+            dict(zip(headers, gspread.utils.numericise_all((row + [""] * len(headers))[:len(headers)])))
+            for row in values[1:]
+        ]
+    
+    def get_values(self, range_name=None):
+        if range_name is None:
+            return self.get_all_values()
+        first_row, first_col, last_row, last_col = parse_a1_range(range_name)
+        rows = self.store.get_rows(self.title, first_row, last_row)
+        return [row[first_col - 1:last_col] for row in rows]
+    
+    def _updated_range(self, first_row, rows):
+        width = max([len(row) for row in rows] + [1])
+        last = gspread.utils.rowcol_to_a1(first_row + len(rows) - 1, width)
+        return {'updates': {'updatedRange': f"'{self.title}'!A{first_row}:{last}"}}
+    
+    def append_row(self, values, value_input_option='RAW', **kwargs):
+        return self.append_rows([values], value_input_option=value_input_option)
+    
+    def append_rows(self, values, value_input_option='RAW', **kwargs):
+        rows = [list(row) for row in values]
+        first_row = self.store.append_rows(self.title, rows, value_input_option)
+        return self._updated_range(first_row, rows)
+    
+    def update_cell(self, row, col, value):
+        self.store.update_cells(self.title, [(row, col, value)])
+    
+    def batch_update(self, data, value_input_option='USER_ENTERED', **kwargs):
+        cells = []
+        for item in data:
+            first_row, first_col, _, _ = parse_a1_range(item['range'])
+            for i, row_values in enumerate(item['values']):
+                for j, value in enumerate(row_values):
+                    cells.append((first_row + i, first_col + j, value))
+        if cells:
+            self.store.update_cells(self.title, cells, value_input_option)
+
+class SheetsMirror:
+    """Фоновая репликация локальной базы в Google Sheets.
+    
+    Изменения из outbox отправляются пачками: подряд идущие добавления строк
+    одного листа - одним append_rows, изменения ячеек - одним batch_update.
+    Когда неотправленных изменений нет, лист периодически перечитывается,
+    чтобы подхватить ручные правки администратора в таблице.
+    
+    Изменение, которое Google Sheets отвергает из-за его данных, после
+    MIRROR_MAX_ATTEMPTS попыток откладывается, чтобы не держать очередь листа.
+    """
+    
+    def __init__(self, store):
+        self.store = store
+        self._remotes = {}
+        self._pulled_at = {}
+        self._shifts = {}       # лист -> [(локальная строка, сдвиг)] после ручных добавлений в таблицу
+        self.last_flush_at = None
+        self.flushed_ops = 0
+        self.pending_ops = 0            # размер очереди на последней итерации run()
+        self.oldest_pending_at = None
+    
+    def attach(self, remote):
+        """Подключить лист Google Sheets как зеркало; вернуть локальный лист"""
+        self._remotes[remote.title] = remote
+        return LocalWorksheet(self.store, remote.title)
+    
+    def titles(self):
+        return list(self._remotes)
+    
+    def pull(self, title, values=None):
+        """Перечитать лист из Google Sheets в локальную базу (если нет неотправленных изменений).
+        
+        values - уже известное содержимое листа (например, только что созданного), без чтения.
+        """
+        if values is None:
+            values = self._remotes[title].get_all_values()
+        self._pulled_at[title] = time.monotonic()
+        replaced = self.store.replace_if_idle(title, values)
+        if not self.store.has_pending(title):
+            # Локальная база совпадает с таблицей - номера строк снова одинаковые
+            self._shifts.pop(title, None)
+        return replaced
+    
+    def flush_once(self):
+        """Отправить накопленные изменения в Google Sheets; возвращает число операций.
+        
+        За один проход по каждому листу делается один append_rows со всеми новыми
+        строками и один batch_update со всеми измененными ячейками. Добавления
+        отправляются первыми: изменения могут ссылаться на только что добавленные
+        строки, а на старые строки добавления не влияют.
+        """
+        with sheets_priority_scope(PRIORITY_HIGH):
+            return self._flush(self.store.pending_ops(MIRROR_BATCH_SIZE))
+    
+    def _flush(self, ops):
+        by_sheet = {}
+        for op in ops:
+            by_sheet.setdefault(op[1], []).append(op)
+        
+        for title, sheet_ops in by_sheet.items():
+            remote = self._remotes.get(title)
+            if remote is None:
+                continue
+            batches = []
+            for kind in ('append', 'update'):
+                groups = {}
+                for op in sheet_ops:
+                    if op[2] == kind:
+                        groups.setdefault(op[3].get('value_input_option'), []).append(op)
+                batches.extend((kind, value_input_option, group) for value_input_option, group in groups.items())
+            for kind, value_input_option, group in batches:
+                if not self._push(remote, kind, group, value_input_option):
+                    # Следующие изменения листа могут ссылаться на неотправленные строки
+                    break
+        
+        self.last_flush_at = time.time()
+        return len(ops)
+    
+    @staticmethod
+    def _is_op_error(error):
+        """Ошибка в данных самой операции: повтор не поможет (в отличие от сбоев сети, квоты и доступа)"""
+        if isinstance(error, gspread.exceptions.APIError):
+            return getattr(error.response, 'status_code', None) == 400
+        return isinstance(error, (KeyError, IndexError, TypeError, ValueError))
+    
+    def _push(self, remote, kind, ops, value_input_option):
+        """Отправить пачку операций; False - какая-то операция не отправлена.
+        
+        Если Google Sheets отвергает пачку, операции отправляются по одной, чтобы
+        отказ одной не задерживал остальные.
+        """
+        try:
+            if kind == 'append':
+                self._push_appends(remote, ops, value_input_option)
+            else:
+                self._push_updates(remote, ops, value_input_option)
+        except Exception as e:
+            if not self._is_op_error(e):
+                raise
+            if len(ops) > 1:
+                return all(self._push(remote, kind, [op], value_input_option) for op in ops)
+            self._fail(remote.title, ops[0], e)
+            return False
+        # Подтверждаем сразу, чтобы при ошибке дальше строки не задублировались
+        self.store.ack([op[0] for op in ops])
+        self.flushed_ops += len(ops)
+        return True
+    
+    def _fail(self, title, op, error):
+        attempts = self.store.fail(op[0], MIRROR_MAX_ATTEMPTS)
+        if attempts < MIRROR_MAX_ATTEMPTS:
+            sheets_logger.warning(
+                "⚠️ '%s': изменение #%s не принято Google Sheets (попытка %s из %s): %s",
+                title, op[0], attempts, MIRROR_MAX_ATTEMPTS, error
+            )
+            return
+        SHEETS_DEAD_OPS.inc(worksheet=title)
+        sheets_logger.error(
+            "❌ '%s': изменение #%s отложено после %s попыток, исправьте его вручную: %s | %s %s",
+            title, op[0], attempts, error, op[2], op[3]
+        )
+    
+    def _remote_row(self, title, row):
+        """Номер строки в Google Sheets для локальной строки"""
+        return row + sum(delta for first_row, delta in self._shifts.get(title, []) if row >= first_row)
+    
+    def _push_appends(self, remote, ops, value_input_option):
+        rows = [row for op in ops for row in op[3]['values']]
+        response = remote.append_rows(rows, value_input_option=value_input_option)
+        remote_row = row_from_append_response(response)
+        local_row = ops[0][3]['row']
+        expected_row = self._remote_row(remote.title, local_row)
+        if remote_row is not None and remote_row != expected_row:
+            # В таблицу вручную дописали строки - сдвигаем номера следующих строк,
+            # а после отправки всех изменений перечитаем лист целиком
+            sheets_logger.warning("⚠️ '%s': строка %s записана в Google Sheets как %s", remote.title, local_row, remote_row)
+            self._shifts.setdefault(remote.title, []).append((local_row, remote_row - expected_row))
+        sheets_logger.info("📤 '%s': %s строк одним append_rows", remote.title, len(rows))
+    
+    def _push_updates(self, remote, ops, value_input_option):
+        batch = CellBatch(remote)
+        for op in ops:
+            for row, col, value in op[3]['cells']:
+                batch.set(self._remote_row(remote.title, row), col, value)
+        remote.batch_update(batch.ranges(), value_input_option=value_input_option)
+    
+    def stats(self):
+        """Состояние очереди отправки в Google Sheets"""
+        pending, oldest = self.store.backlog()
+        return {
+            'pending_ops': pending,
+            'flush_lag_seconds': round(max(0.0, time.time() - oldest), 3) if oldest else 0.0,
+            'flushed_ops': self.flushed_ops,
+            'last_flush_at': self.last_flush_at,
+        }
+    
+    def pull_due(self):
+        """Перечитать листы, у которых подошло время синхронизации; возвращает листы с изменениями"""
+        changed = []
+        now = time.monotonic()
+        with sheets_priority_scope(PRIORITY_LOW):
+            for title in self.titles():
+                due = now - self._pulled_at.get(title, 0) > MIRROR_PULL_INTERVAL
+                if (due or title in self._shifts) and not self.store.has_pending(title) and self.pull(title):
+                    changed.append(title)
+        return changed
+    
+    async def run(self):
+        """Фоновая задача репликации"""
+        sheets_logger.info("🔄 Репликация в Google Sheets: каждые %s c", MIRROR_FLUSH_INTERVAL)
+        while True:
+            try:
+                await run_sheets(self.flush_once)
+                changed = await run_sheets(self.pull_due)
+                if changed:
+                    invalidate_caches(changed)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                sheets_logger.error("❌ Ошибка репликации в Google Sheets: %s", e)
+            
+            self.pending_ops, self.oldest_pending_at = await run_sheets(self.store.backlog)
+            lag = max(0.0, time.time() - self.oldest_pending_at) if self.oldest_pending_at else 0.0
+            if lag > MIRROR_LAG_WARNING:
+                sheets_logger.warning("⚠️ Изменения не отправлены в Google Sheets уже %.0f c", lag)
+            await asyncio.sleep(MIRROR_FLUSH_INTERVAL)
+
+local_store = LocalStore(LOCAL_DB_PATH)
+sheets_mirror = SheetsMirror(local_store)
+
+def invalidate_caches(titles=None):
+    """Сбросить in-memory индексы и снимок настроек (titles - только кэши этих листов)"""
+    caches = (
+        (users_sheet, user_index),
+        (payments_sheet, payment_index),
+        (attendance_sheet, attendance_index),
+        (settings_sheet, SettingsManager),
+    )
+    for sheet, cache in caches:
+        if titles is None or (sheet is not None and sheet.title in titles):
+            cache.invalidate()
+
+class SheetIndex:
+    """Базовый in-memory индекс листа Google Sheets.
+    
+    Лист загружается целиком один раз, затем раз в tail_interval секунд
+    догружаются только новые строки в конце листа, а раз в full_ttl секунд
+    индекс перестраивается полностью (чтобы подхватить ручные правки в таблице).
+    Записи бота обновляют индекс сразу (write-through).
+    
+    Полная перезагрузка читает и разбирает лист без self._lock (на большом листе
+    это секунды), поэтому обращения к индексу из цикла событий не ждут ее;
+    изменения, сделанные за это время, повторяются на новом индексе перед подменой.
+    """
+    
+    def __init__(self, sheet_getter, default_headers, full_ttl, tail_interval):
+        self._sheet_getter = sheet_getter
+        self._default_headers = list(default_headers)
+        self.full_ttl = full_ttl
+        self.tail_interval = tail_interval
+        self._lock = threading.RLock()
+        self._reload_lock = threading.Lock()   # одна загрузка листа за раз
+        self._journal = None                   # изменения во время перезагрузки
+        self._loaded = False
+        self._loaded_at = 0.0
+        self._tail_at = 0.0
+        self._headers = list(default_headers)
+        self._next_row = 2
+        self._reset()
+    
+    def col_of(self, field):
+        """Номер колонки (с 1) по названию заголовка"""
+        try:
+            return self._headers.index(field) + 1
+        except ValueError:
+            return self._default_headers.index(field) + 1
+    
+    def invalidate(self):
+        """Сбросить индекс - следующее обращение загрузит лист заново"""
+        with self._lock:
+            self._record_change('invalidate')
+            self._loaded = False
+    
+    def _record_change(self, method, *args, **kwargs):
+        """Запомнить изменение (вызывается под self._lock), если сейчас идет перезагрузка"""
+        if self._journal is not None:
+            self._journal.append((method, args, kwargs))
+    
+    def ensure_fresh(self):
+        """Загрузить или догрузить индекс при необходимости. False - лист недоступен"""
+        sheet = self._sheet_getter()
+        if sheet is None:
+            return False
+        with self._reload_lock:
+            with self._lock:
+                now = time.monotonic()
+                stale = not self._loaded or now - self._loaded_at > self.full_ttl
+                if stale:
+                    CACHE_REQUESTS.inc(cache=type(self).__name__, result='miss')
+                elif now - self._tail_at > self.tail_interval:
+                    CACHE_REQUESTS.inc(cache=type(self).__name__, result='tail')
+                    self._refresh_tail(sheet)
+                else:
+                    CACHE_REQUESTS.inc(cache=type(self).__name__, result='hit')
+            if stale:
+                self._reload(sheet)
+        return True
+    
+    def ensure_loaded(self):
+        """Загрузить индекс, только если он еще не загружен (без догрузки хвоста)"""
+        sheet = self._sheet_getter()
+        if sheet is None:
+            return False
+        with self._reload_lock:
+            if not self._loaded:
+                self._reload(sheet)
+        return True
+    
+    def _reload(self, sheet):
+        """Перечитать лист в новый индекс и подменить им текущий (под self._reload_lock)"""
+        with self._lock:
+            self._journal = []
+        try:
+            values = sheet.get_all_values()
+            fresh = copy.copy(self)
+            fresh._lock = threading.RLock()
+            fresh._journal = None
+            fresh._load(values)
+        finally:
+            with self._lock:
+                journal, self._journal = self._journal, None
+        with self._lock:
+            for method, args, kwargs in journal:
+                if method == 'note_appended' and args[0] is not None and args[0] <= len(values):
+                    # Строка уже есть в прочитанном листе
+                    continue
+                getattr(fresh, method)(*args, **kwargs)
+            for name, value in vars(fresh).items():
+                if name not in ('_lock', '_journal'):
+                    setattr(self, name, value)
+    
+    def _load(self, values):
+        self._reset()
+        self._headers = values[0] if values and values[0] else list(self._default_headers)
+        debug_row = sampled_debug(sheets_logger)
+        for row_number, row in enumerate(values[1:], start=2):
+            record = self._to_record(row)
+            if debug_row:
+                debug_row("%s: строка %d -> %s", type(self).__name__, row_number, record)
+            self._apply_row(row_number, record)
+        self._next_row = max(len(values) + 1, 2)
+        self._loaded = True
+        self._loaded_at = self._tail_at = time.monotonic()
+    
+    def _refresh_tail(self, sheet):
+        """Догрузить строки, добавленные в лист после последней загрузки"""
+        last_col = column_letter(len(self._headers))
+        values = sheet.get_values(f"A{self._next_row}:{last_col}")
+        debug_row = sampled_debug(sheets_logger)
+        for offset, row in enumerate(values):
+            record = self._to_record(row)
+            if debug_row:
+                debug_row("%s: новая строка %d -> %s", type(self).__name__, self._next_row + offset, record)
+            self._apply_row(self._next_row + offset, record)
+        self._next_row += len(values)
+        self._tail_at = time.monotonic()
+    
+    def _to_record(self, row):
+        row = list(row) + [""] * (len(self._headers) - len(row))
+        return dict(zip(self._headers, gspread.utils.numericise_all(row[:len(self._headers)])))
+    
+    def note_appended(self, row_number, row):
+        """Зарегистрировать строку, которую бот только что дописал в лист"""
+        with self._lock:
+            self._record_change('note_appended', row_number, row)
+            if not self._loaded:
+                return
+            if row_number is None:
+                # Не знаем куда попала строка - перечитаем лист при следующем обращении
+                self._loaded = False
+                return
+            self._apply_row(row_number, self._to_record([str(v) for v in row]))
+            self._next_row = max(self._next_row, row_number + 1)
+    
+    def _reset(self):
+        raise NotImplementedError
+    
+    def _apply_row(self, row_number, record):
+        raise NotImplementedError
+
+class UserIndex(SheetIndex):
+    """Индекс пользователей: telegram_id -> запись и номер строки в листе.
+    
+    Попутно считает пользователей по статусам для статистики.
+    """
+    
+    def _reset(self):
+        self._users = {}
+        self._rows = {}
+        self._status_counts = {}
+    
+    def _count_status(self, status, delta):
+        status = str(status)
+        self._status_counts[status] = self._status_counts.get(status, 0) + delta
+    
+    def _apply_row(self, row_number, record):
+        key = str(record.get('telegram_id', ''))
+        if not key or key in self._users:
+            # Как и раньше, при дублях используется первая строка
+            return
+        self._users[key] = record
+        self._rows[key] = row_number
+        self._count_status(record.get('status', ''), 1)
+    
+    def get(self, telegram_id):
+        with self._lock:
+            user = self._users.get(str(telegram_id))
+            return dict(user) if user is not None else None
+    
+    def row_of(self, telegram_id):
+        with self._lock:
+            return self._rows.get(str(telegram_id))
+    
+    def set_fields(self, telegram_id, **fields):
+        """Обновить поля пользователя в индексе после записи в лист"""
+        with self._lock:
+            self._record_change('set_fields', telegram_id, **fields)
+            user = self._users.get(str(telegram_id))
+            if user is not None:
+                if 'status' in fields:
+                    self._count_status(user.get('status', ''), -1)
+                    self._count_status(fields['status'], 1)
+                user.update(fields)
+    
+    def status_counts(self):
+        """Количество пользователей по статусам"""
+        with self._lock:
+            return {status: n for status, n in self._status_counts.items() if n}
+
+user_index = UserIndex(lambda: users_sheet, USERS_HEADERS, USERS_CACHE_TTL, USERS_TAIL_REFRESH)
+
+def normalize_amount(value):
+    """Сумма платежа в копейках (int) для точного сравнения; None если не число"""
+    try:
+        return int(round(float(str(value).replace(' ', '').replace(',', '.')) * 100))
+    except (ValueError, TypeError):
+        return None
+
+class PaymentIndex(SheetIndex):
+    """Индекс истории платежей.
+    
+    Хранит payment_id -> номер строки, а для ожидающих платежей еще и
+    (telegram_id, сумма в копейках) -> номера строк (для платежей без
+    payment_id), поэтому подтверждение и отклонение не читают весь лист.
+    """
+    
+    def _reset(self):
+        self._records = {}      # номер строки -> запись
+        self._ids = {}          # payment_id -> номер строки
+        self._user_rows = {}    # telegram_id -> номера строк по порядку
+        self._pending = {}      # (telegram_id, сумма) -> номера строк pending платежей
+        self._pending_rows = [] # номера строк всех pending платежей по возрастанию
+        self._monthly = {}      # "ГГГГ-ММ" -> [кол-во, сумма в копейках] подтвержденных платежей
+    
+    @staticmethod
+    def _pending_key(record):
+        return (str(record.get('telegram_id', '')), normalize_amount(record.get('amount', '')))
+    
+    def _apply_row(self, row_number, record):
+        previous = self._records.get(row_number)
+        if previous is not None:
+            self._unlink_pending(row_number, previous)
+            self._count_income(previous, -1)
+            if self._ids.get(previous.get('payment_id')) == row_number:
+                del self._ids[previous['payment_id']]
+        else:
+            self._user_rows.setdefault(str(record.get('telegram_id', '')), []).append(row_number)
+        self._records[row_number] = record
+        self._count_income(record, 1)
+        if record.get('payment_id'):
+            self._ids.setdefault(str(record['payment_id']), row_number)
+        if str(record.get('status', '')).lower() == 'pending':
+            key = self._pending_key(record)
+            if key[1] is not None:
+                self._pending.setdefault(key, []).append(row_number)
+            bisect.insort(self._pending_rows, row_number)
+    
+    def _count_income(self, record, sign):
+        """Учесть (sign=1) или убрать (sign=-1) подтвержденный платеж из доходов по месяцам"""
+        if record.get('status') != 'confirmed':
+            return
+        cents = normalize_amount(record.get('amount', ''))
+        month = str(record.get('timestamp', ''))[:7]
+        if cents is None or not month:
+            return
+        totals = self._monthly.setdefault(month, [0, 0])
+        totals[0] += sign
+        totals[1] += sign * cents
+    
+    def monthly_income(self, month):
+        """(кол-во, сумма) подтвержденных платежей за месяц "ГГГГ-ММ" """
+        with self._lock:
+            count, cents = self._monthly.get(month, (0, 0))
+            return count, cents / 100
+    
+    def _unlink_pending(self, row_number, record):
+        i = bisect.bisect_left(self._pending_rows, row_number)
+        if i < len(self._pending_rows) and self._pending_rows[i] == row_number:
+            del self._pending_rows[i]
+        key = self._pending_key(record)
+        rows = self._pending.get(key)
+        if rows and row_number in rows:
+            rows.remove(row_number)
+            if not rows:
+                del self._pending[key]
+    
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending_rows)
+    
+    def pending_page(self, offset, limit):
+        """Ожидающие платежи [(номер строки, запись), ...] по порядку, начиная с offset"""
+        with self._lock:
+            return [(r, dict(self._records[r])) for r in self._pending_rows[offset:offset + limit]]
+    
+    def user_payments(self, telegram_id, status=None):
+        """Платежи пользователя по порядку строк (с фильтром по статусу)"""
+        with self._lock:
+            records = (self._records[r] for r in self._user_rows.get(str(telegram_id), []))
+            return [
+                dict(record) for record in records
+                if status is None or str(record.get('status', '')).lower() == status
+            ]
+    
+    def find_by_id(self, payment_id):
+        """Строка платежа по payment_id"""
+        with self._lock:
+            return self._ids.get(payment_id)
+    
+    def find_pending(self, telegram_id, amount):
+        """Строка самого раннего pending платежа пользователя на эту сумму"""
+        with self._lock:
+            rows = self._pending.get((str(telegram_id), normalize_amount(amount)))
+            return rows[0] if rows else None
+    
+    def set_fields(self, row_number, **fields):
+        """Обновить запись платежа в индексе после записи в лист"""
+        with self._lock:
+            self._record_change('set_fields', row_number, **fields)
+            record = self._records.get(row_number)
+            if record is None:
+                return
+            updated = dict(record, **fields)
+            self._apply_row(row_number, updated)
+    
+    def claim_pending(self, row_number, **fields):
+        """Обновить запись, только если платеж еще pending; возвращает прежнюю запись или None.
+        
+        Проверка и изменение под одной блокировкой: из двух одновременных нажатий
+        (уведомление и список ожидающих) решение примет только первое.
+        """
+        with self._lock:
+            self._record_change('claim_pending', row_number, **fields)
+            record = self._records.get(row_number)
+            if record is None or str(record.get('status', '')).lower() != 'pending':
+                return None
+            self._apply_row(row_number, dict(record, **fields))
+            return record
+
+payment_index = PaymentIndex(lambda: payments_sheet, PAYMENTS_HEADERS, PAYMENTS_CACHE_TTL, PAYMENTS_TAIL_REFRESH)
+
+def collect_statistics(refresh=True):
+    """Сводная статистика из счетчиков индексов.
+    
+    Счетчики обновляются при каждой записи бота; с refresh=False лист
+    читается, только если индекс еще ни разу не загружался.
+    """
+    for index in (user_index, payment_index):
+        if refresh:
+            index.ensure_fresh()
+        else:
+            index.ensure_loaded()
+    statuses = user_index.status_counts()
+    total_users = sum(statuses.values())
+    active_users = statuses.get('active', 0)
+    current_month = datetime.now().strftime("%Y-%m")
+    monthly_count, monthly_income = payment_index.monthly_income(current_month)
+    return {
+        "total_users": total_users,
+        "active_users": active_users,
+        "inactive_users": total_users - active_users,
+        "pending_payments": payment_index.pending_count(),
+        "month": current_month,
+        "monthly_confirmed_payments": monthly_count,
+        "monthly_income": monthly_income
+    }
+
+class AttendanceIndex(SheetIndex):
+    """Счетчики посещений: для каждого пользователя отсортированный список дат 'attended'.
+    
+    Количество занятий после даты последней оплаты считается бинарным поиском,
+    так что размер журнала посещений не влияет на стоимость запроса.
+    """
+    
+    def _reset(self):
+        self._attended = {}     # telegram_id -> отсортированные даты посещений
+    
+    def _apply_row(self, row_number, record):
+        if record.get('status') != 'attended':
+            return
+        dates = self._attended.setdefault(str(record.get('telegram_id', '')), [])
+        bisect.insort(dates, str(record.get('date', '')))
+    
+    def count_since(self, telegram_id, since_date=''):
+        """Сколько занятий посещено строго после since_date (все, если дата пустая)"""
+        with self._lock:
+            dates = self._attended.get(str(telegram_id), [])
+            if not since_date:
+                return len(dates)
+            return len(dates) - bisect.bisect_right(dates, str(since_date))
+
+attendance_index = AttendanceIndex(lambda: attendance_sheet, ATTENDANCE_HEADERS, ATTENDANCE_CACHE_TTL, ATTENDANCE_TAIL_REFRESH)
+
+# Настройки, которые хранятся как целые числа
+INT_SETTINGS = ('min_payment', 'max_payment', 'monthly_price', 'sessions_per_month', 'free_days_limit', 'sick_days_limit')
+
+class SettingsSnapshot:
+    """Неизменяемый снимок листа настроек с уже приведенными типами"""
+    
+    def __init__(self, values, rows):
+        self.values = values        # parameter -> int/str
+        self.rows = rows            # parameter -> номер строки в листе
+        self.loaded_at = time.monotonic()
+    
+    def get(self, key, default_value=None):
+        return self.values.get(key, default_value)
+    
+    @staticmethod
+    def parse_value(key, raw):
+        if key in INT_SETTINGS:
+            return int(float(str(raw).replace(' ', '').replace(',', '.')))
+        return str(raw)
+
 class SettingsManager:
+    _snapshot = None
+    _lock = threading.Lock()
+    
+    @staticmethod
+    def invalidate():
+        """Сбросить снимок настроек"""
+        with SettingsManager._lock:
+            SettingsManager._snapshot = None
+    
+    @staticmethod
+    def get_snapshot():
+        """Текущий снимок настроек; лист читается не чаще раза в SETTINGS_CACHE_TTL секунд"""
+        snapshot = SettingsManager._snapshot
+        if snapshot is not None and time.monotonic() - snapshot.loaded_at <= SETTINGS_CACHE_TTL:
+            CACHE_REQUESTS.inc(cache='settings', result='hit')
+            return snapshot
+        
+        CACHE_REQUESTS.inc(cache='settings', result='miss')
+        with SettingsManager._lock:
+            snapshot = SettingsManager._snapshot
+            if snapshot is not None and time.monotonic() - snapshot.loaded_at <= SETTINGS_CACHE_TTL:
+                return snapshot
+            
+            values, rows = {}, {}
+            for i, row in enumerate(settings_sheet.get_all_values()[1:], start=2):
+                if len(row) < 2 or not row[0] or row[0] in rows:
+                    continue
+                rows[row[0]] = i
+                try:
+                    values[row[0]] = SettingsSnapshot.parse_value(row[0], row[1])
+                except (ValueError, TypeError) as e:
+                    settings_logger.warning("Некорректное значение настройки %s=%r: %s", row[0], row[1], e)
+            
+            SettingsManager._snapshot = SettingsSnapshot(values, rows)
+            return SettingsManager._snapshot
+    
     @staticmethod
     def get_setting(key, default_value=None):
         """Получить настройку"""
         try:
             if settings_sheet is None:
-                print(f"❌ settings_sheet не инициализирован, возвращаем {key}={default_value}")
+                settings_logger.error("❌ settings_sheet не инициализирован, возвращаем %s=%s", key, default_value)
                 return default_value
-                
-            settings = settings_sheet.get_all_records()
-            for setting in settings:
-                if setting.get('parameter') == key:
-                    value = setting.get('value')
-                    if key in ['min_payment', 'max_payment', 'monthly_price', 'sessions_per_month', 'free_days_limit', 'sick_days_limit']:
-                        return int(value)
-                    return str(value)
-            return default_value
+            
+            return SettingsManager.get_snapshot().get(key, default_value)
         except Exception as e:
-            print(f"Ошибка получения настройки {key}: {e}, возвращаем default: {default_value}")
+            settings_logger.error("Ошибка получения настройки %s: %s, возвращаем default: %s", key, e, default_value)
             return default_value
     
     @staticmethod
@@ -297,22 +1914,22 @@ class SettingsManager:
         """Обновить настройку"""
         try:
             if settings_sheet is None:
-                print(f"❌ settings_sheet не инициализирован")
+                settings_logger.error("❌ settings_sheet не инициализирован")
                 return False
-                
-            settings = settings_sheet.get_all_values()
-            for i, row in enumerate(settings[1:], start=2):
-                if len(row) >= 2 and row[0] == key:
-                    settings_sheet.update_cell(i, 2, value)
-                    print(f"Настройка {key} обновлена на {value}")
-                    return True
             
-            settings_sheet.append_row([key, value, ""])
-            print(f"Добавлена новая настройка {key}: {value}")
+            row = SettingsManager.get_snapshot().rows.get(key)
+            if row is not None:
+                settings_sheet.update_cell(row, 2, value)
+                settings_logger.info("Настройка %s обновлена на %s", key, value)
+            else:
+                settings_sheet.append_row([key, value, ""])
+                settings_logger.info("Добавлена новая настройка %s: %s", key, value)
+            
+            SettingsManager.invalidate()
             return True
             
         except Exception as e:
-            print(f"Ошибка обновления настройки {key}: {e}")
+            settings_logger.error("Ошибка обновления настройки %s: %s", key, e)
             return False
 
 class UserManager:
@@ -321,7 +1938,7 @@ class UserManager:
         """Получить пользователя из Google Sheets"""
         try:
             if users_sheet is None:
-                print("❌ users_sheet не инициализирован")
+                users_logger.error("❌ users_sheet не инициализирован")
                 if str(telegram_id) == str(ADMIN_ID):
                     return {
                         'telegram_id': telegram_id,
@@ -332,14 +1949,11 @@ class UserManager:
                         'status': 'active'
                     }
                 return None
-                
-            users = users_sheet.get_all_records()
-            for user in users:
-                if str(user.get('telegram_id')) == str(telegram_id):
-                    return user
-            return None
+            
+            user_index.ensure_fresh()
+            return user_index.get(telegram_id)
         except Exception as e:
-            print(f"Ошибка получения пользователя: {e}")
+            users_logger.error("Ошибка получения пользователя: %s", e)
             if str(telegram_id) == str(ADMIN_ID):
                 return {
                     'telegram_id': telegram_id,
@@ -356,7 +1970,7 @@ class UserManager:
         """Добавить пользователя в Google Sheets"""
         try:
             if users_sheet is None:
-                print("❌ users_sheet не инициализирован")
+                users_logger.error("❌ users_sheet не инициализирован")
                 return False
                 
             row = [
@@ -364,11 +1978,11 @@ class UserManager:
                 datetime.now().strftime("%Y-%m-%d"),
                 0, 0, "", "", "", "active", ""
             ]
-            users_sheet.append_row(row)
-            print(f"Пользователь добавлен в Google Sheets: {name}")
+            append_indexed_row(users_sheet, user_index, row)
+            users_logger.info("Пользователь добавлен в Google Sheets: %s", name)
             return True
         except Exception as e:
-            print(f"Ошибка добавления пользователя: {e}")
+            users_logger.error("Ошибка добавления пользователя: %s", e)
             return False
     
     @staticmethod
@@ -376,25 +1990,24 @@ class UserManager:
         """Обновить статус пользователя в Google Sheets"""
         try:
             if users_sheet is None:
-                print("❌ users_sheet не инициализирован")
+                users_logger.error("❌ users_sheet не инициализирован")
                 return False
             
-            # Получаем все записи пользователей
-            users = users_sheet.get_all_records()
+            # Номер строки берем из индекса вместо полного чтения листа
+            user_index.ensure_fresh()
+            row = user_index.row_of(telegram_id)
             
-            # Ищем пользователя для обновления
-            for i, user in enumerate(users, start=2):  # start=2 потому что строка 1 - заголовки
-                if str(user.get('telegram_id')) == str(telegram_id):
-                    # Обновляем статус (колонка 12 - "status")
-                    users_sheet.update_cell(i, 12, new_status)
-                    print(f"✅ Статус пользователя {telegram_id} обновлен на '{new_status}'")
-                    return True
+            if row is None:
+                users_logger.error("❌ Пользователь %s не найден для обновления статуса", telegram_id)
+                return False
             
-            print(f"❌ Пользователь {telegram_id} не найден для обновления статуса")
-            return False
+            users_sheet.update_cell(row, user_index.col_of('status'), new_status)
+            user_index.set_fields(telegram_id, status=new_status)
+            users_logger.info("✅ Статус пользователя %s обновлен на '%s'", telegram_id, new_status)
+            return True
             
         except Exception as e:
-            print(f"❌ Ошибка обновления статуса пользователя: {e}")
+            users_logger.error("❌ Ошибка обновления статуса пользователя: %s", e)
             return False
     
     @staticmethod
@@ -404,31 +2017,17 @@ class UserManager:
             if attendance_sheet is None:
                 return 0
                 
-            attendance_records = attendance_sheet.get_all_records()
             user = UserManager.get_user(telegram_id)
             
             if not user:
                 return 0
-                
-            last_payment_date = user.get('last_payment_date', '')
             
-            if not last_payment_date:
-                count = sum(
-                    1 for record in attendance_records
-                    if str(record.get('telegram_id')) == str(telegram_id) and 
-                       record.get('status') == 'attended'
-                )
-            else:
-                count = sum(
-                    1 for record in attendance_records
-                    if str(record.get('telegram_id')) == str(telegram_id) and 
-                       record.get('status') == 'attended' and
-                       record.get('date', '') > last_payment_date
-                )
+            attendance_index.ensure_fresh()
+            count = attendance_index.count_since(telegram_id, user.get('last_payment_date', ''))
             
             return count
         except Exception as e:
-            print(f"Ошибка подсчета занятий: {e}")
+            users_logger.error("Ошибка подсчета занятий: %s", e)
             return 0
 
 # Создаем главное меню с кнопками
@@ -462,22 +2061,36 @@ def get_admin_menu():
     )
     return keyboard
 
+def new_payment_id():
+    """Короткий уникальный идентификатор платежа, например "P7KQ2MZXA".
+    
+    Буква в начале не дает таблице превратить идентификатор в число.
+    """
+    while True:
+        payment_id = "P" + base64.b32encode(os.urandom(PAYMENT_ID_BYTES)).decode()
+        if payment_index.find_by_id(payment_id) is None:
+            return payment_id
+
 async def save_payment_to_sheets(telegram_id, amount, payment_type="transfer", status="pending", photo_file_id=None):
-    """Сохранить платеж в Google Sheets - ВСЕГДА с статусом pending"""
+    """Сохранить платеж в Google Sheets - ВСЕГДА с статусом pending.
+    
+    Возвращает payment_id сохраненного платежа или False.
+    """
     try:
         if users_sheet is None or payments_sheet is None:
-            print("❌ Google Sheets не инициализированы")
+            payments_logger.error("❌ Google Sheets не инициализированы")
             return False
             
-        user = UserManager.get_user(telegram_id)
+        user = await run_sheets(UserManager.get_user, telegram_id)
         if not user:
-            print(f"❌ Пользователь {telegram_id} не найден")
+            payments_logger.error("❌ Пользователь %s не найден", telegram_id)
             return False
         
-        current_sessions = UserManager.get_user_sessions_count(telegram_id)
+        current_sessions = await run_sheets(UserManager.get_user_sessions_count, telegram_id)
         
         # ВСЕГДА сохраняем сумму как число, статус как "pending"
         amount_clean = float(amount) if amount else 0
+        payment_id = new_payment_id()
         
         payment_row = [
             datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
@@ -491,226 +2104,195 @@ async def save_payment_to_sheets(telegram_id, amount, payment_type="transfer", s
             "",  # confirmed_by - пустое
             "",  # confirmation_date - пустое  
             current_sessions,
-            ""
+            "",
+            payment_id
         ]
-        payments_sheet.append_row(payment_row)
+        await run_sheets(append_indexed_row, payments_sheet, payment_index, payment_row)
         
-        print(f"✅ Платеж сохранен в Google Sheets для {user['name']}: {amount_clean} сом, статус: pending")
-        return True
+        payments_logger.info("✅ Платеж %s сохранен в Google Sheets для %s: %s сом, статус: pending", payment_id, user['name'], amount_clean)
+        return payment_id
         
     except Exception as e:
-        print(f"❌ Ошибка сохранения платежа: {e}")
+        payments_logger.error("❌ Ошибка сохранения платежа: %s", e)
         return False
 
-async def update_payment_status(user_id: int, amount: float, new_status: str, admin_id: int):
-    """Обновить статус платежа в Google Sheets"""
+# update_payment_status: платеж уже подтвержден или отклонен (повторное/устаревшее нажатие)
+PAYMENT_ALREADY_PROCESSED = "already_processed"
+
+async def update_payment_status(user_id: int, amount: float, new_status: str, admin_id: int, payment_id: str = None):
+    """Обновить статус pending платежа в Google Sheets.
+    
+    Возвращает True, False при ошибке или PAYMENT_ALREADY_PROCESSED, если платеж уже не pending.
+    """
     try:
         if payments_sheet is None:
-            print("❌ payments_sheet не инициализирован")
+            payments_logger.error("❌ payments_sheet не инициализирован")
             return False
         
-        print(f"🔍 Ищем платеж: user_id={user_id}, amount={amount}, status=pending")
-        
-        # Получаем все платежи
-        payments = payments_sheet.get_all_records()
-        print(f"🔍 Всего платежей в таблице: {len(payments)}")
+        await run_sheets(payment_index.ensure_fresh)
         
-        # Ищем платеж для обновления
-        found_payment_row = None
-        for i, payment in enumerate(payments, start=2):  # start=2 потому что строка 1 - заголовки
-            print(f"🔍 Проверяем платеж {i-1}: telegram_id={payment.get('telegram_id')}, amount={payment.get('amount')}, status={payment.get('status')}")
-            
-            # Проверяем совпадение (исправляем проблемы с типами данных)
-            payment_user_id = str(payment.get('telegram_id', ''))
-            payment_amount = payment.get('amount', '')
-            payment_status = str(payment.get('status', ''))
-            
-            # ИСПРАВЛЕННОЕ ПРЕОБРАЗОВАНИЕ AMOUNT К FLOAT
-            try:
-                # Удаляем пробелы и заменяем запятую на точку
-                amount_cleaned = str(payment_amount).replace(' ', '').replace(',', '.')
-                payment_amount_float = float(amount_cleaned)
-                print(f"✅ Успешно преобразовали '{payment_amount}' -> {payment_amount_float}")
-            except (ValueError, TypeError):
-                print(f"⚠️ Не удалось преобразовать amount в float: {payment_amount}")
-                continue
-            
-            # УЛУЧШЕННАЯ ПРОВЕРКА СОВПАДЕНИЯ
-            user_id_match = payment_user_id == str(user_id)
-            # Сравниваем как точно, так и приближенно
-            amount_exact_match = payment_amount_float == float(amount)
-            amount_approx_match = abs(payment_amount_float - float(amount)) < 0.01
-            # ИСПРАВЛЯЕМ ПРОВЕРКУ СТАТУСА - ищем и pending и другие статусы
-            status_match = payment_status.lower() in ['pending']
-            
-            print(f"🔍 Проверка совпадений:")
-            print(f"   - User ID: {payment_user_id} == {user_id} -> {user_id_match}")
-            print(f"   - Amount: {payment_amount_float} ~= {amount} -> {amount_exact_match or amount_approx_match}")
-            print(f"   - Status: {payment_status} in [pending] -> {status_match}")
-            
-            if user_id_match and (amount_exact_match or amount_approx_match) and status_match:
-                found_payment_row = i
-                print(f"✅ Найден платеж для обновления в строке {i}")
-                print(f"   - User ID: {payment_user_id} == {user_id}")
-                print(f"   - Amount: {payment_amount_float} ~= {amount}")
-                print(f"   - Status: {payment_status}")
-                break
-        
-        if found_payment_row is None:
-            print(f"❌ Платеж не найден для пользователя {user_id} на сумму {amount}")
-            
-            # ДОПОЛНИТЕЛЬНЫЙ ПОИСК - ищем последний платеж пользователя
-            print("🔍 Ищем последний платеж пользователя...")
-            user_payments = []
-            for i, payment in enumerate(payments, start=2):
-                if str(payment.get('telegram_id')) == str(user_id):
-                    user_payments.append((i, payment))
-            
-            if user_payments:
-                print(f"🔍 Найдено {len(user_payments)} платежей пользователя:")
-                for row_num, payment in user_payments[-3:]:  # Показываем последние 3
-                    print(f"   Строка {row_num}: Amount={payment.get('amount')}, Status={payment.get('status')}, Time={payment.get('timestamp')}")
-                
-                # Попробуем найти по более мягким критериям
-                for row_num, payment in reversed(user_payments):  # Идем с конца
-                    payment_amount = payment.get('amount', '')
-                    payment_status = str(payment.get('status', ''))
-                    
-                    try:
-                        # ИСПРАВЛЕННОЕ ПРЕОБРАЗОВАНИЕ для поиска по мягким критериям
-                        amount_cleaned = str(payment_amount).replace(' ', '').replace(',', '.')
-                        payment_amount_float = float(amount_cleaned)
-                        
-                        # Ищем любой платеж с нужной суммой, независимо от статуса
-                        if abs(payment_amount_float - float(amount)) < 0.01:
-                            found_payment_row = row_num
-                            print(f"✅ Найден платеж по мягким критериям в строке {row_num}")
-                            print(f"   Amount: {payment_amount} -> {payment_amount_float}")
-                            print(f"   Status: {payment_status}")
-                            break
-                    except:
-                        continue
-            
+        if payment_id:
+            found_payment_row = payment_index.find_by_id(payment_id)
             if found_payment_row is None:
+                payments_logger.error("❌ Платеж %s не найден", payment_id)
                 return False
+            payments_logger.info("✅ Найден платеж %s в строке %s", payment_id, found_payment_row)
+        else:
+            # Платежи, сохраненные до появления payment_id
+            payments_logger.debug("🔍 Ищем платеж: user_id=%s, amount=%s, status=pending", user_id, amount)
+            found_payment_row = payment_index.find_pending(user_id, amount)
+        
+        if found_payment_row is None:
+            # Без payment_id pending платежа нет - значит, его уже обработали
+            payments_logger.warning("⚠️ Нет pending платежа пользователя %s на сумму %s", user_id, amount)
+            return PAYMENT_ALREADY_PROCESSED
+        
+        # Сначала отмечаем решение в индексе: повторное нажатие увидит, что платеж не pending
+        confirmation_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        previous = payment_index.claim_pending(
+            found_payment_row,
+            status=new_status,
+            confirmed_by=str(admin_id),
+            confirmation_date=confirmation_date
+        )
+        if previous is None:
+            payments_logger.warning("⚠️ Платеж в строке %s уже обработан", found_payment_row)
+            return PAYMENT_ALREADY_PROCESSED
+        payments_logger.info("✅ Найден платеж для обновления в строке %s", found_payment_row)
         
-        # Обновляем найденный платеж
+        # Обновляем найденный платеж одним запросом
         try:
-            # Колонка 6 - status (считаем от 1)
-            payments_sheet.update_cell(found_payment_row, 6, new_status)
-            print(f"✅ Обновили статус в ячейке ({found_payment_row}, 6) на '{new_status}'")
-            
-            # Колонка 9 - confirmed_by
-            payments_sheet.update_cell(found_payment_row, 9, str(admin_id))
-            print(f"✅ Обновили confirmed_by в ячейке ({found_payment_row}, 9)")
+            batch = CellBatch(payments_sheet)
+            batch.set(found_payment_row, 6, new_status)           # Колонка 6 - status
+            batch.set(found_payment_row, 9, str(admin_id))        # Колонка 9 - confirmed_by
+            batch.set(found_payment_row, 10, confirmation_date)   # Колонка 10 - confirmation_date
+            await run_sheets(batch.commit)
+            payments_logger.info("✅ Обновили status/confirmed_by/confirmation_date в строке %s", found_payment_row)
             
-            # Колонка 10 - confirmation_date
-            confirmation_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            payments_sheet.update_cell(found_payment_row, 10, confirmation_date)
-            print(f"✅ Обновили confirmation_date в ячейке ({found_payment_row}, 10)")
-            
-            print(f"✅ Статус платежа успешно обновлен: {new_status} для пользователя {user_id}")
+            payments_logger.info("✅ Статус платежа успешно обновлен: %s для пользователя %s", new_status, user_id)
             return True
             
         except Exception as update_error:
-            print(f"❌ Ошибка при обновлении ячеек: {update_error}")
+            payments_logger.error("❌ Ошибка при обновлении ячеек: %s", update_error)
+            payment_index.set_fields(
+                found_payment_row,
+                **{field: previous.get(field, "") for field in ('status', 'confirmed_by', 'confirmation_date')}
+            )
             return False
         
     except Exception as e:
-        print(f"❌ Ошибка обновления статуса платежа: {e}")
-        import traceback
-        traceback.print_exc()
+        payments_logger.exception("❌ Ошибка обновления статуса платежа: %s", e)
         return False
 
 async def update_user_after_payment_confirmation(user_id: int, amount: float, confirmation_date: str):
     """Обновить данные пользователя после подтверждения платежа"""
     try:
         if users_sheet is None:
-            print("❌ users_sheet не инициализирован")
+            payments_logger.error("❌ users_sheet не инициализирован")
             return False
         
-        print(f"🔄 Обновляем данные пользователя {user_id} после подтверждения платежа")
+        payments_logger.info("🔄 Обновляем данные пользователя %s после подтверждения платежа", user_id)
         
-        # Получаем все записи пользователей
-        users = users_sheet.get_all_records()
+        await run_sheets(user_index.ensure_fresh)
+        i = user_index.row_of(user_id)
         
-        # Ищем пользователя для обновления
-        for i, user in enumerate(users, start=2):  # start=2 потому что строка 1 - заголовки
-            if str(user.get('telegram_id')) == str(user_id):
-                print(f"✅ Найден пользователь в строке {i}")
-                
-                # Обновляем данные последней оплаты
-                # Колонка 9 - last_payment_date
-                users_sheet.update_cell(i, 9, confirmation_date.split()[0])  # Только дата без времени
-                
-                # Колонка 10 - last_payment_amount  
-                users_sheet.update_cell(i, 10, amount)
-                
-                # Колонка 12 - status (активируем пользователя)
-                users_sheet.update_cell(i, 12, "active")
-                
-                print(f"✅ Обновлены данные пользователя:")
-                print(f"   - last_payment_date: {confirmation_date.split()[0]}")
-                print(f"   - last_payment_amount: {amount}")
-                print(f"   - status: active")
-                
-                return True
+        if i is None:
+            payments_logger.error("❌ Пользователь %s не найден для обновления данных", user_id)
+            return False
         
-        print(f"❌ Пользователь {user_id} не найден для обновления данных")
-        return False
+        payments_logger.info("✅ Найден пользователь в строке %s", i)
         
-    except Exception as e:
-        print(f"❌ Ошибка обновления данных пользователя: {e}")
-        return False
-
-def create_short_callback_data(action: str, user_id: int, amount: float):
-    """Создать короткий callback_data с хешированием при необходимости"""
-    try:
-        amount_str = str(int(amount)) if amount == int(amount) else str(amount)
-        callback_data = f"{action}_{user_id}_{amount_str}"
+        # Обновляем данные последней оплаты одним запросом
+        batch = CellBatch(users_sheet)
+        batch.set(i, 9, confirmation_date.split()[0])  # Колонка 9 - last_payment_date (только дата)
+        batch.set(i, 10, amount)                       # Колонка 10 - last_payment_amount
+        batch.set(i, 12, "active")                     # Колонка 12 - status (активируем пользователя)
+        await run_sheets(batch.commit)
         
-        # Если callback_data слишком длинный, используем hash
-        if len(callback_data) > 60:  # Оставляем запас до лимита 64
-            user_hash = hashlib.md5(str(user_id).encode()).hexdigest()[:8]
-            amount_hash = hashlib.md5(str(amount_str).encode()).hexdigest()[:6]
-            callback_data = f"{action}_{user_hash}_{amount_hash}"
-            
-            # Сохраняем mapping для обратного поиска
-            save_callback_mapping(callback_data, user_id, amount)
+        user_index.set_fields(
+            user_id,
+            last_payment_date=confirmation_date.split()[0],
+            last_payment_amount=amount,
+            status="active"
+        )
+        
+        payments_logger.info("✅ Обновлены данные пользователя:")
+        payments_logger.debug("   - last_payment_date: %s", confirmation_date.split()[0])
+        payments_logger.debug("   - last_payment_amount: %s", amount)
+        payments_logger.debug("   - status: active")
+        
+        return True
         
-        return callback_data
     except Exception as e:
-        print(f"❌ Ошибка создания callback_data: {e}")
-        return f"{action}_error"
+        payments_logger.error("❌ Ошибка обновления данных пользователя: %s", e)
+        return False
+
+# Формат кнопок платежей: telegram_id, сумма в копейках и payment_id + подпись HMAC.
+# Все данные внутри кнопки, поэтому кнопки работают и после перезапуска бота.
+PAYMENT_ID_BYTES = 5
+PAYMENT_CALLBACK_FORMAT = struct.Struct(f">qq{PAYMENT_ID_BYTES}s")
+LEGACY_PAYMENT_CALLBACK_FORMAT = struct.Struct(">qq")    # кнопки без payment_id
+CALLBACK_SIGNATURE_SIZE = 8
+PAYMENT_ID_PATTERN = re.compile(rf"P[A-Z2-7]{{{PAYMENT_ID_BYTES * 8 // 5}}}")    # как в new_payment_id
 
-# Простое хранилище mapping для callback (в памяти)
-callback_mappings = {}
+def callback_signature(action: str, payload: bytes):
+    """Подпись данных кнопки (действие тоже подписано - нельзя превратить отклонение в подтверждение)"""
+    key = (CALLBACK_SECRET or BOT_TOKEN or "").encode()
+    return hmac.new(key, action.encode() + payload, hashlib.sha256).digest()[:CALLBACK_SIGNATURE_SIZE]
 
-def save_callback_mapping(callback_data: str, user_id: int, amount: float):
-    """Сохранить mapping hash -> реальные данные"""
-    callback_mappings[callback_data] = {'user_id': user_id, 'amount': amount}
+def create_short_callback_data(action: str, user_id: int, amount: float, payment_id: str = None):
+    """Создать подписанный callback_data вида "<action>_<base64>" (не длиннее 64 байт).
+    
+    payment_id, исправленный в таблице вручную и не подходящий по формату, в кнопку
+    не кладется - такой платеж ищется по пользователю и сумме.
+    """
+    if payment_id and not PAYMENT_ID_PATTERN.fullmatch(payment_id):
+        payments_logger.warning("⚠️ Некорректный payment_id %r, кнопка без него", payment_id)
+        payment_id = None
+    if payment_id:
+        payload = PAYMENT_CALLBACK_FORMAT.pack(int(user_id), normalize_amount(amount), base64.b32decode(payment_id[1:]))
+    else:
+        payload = LEGACY_PAYMENT_CALLBACK_FORMAT.pack(int(user_id), normalize_amount(amount))
+    token = base64.urlsafe_b64encode(payload + callback_signature(action, payload))
+    return f"{action}_{token.rstrip(b'=').decode()}"
 
-def get_callback_mapping(callback_data: str):
-    """Получить реальные данные по hash"""
-    return callback_mappings.get(callback_data)
+def parse_payment_callback(callback_data: str, action: str):
+    """Разобрать callback_data кнопки платежа -> (user_id, amount, payment_id) или None"""
+    token = callback_data[len(action) + 1:]
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    except (ValueError, TypeError):
+        raw = b""
+    for fmt in (PAYMENT_CALLBACK_FORMAT, LEGACY_PAYMENT_CALLBACK_FORMAT):
+        if len(raw) != fmt.size + CALLBACK_SIGNATURE_SIZE:
+            continue
+        payload, signature = raw[:fmt.size], raw[fmt.size:]
+        if not hmac.compare_digest(signature, callback_signature(action, payload)):
+            return None
+        user_id, cents, *rest = fmt.unpack(payload)
+        payment_id = "P" + base64.b32encode(rest[0]).decode() if rest else None
+        return user_id, cents / 100, payment_id
+    
+    # Неподписанный формат "<action>_<user_id>_<amount>" не принимаем: его может подделать любой клиент
+    return None
 
-async def send_payment_confirmation_to_admin(user_id: int, amount: float, photo_file_id: str = None):
+async def send_payment_confirmation_to_admin(user_id: int, amount: float, photo_file_id: str = None, payment_id: str = None):
     """Отправить админу уведомление о платеже с кнопками подтверждения"""
     try:
-        user = UserManager.get_user(user_id)
+        user = await run_sheets(UserManager.get_user, user_id)
         if not user:
-            print(f"Пользователь {user_id} не найден")
+            payments_logger.error("Пользователь %s не найден", user_id)
             return
         
         payment_type = "💳 Перевод" if photo_file_id else "💵 Наличные"
         
         # Создаем короткие callback_data
-        confirm_callback = create_short_callback_data("pay_ok", user_id, amount)
-        reject_callback = create_short_callback_data("pay_no", user_id, amount)
+        confirm_callback = create_short_callback_data("pay_ok", user_id, amount, payment_id)
+        reject_callback = create_short_callback_data("pay_no", user_id, amount, payment_id)
         
-        print(f"🔍 Создаем кнопки с callback_data:")
-        print(f"   Подтвердить: {confirm_callback} (длина: {len(confirm_callback)})")
-        print(f"   Отклонить: {reject_callback} (длина: {len(reject_callback)})")
+        payments_logger.debug("🔍 Создаем кнопки с callback_data:")
+        payments_logger.debug("   Подтвердить: %s (длина: %s)", confirm_callback, len(confirm_callback))
+        payments_logger.debug("   Отклонить: %s (длина: %s)", reject_callback, len(reject_callback))
         
         # Создаем кнопки для подтверждения/отклонения  
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -758,24 +2340,22 @@ async def send_payment_confirmation_to_admin(user_id: int, amount: float, photo_
                 parse_mode="Markdown"
             )
         
-        print(f"✅ Уведомление админу отправлено для платежа {amount_str} сом от пользователя {user_id}")
+        payments_logger.info("✅ Уведомление админу отправлено для платежа %s сом от пользователя %s", amount_str, user_id)
         
     except Exception as e:
-        print(f"❌ Ошибка отправки уведомления админу: {e}")
-        import traceback
-        traceback.print_exc()
+        payments_logger.exception("❌ Ошибка отправки уведомления админу: %s", e)
 
 async def save_and_notify_cash_payment(user_id: int, amount: float, state: FSMContext):
     """Сохранить наличную оплату и уведомить админа"""
     try:
-        success = await save_payment_to_sheets(
+        payment_id = await save_payment_to_sheets(
             telegram_id=user_id,
             amount=amount,
             payment_type="cash",
             status="pending"
         )
         
-        if success:
+        if payment_id:
             await bot.send_message(
                 user_id,
                 f"✅ **Наличная оплата зарегистрирована!**\n\n"
@@ -786,14 +2366,14 @@ async def save_and_notify_cash_payment(user_id: int, amount: float, state: FSMCo
             )
             
             # Уведомление админу
-            await send_payment_confirmation_to_admin(user_id, amount)
+            await send_payment_confirmation_to_admin(user_id, amount, payment_id=payment_id)
         else:
             await bot.send_message(user_id, "❌ Ошибка при сохранении платежа. Попробуйте еще раз.")
         
         await state.clear()
         
     except Exception as e:
-        print(f"Ошибка сохранения наличной оплаты: {e}")
+        payments_logger.error("Ошибка сохранения наличной оплаты: %s", e)
 
 async def notify_admin_on_error(error_text: str):
     """Уведомить админа об ошибке"""
@@ -801,7 +2381,7 @@ async def notify_admin_on_error(error_text: str):
         clean_error = str(error_text).replace('*', '').replace('_', '').replace('`', '')[:1000]
         await bot.send_message(ADMIN_ID, f"⚠️ ОШИБКА В БОТЕ:\n\n{clean_error}")
     except Exception as e:
-        print(f"Ошибка отправки уведомления админу: {e}")
+        telegram_logger.error("Ошибка отправки уведомления админу: %s", e)
 
 def get_user_last_payment(user_id: int):
     """Получить информацию о последней оплате пользователя"""
@@ -809,14 +2389,9 @@ def get_user_last_payment(user_id: int):
         if payments_sheet is None:
             return None
         
-        payments = payments_sheet.get_all_records()
-        
-        # Ищем последнюю подтвержденную оплату пользователя
-        user_payments = []
-        for payment in payments:
-            if (str(payment.get('telegram_id')) == str(user_id) and 
-                str(payment.get('status', '')).lower() == 'confirmed'):
-                user_payments.append(payment)
+        # Подтвержденные оплаты пользователя - из индекса, без разбора всего листа
+        payment_index.ensure_fresh()
+        user_payments = payment_index.user_payments(user_id, 'confirmed')
         
         if not user_payments:
             return None
@@ -841,7 +2416,7 @@ def get_user_last_payment(user_id: int):
         }
         
     except Exception as e:
-        print(f"❌ Ошибка получения последней оплаты: {e}")
+        payments_logger.error("❌ Ошибка получения последней оплаты: %s", e)
         return None
 
 def get_user_pending_payments_count(user_id: int):
@@ -850,19 +2425,11 @@ def get_user_pending_payments_count(user_id: int):
         if payments_sheet is None:
             return 0
         
-        payments = payments_sheet.get_all_records()
-        
-        # Считаем pending платежи пользователя
-        pending_count = 0
-        for payment in payments:
-            if (str(payment.get('telegram_id')) == str(user_id) and 
-                str(payment.get('status', '')).lower() == 'pending'):
-                pending_count += 1
-        
-        return pending_count
+        payment_index.ensure_fresh()
+        return len(payment_index.user_payments(user_id, 'pending'))
         
     except Exception as e:
-        print(f"❌ Ошибка подсчета pending платежей: {e}")
+        payments_logger.error("❌ Ошибка подсчета pending платежей: %s", e)
         return 0
 
 # Настройка команд бота
@@ -882,11 +2449,371 @@ async def set_bot_commands():
     ]
     await bot.set_my_commands(commands)
 
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в SQLite: состояния диалогов переживают перезапуск бота.
+    
+    Записи за время FSM_WRITE_DELAY (set_state + update_data одного обработчика)
+    объединяются в одну транзакцию; изменяются только записанные поля, поэтому
+    базу могут одновременно использовать несколько процессов бота на одном сервере.
+    Диалоги без активности дольше FSM_STATE_TTL считаются брошенными и удаляются.
+    Если запись не удалась, изменения возвращаются в очередь и повторяются через RETRY_DELAY секунд.
+    """
+    
+    RETRY_DELAY = 5
+    
+    def __init__(self, path, state_ttl=FSM_STATE_TTL, write_delay=FSM_WRITE_DELAY):
+        self.path = path
+        self.state_ttl = state_ttl
+        self.write_delay = write_delay
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS fsm (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._pending = {}          # key -> {'state': ..., 'data': ...} еще не записанные поля
+        self._inflight = []         # пачки, которые записываются прямо сейчас (до COMMIT читаем из них)
+        self._flush_handle = None
+        self._flush_tasks = set()   # фоновые записи (ссылки держим, чтобы задачи не собрал GC)
+        self._purged_at = 0.0
+        self._closed = False
+    
+    @staticmethod
+    def _key(key: StorageKey):
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+    
+    def _read(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT state, data FROM fsm WHERE key = ? AND updated_at >= ?",
+                (key, time.time() - self.state_ttl)
+            ).fetchone()
+        if row is None:
+            return None, {}
+        return row[0], json.loads(row[1]) if row[1] else {}
+    
+    def _unwritten(self, key, field):
+        """Последнее еще не записанное в базу значение поля: (True, значение) или (False, None)"""
+        for batch in [self._pending, *reversed(self._inflight)]:
+            if field in batch.get(key, {}):
+                return True, batch[key][field]
+        return False, None
+    
+    async def _read_async(self, key):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._read, key)
+    
+    async def get_state(self, key: StorageKey):
+        key = self._key(key)
+        found, state = self._unwritten(key, 'state')
+        if found:
+            return state
+        return (await self._read_async(key))[0]
+    
+    async def get_data(self, key: StorageKey):
+        key = self._key(key)
+        found, data = self._unwritten(key, 'data')
+        if found:
+            return dict(data)
+        return (await self._read_async(key))[1]
+    
+    async def set_state(self, key: StorageKey, state=None):
+        value = state.state if isinstance(state, State) else state
+        self._schedule(self._key(key), 'state', value)
+    
+    async def set_data(self, key: StorageKey, data):
+        self._schedule(self._key(key), 'data', dict(data))
+    
+    def _schedule(self, key, field, value):
+        self._pending.setdefault(key, {})[field] = value
+        self._schedule_flush(self.write_delay)
+    
+    def _schedule_flush(self, delay):
+        if self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(delay, self._start_flush)
+    
+    def _start_flush(self):
+        task = asyncio.ensure_future(self._background_flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+    
+    async def _background_flush(self):
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error("❌ Ошибка записи состояний диалогов, повтор через %s c: %s", self.RETRY_DELAY, e)
+            self._schedule_flush(self.RETRY_DELAY)
+    
+    async def flush(self):
+        """Записать накопленные изменения одной транзакцией"""
+        self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        if pending:
+            self._inflight.append(pending)
+            try:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self._write, pending)
+            except Exception:
+                # Возвращаем в очередь; записанные за это время более новые значения главнее
+                for key, fields in pending.items():
+                    self._pending[key] = {**fields, **self._pending.get(key, {})}
+                raise
+            finally:
+                self._inflight.remove(pending)
+    
+    def _write(self, pending):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for key, fields in pending.items():
+                    # Брошенный диалог начинается заново: частичное обновление не должно вернуть старые поля
+                    self._conn.execute("DELETE FROM fsm WHERE key = ? AND updated_at < ?", (key, now - self.state_ttl))
+                    self._conn.execute(
+                        "INSERT OR IGNORE INTO fsm (key, state, data, updated_at) VALUES (?, NULL, NULL, ?)",
+                        (key, now)
+                    )
+                    if 'state' in fields:
+                        self._conn.execute("UPDATE fsm SET state = ?, updated_at = ? WHERE key = ?", (fields['state'], now, key))
+                    if 'data' in fields:
+                        data = json.dumps(fields['data'], ensure_ascii=False, default=str) if fields['data'] else None
+                        self._conn.execute("UPDATE fsm SET data = ?, updated_at = ? WHERE key = ?", (data, now, key))
+                # Завершенные диалоги (без состояния и данных) не храним
+                self._conn.execute("DELETE FROM fsm WHERE state IS NULL AND data IS NULL")
+                if now - self._purged_at > 3600:
+                    self._conn.execute("DELETE FROM fsm WHERE updated_at < ?", (now - self.state_ttl,))
+                    self._purged_at = now
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+    
+    def states_count(self):
+        """Количество активных диалогов по состояниям"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT state, COUNT(*) FROM fsm WHERE state IS NOT NULL AND updated_at >= ? GROUP BY state",
+                (time.time() - self.state_ttl,)
+            ).fetchall()
+        return dict(rows)
+    
+    async def close(self):
+        if self._closed:
+            return
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks)
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        await self.flush()
+        self._closed = True
+        with self._lock:
+            self._conn.close()
+
 # Инициализация бота
 bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+storage = SQLiteStorage(FSM_DB_PATH) if FSM_STORAGE == "sqlite" else MemoryStorage()
 dp = Dispatcher(storage=storage)
+
+class UpdateTimingMiddleware(BaseMiddleware):
+    """Время обработки апдейта целиком: Google Sheets, Telegram API и сам обработчик.
+    
+    Апдейты дольше SLOW_UPDATE_THRESHOLD пишутся в лог с разбивкой и числом вызовов.
+    """
+    
+    async def __call__(self, handler, event, data):
+        timing = UpdateTiming()
+        token = update_timing.set(timing)
+        started = time.monotonic()
+        try:
+            return await handler(event, data)
+        finally:
+            update_timing.reset(token)
+            total = time.monotonic() - started
+            own = max(0.0, total - timing.sheets_seconds - timing.telegram_seconds)
+            UPDATE_SECONDS.observe(total, part="total")
+            UPDATE_SECONDS.observe(timing.sheets_seconds, part="sheets")
+            UPDATE_SECONDS.observe(timing.telegram_seconds, part="telegram")
+            UPDATE_SECONDS.observe(own, part="handler")
+            if total >= SLOW_UPDATE_THRESHOLD:
+                user = data.get("event_from_user")
+                SLOW_UPDATES.inc(handler=timing.handler or "-")
+                handlers_logger.warning(
+                    "🐢 Медленный апдейт %s: %.3f с, обработчик %s, пользователь %s | "
+                    "Sheets %.3f с (%d операций, %d запросов к API), Telegram %.3f с (%d запросов), "
+                    "обработчик %.3f с",
+                    event.update_id, total, timing.handler or "-", user.id if user else "-",
+                    timing.sheets_seconds, timing.sheets_calls, timing.sheets_api_calls,
+                    timing.telegram_seconds, timing.telegram_calls, own
+                )
+            elif handlers_logger.isEnabledFor(logging.DEBUG):
+                handlers_logger.debug(
+                    "⏱️ Апдейт %s: %.3f с (%s; Sheets %.3f с, Telegram %.3f с)",
+                    event.update_id, total, timing.handler or "-", timing.sheets_seconds, timing.telegram_seconds
+                )
+
+class UpdateLogContextMiddleware(BaseMiddleware):
+    """Отмечает время последнего апдейта и задает request_id для логов"""
+    
+    async def __call__(self, handler, event, data):
+        global last_update_at
+        last_update_at = time.time()
+        log_token = log_request_id.set(f"u{event.update_id}")
+        try:
+            return await handler(event, data)
+        finally:
+            log_request_id.reset(log_token)
+
+dp.update.outer_middleware(UpdateLogContextMiddleware())
+dp.update.outer_middleware(UpdateTimingMiddleware())
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время работы каждого обработчика для /metrics"""
+    
+    async def __call__(self, handler, event, data):
+        name = data['handler'].callback.__name__
+        timing = update_timing.get()
+        if timing is not None:
+            timing.handler = name
+        started = time.monotonic()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.monotonic() - started, handler=name, event=type(event).__name__)
+
+class SheetsWarmupMiddleware(BaseMiddleware):
+    """Пока Google Sheets подключаются и локальной базы нет, отвечает, что бот запускается.
+    
+    Без этого обработчики ответили бы, что таблица недоступна и бот работает
+    в упрощенном режиме, хотя подключение обычно занимает секунды.
+    """
+    
+    async def __call__(self, handler, event, data):
+        if sheets_state != "starting" or users_sheet is not None:
+            return await handler(event, data)
+        if isinstance(event, CallbackQuery):
+            await event.answer(SHEETS_STARTING_MESSAGE, show_alert=True)
+        else:
+            await event.answer(SHEETS_STARTING_MESSAGE)
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Количество и время запросов к Telegram Bot API для /metrics"""
+    
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.monotonic()
+        try:
+            response = await make_request(bot, method)
+        except Exception:
+            TELEGRAM_CALLS.inc(method=name, result='error')
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            TELEGRAM_SECONDS.observe(elapsed, method=name)
+            timing = update_timing.get()
+            if timing is not None:
+                timing.add(telegram_seconds=elapsed, telegram_calls=1)
+        TELEGRAM_CALLS.inc(method=name, result='ok')
+        return response
+
+bot.session.middleware(TelegramMetricsMiddleware())
+
+def fsm_state_counts():
+    if isinstance(storage, SQLiteStorage):
+        return storage.states_count()
+    counts = {}
+    for record in list(storage.storage.values()):
+        if record.state:
+            counts[record.state] = counts.get(record.state, 0) + 1
+    return counts
+
+Gauge("fitness_bot_fsm_states", "Активные диалоги по состояниям FSM", ("state",), collect=fsm_state_counts)
+Gauge(
+    "fitness_bot_sheets_write_queue", "Изменения, ожидающие отправки в Google Sheets",
+    collect=lambda: {(): sheets_mirror.pending_ops}
+)
+Gauge(
+    "fitness_bot_sheets_quota_remaining", "Оставшиеся запросы к Google Sheets в текущем окне", ("kind",),
+    collect=lambda: {(kind,): sheets_quota.stats()[f'{kind}s_remaining'] for kind in ('read', 'write')}
+)
+
+class TelegramSender:
+    """Отправка сообщений с соблюдением лимитов Telegram.
+    
+    Сообщения разным чатам могут уходить одновременно (не больше concurrency
+    запросов), общий и поканальный темп ограничены токен-бакетами, а на
+    TelegramRetryAfter отправка ждет указанное Telegram время и повторяется.
+    """
+    
+    def __init__(self, concurrency, per_second, chat_per_second, chat_burst, max_retries):
+        self.concurrency = concurrency
+        self.chat_per_second = chat_per_second
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._semaphore = None
+        self._global = TokenBucket(per_second * 60, capacity=per_second)
+        self._chats = {}
+        self._paused_until = {}     # chat_id -> время, до которого Telegram просил не писать
+        self.retries = 0
+    
+    @staticmethod
+    async def _take(bucket):
+        while True:
+            bucket.refill()
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return
+            await asyncio.sleep(bucket.seconds_until_token())
+    
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_per_second * 60, capacity=self.chat_burst)
+        return bucket
+    
+    async def call(self, chat_id, method, *args, **kwargs):
+        """Выполнить метод бота, адресованный чату chat_id"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            for attempt in itertools.count():
+                pause = self._paused_until.get(chat_id, 0) - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                await self._take(self._chat_bucket(chat_id))
+                await self._take(self._global)
+                try:
+                    return await method(*args, **kwargs)
+                except TelegramRetryAfter as e:
+                    if attempt >= self.max_retries:
+                        raise
+                    self.retries += 1
+                    telegram_logger.info("⏳ Telegram просит подождать %s с (чат %s)", e.retry_after, chat_id)
+                    self._paused_until[chat_id] = max(
+                        self._paused_until.get(chat_id, 0), time.monotonic() + e.retry_after
+                    )
+    
+    async def send_message(self, chat_id, text, **kwargs):
+        return await self.call(chat_id, bot.send_message, chat_id, text, **kwargs)
+
+telegram_sender = TelegramSender(
+    TELEGRAM_SEND_CONCURRENCY, TELEGRAM_MESSAGES_PER_SECOND,
+    TELEGRAM_CHAT_MESSAGES_PER_SECOND, TELEGRAM_CHAT_BURST, TELEGRAM_MAX_RETRIES
+)
 router = Router()
+router.message.middleware(HandlerMetricsMiddleware())
+router.callback_query.middleware(HandlerMetricsMiddleware())
+router.message.middleware(SheetsWarmupMiddleware())
+router.callback_query.middleware(SheetsWarmupMiddleware())
 dp.include_router(router)
 
 @router.message(Command("start"))
@@ -894,11 +2821,11 @@ async def cmd_start(message: Message, state: FSMContext):
     user_id = message.from_user.id
     username = message.from_user.username or "без username"
     
-    print(f"🔍 Команда /start от пользователя {username} (ID: {user_id})")
+    handlers_logger.debug("🔍 Команда /start от пользователя %s (ID: %s)", username, user_id)
     
     try:
         if users_sheet is None:
-            print(f"⚠️ Google Sheets не инициализированы, работаем в упрощенном режиме")
+            handlers_logger.warning("⚠️ Google Sheets не инициализированы, работаем в упрощенном режиме")
             
             if user_id == ADMIN_ID:
                 await message.answer(
@@ -915,17 +2842,17 @@ async def cmd_start(message: Message, state: FSMContext):
                 )
             return
             
-        user = UserManager.get_user(user_id)
-        print(f"🔍 Пользователь найден: {user is not None}")
+        user = await run_sheets(UserManager.get_user, user_id)
+        handlers_logger.debug("🔍 Пользователь найден: %s", user is not None)
         
         if user:
             current_status = user.get('status', 'active')
-            print(f"🔍 Текущий статус пользователя: {current_status}")
+            handlers_logger.debug("🔍 Текущий статус пользователя: %s", current_status)
             
             # Если пользователь неактивный, активируем его
             if current_status == 'inactive' or current_status == 'неактивный':
-                print(f"🔄 Активируем неактивного пользователя {user_id}")
-                success = UserManager.update_user_status(user_id, 'active')
+                handlers_logger.info("🔄 Активируем неактивного пользователя %s", user_id)
+                success = await run_sheets(UserManager.update_user_status, user_id, 'active')
                 
                 if success:
                     # Уведомляем админа о возвращении
@@ -937,7 +2864,7 @@ async def cmd_start(message: Message, state: FSMContext):
                             f"📅 Дата: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
                         )
                     except Exception as notify_error:
-                        print(f"❌ Ошибка уведомления админа о возвращении: {notify_error}")
+                        handlers_logger.error("❌ Ошибка уведомления админа о возвращении: %s", notify_error)
                     
                     await message.answer(
                         f"🎉 С возвращением, {user['name']}! 👋\n\n"
@@ -954,21 +2881,21 @@ async def cmd_start(message: Message, state: FSMContext):
             else:
                 # Обычный вход активного пользователя
                 if user_id == ADMIN_ID:
-                    print(f"🔍 Администратор входит в систему")
+                    handlers_logger.debug("🔍 Администратор входит в систему")
                     await message.answer(
                         f"👨‍💼 Добро пожаловать, Администратор!\n\n"
                         "Выберите действие:",
                         reply_markup=get_admin_menu()
                     )
                 else:
-                    print(f"🔍 Обычный пользователь: {user.get('name', 'Без имени')}")
+                    handlers_logger.debug("🔍 Обычный пользователь: %s", user.get('name', 'Без имени'))
                     await message.answer(
                         f"Привет, {user['name']}! 👋\n\n"
                         "Выберите действие из меню ниже:",
                         reply_markup=get_main_menu()
                     )
         else:
-            print(f"🔍 Новый пользователь, начинаем регистрацию")
+            handlers_logger.debug("🔍 Новый пользователь, начинаем регистрацию")
             await message.answer(
                 "🎉 Добро пожаловать в фитнес-бот! 🏋️‍♀️\n\n"
                 "Для начала работы нужно пройти быструю регистрацию.\n\n"
@@ -977,7 +2904,7 @@ async def cmd_start(message: Message, state: FSMContext):
             await state.set_state(RegistrationStates.waiting_for_name)
             
     except Exception as e:
-        print(f"❌ Ошибка в cmd_start: {e}")
+        handlers_logger.error("❌ Ошибка в cmd_start: %s", e)
         
         if user_id == ADMIN_ID:
             await message.answer(
@@ -989,7 +2916,7 @@ async def cmd_start(message: Message, state: FSMContext):
 
 @router.message(Command("help"))
 async def cmd_help(message: Message):
-    print(f"🔍 Команда /help от пользователя {message.from_user.id}")
+    handlers_logger.debug("🔍 Команда /help от пользователя %s", message.from_user.id)
     
     if message.from_user.id == ADMIN_ID:
         help_text = (
@@ -1004,9 +2931,9 @@ async def cmd_help(message: Message):
             "• Уведомления приходят автоматически"
         )
     else:
-        monthly_price = SettingsManager.get_setting('monthly_price', DEFAULT_SETTINGS['monthly_price'])
-        sessions_count = SettingsManager.get_setting('sessions_per_month', DEFAULT_SETTINGS['sessions_per_month'])
-        min_payment = SettingsManager.get_setting('min_payment', DEFAULT_SETTINGS['min_payment'])
+        monthly_price = await run_sheets(SettingsManager.get_setting, 'monthly_price', DEFAULT_SETTINGS['monthly_price'])
+        sessions_count = await run_sheets(SettingsManager.get_setting, 'sessions_per_month', DEFAULT_SETTINGS['sessions_per_month'])
+        min_payment = await run_sheets(SettingsManager.get_setting, 'min_payment', DEFAULT_SETTINGS['min_payment'])
         
         help_text = (
             "🤖 Справка по работе с ботом\n\n"
@@ -1029,17 +2956,17 @@ async def cmd_help(message: Message):
 
 @router.message(Command("payment"))
 async def cmd_payment(message: Message, state: FSMContext):
-    print(f"🔍 Команда /payment от пользователя {message.from_user.id}")
+    handlers_logger.debug("🔍 Команда /payment от пользователя %s", message.from_user.id)
     
     user_id = message.from_user.id
-    user = UserManager.get_user(user_id)
+    user = await run_sheets(UserManager.get_user, user_id)
     
     if not user:
         await message.answer("❌ Сначала пройдите регистрацию командой /start")
         return
     
-    monthly_price = SettingsManager.get_setting('monthly_price', DEFAULT_SETTINGS['monthly_price'])
-    sessions_count = SettingsManager.get_setting('sessions_per_month', DEFAULT_SETTINGS['sessions_per_month'])
+    monthly_price = await run_sheets(SettingsManager.get_setting, 'monthly_price', DEFAULT_SETTINGS['monthly_price'])
+    sessions_count = await run_sheets(SettingsManager.get_setting, 'sessions_per_month', DEFAULT_SETTINGS['sessions_per_month'])
     
     message_text = f"💳 Оплата занятий\n\n"
     message_text += f"💡 Месячный абонемент: {monthly_price} сом за {sessions_count} занятий\n\n"
@@ -1054,10 +2981,10 @@ async def cmd_payment(message: Message, state: FSMContext):
 @router.message(Command("profile"))
 async def cmd_profile(message: Message):
     """Команда /profile - показать профиль пользователя с актуальными данными"""
-    print(f"🔍 Команда /profile от пользователя {message.from_user.id}")
+    handlers_logger.debug("🔍 Команда /profile от пользователя %s", message.from_user.id)
     
     user_id = message.from_user.id
-    user = UserManager.get_user(user_id)
+    user = await run_sheets(UserManager.get_user, user_id)
     
     if not user:
         await message.answer("❌ Сначала пройдите регистрацию командой /start")
@@ -1066,16 +2993,16 @@ async def cmd_profile(message: Message):
     # Получаем актуальные данные из Google Sheets
     try:
         # Подсчитываем посещения
-        sessions_count = UserManager.get_user_sessions_count(user_id)
-        sessions_per_month = SettingsManager.get_setting('sessions_per_month', DEFAULT_SETTINGS['sessions_per_month'])
+        sessions_count = await run_sheets(UserManager.get_user_sessions_count, user_id)
+        sessions_per_month = await run_sheets(SettingsManager.get_setting, 'sessions_per_month', DEFAULT_SETTINGS['sessions_per_month'])
         sessions_left = max(0, sessions_per_month - sessions_count)
-        monthly_price = SettingsManager.get_setting('monthly_price', DEFAULT_SETTINGS['monthly_price'])
+        monthly_price = await run_sheets(SettingsManager.get_setting, 'monthly_price', DEFAULT_SETTINGS['monthly_price'])
         
         # Получаем информацию о последней оплате из истории платежей
-        last_payment_info = get_user_last_payment(user_id)
+        last_payment_info = await run_sheets(get_user_last_payment, user_id)
         
         # Получаем информацию о pending платежах
-        pending_payments_count = get_user_pending_payments_count(user_id)
+        pending_payments_count = await run_sheets(get_user_pending_payments_count, user_id)
         
         profile_text = (
             f"📋 **Ваш профиль**\n\n"
@@ -1113,7 +3040,7 @@ async def cmd_profile(message: Message):
         await message.answer(profile_text, parse_mode="Markdown")
         
     except Exception as e:
-        print(f"❌ Ошибка получения данных профиля: {e}")
+        handlers_logger.error("❌ Ошибка получения данных профиля: %s", e)
         # Fallback к базовому профилю
         await message.answer(
             f"📋 Ваш профиль\n\n"
@@ -1127,10 +3054,10 @@ async def cmd_profile(message: Message):
 @router.message(Command("sick"))
 async def cmd_sick(message: Message):
     """Команда /sick - отметить болезнь"""
-    print(f"🔍 Команда /sick от пользователя {message.from_user.id}")
+    handlers_logger.debug("🔍 Команда /sick от пользователя %s", message.from_user.id)
     
     user_id = message.from_user.id
-    user = UserManager.get_user(user_id)
+    user = await run_sheets(UserManager.get_user, user_id)
     
     if not user:
         await message.answer("❌ Сначала пройдите регистрацию командой /start")
@@ -1153,7 +3080,7 @@ async def cmd_sick(message: Message):
     ]
     
     try:
-        attendance_sheet.append_row(attendance_row)
+        await run_sheets(append_indexed_row, attendance_sheet, attendance_index, attendance_row)
         
         await message.answer(
             f"🤒 Болезнь отмечена на {today}.\n"
@@ -1170,16 +3097,16 @@ async def cmd_sick(message: Message):
         )
         
     except Exception as e:
-        print(f"Ошибка записи болезни: {e}")
+        handlers_logger.error("Ошибка записи болезни: %s", e)
         await message.answer("❌ Ошибка при записи. Попробуйте еще раз.")
 
 @router.message(Command("quit"))
 async def cmd_quit(message: Message):
     """Команда /quit - покинуть программу"""
-    print(f"🔍 Команда /quit от пользователя {message.from_user.id}")
+    handlers_logger.debug("🔍 Команда /quit от пользователя %s", message.from_user.id)
     
     user_id = message.from_user.id
-    user = UserManager.get_user(user_id)
+    user = await run_sheets(UserManager.get_user, user_id)
     
     if not user:
         await message.answer("❌ Сначала пройдите регистрацию командой /start")
@@ -1199,20 +3126,20 @@ async def cmd_quit(message: Message):
 @router.message(Command("rules"))
 async def cmd_rules(message: Message):
     """Команда /rules - показать правила"""
-    print(f"🔍 Команда /rules от пользователя {message.from_user.id}")
+    handlers_logger.debug("🔍 Команда /rules от пользователя %s", message.from_user.id)
     
     # Получаем правила из настроек Google Sheets
-    rules_text = SettingsManager.get_setting('gym_rules', DEFAULT_SETTINGS['gym_rules'])
+    rules_text = await run_sheets(SettingsManager.get_setting, 'gym_rules', DEFAULT_SETTINGS['gym_rules'])
     
     # Если правила из настроек пустые, используем шаблон с актуальными настройками
     if not rules_text or rules_text == DEFAULT_SETTINGS['gym_rules']:
-        min_payment = SettingsManager.get_setting('min_payment', DEFAULT_SETTINGS['min_payment'])
-        max_payment = SettingsManager.get_setting('max_payment', DEFAULT_SETTINGS['max_payment'])
-        monthly_price = SettingsManager.get_setting('monthly_price', DEFAULT_SETTINGS['monthly_price'])
-        sessions_count = SettingsManager.get_setting('sessions_per_month', DEFAULT_SETTINGS['sessions_per_month'])
-        free_days = SettingsManager.get_setting('free_days_limit', DEFAULT_SETTINGS['free_days_limit'])
-        sick_days = SettingsManager.get_setting('sick_days_limit', DEFAULT_SETTINGS['sick_days_limit'])
-        gym_schedule = SettingsManager.get_setting('gym_schedule', DEFAULT_SETTINGS['gym_schedule'])
+        min_payment = await run_sheets(SettingsManager.get_setting, 'min_payment', DEFAULT_SETTINGS['min_payment'])
+        max_payment = await run_sheets(SettingsManager.get_setting, 'max_payment', DEFAULT_SETTINGS['max_payment'])
+        monthly_price = await run_sheets(SettingsManager.get_setting, 'monthly_price', DEFAULT_SETTINGS['monthly_price'])
+        sessions_count = await run_sheets(SettingsManager.get_setting, 'sessions_per_month', DEFAULT_SETTINGS['sessions_per_month'])
+        free_days = await run_sheets(SettingsManager.get_setting, 'free_days_limit', DEFAULT_SETTINGS['free_days_limit'])
+        sick_days = await run_sheets(SettingsManager.get_setting, 'sick_days_limit', DEFAULT_SETTINGS['sick_days_limit'])
+        gym_schedule = await run_sheets(SettingsManager.get_setting, 'gym_schedule', DEFAULT_SETTINGS['gym_schedule'])
         
         rules_text = f"""📋 ПРАВИЛА ФИТНЕС-ЗАЛА
 
@@ -1251,16 +3178,16 @@ async def cmd_rules(message: Message):
 @router.message(Command("edit_prices"))
 async def cmd_edit_prices(message: Message):
     """Команда /edit_prices - изменить цены (только админ)"""
-    print(f"🔍 Команда /edit_prices от пользователя {message.from_user.id}")
+    handlers_logger.debug("🔍 Команда /edit_prices от пользователя %s", message.from_user.id)
     
     if message.from_user.id != ADMIN_ID:
         await message.answer("❌ Доступно только администратору")
         return
     
-    min_payment = SettingsManager.get_setting('min_payment', DEFAULT_SETTINGS['min_payment'])
-    max_payment = SettingsManager.get_setting('max_payment', DEFAULT_SETTINGS['max_payment'])
-    monthly_price = SettingsManager.get_setting('monthly_price', DEFAULT_SETTINGS['monthly_price'])
-    sessions_count = SettingsManager.get_setting('sessions_per_month', DEFAULT_SETTINGS['sessions_per_month'])
+    min_payment = await run_sheets(SettingsManager.get_setting, 'min_payment', DEFAULT_SETTINGS['min_payment'])
+    max_payment = await run_sheets(SettingsManager.get_setting, 'max_payment', DEFAULT_SETTINGS['max_payment'])
+    monthly_price = await run_sheets(SettingsManager.get_setting, 'monthly_price', DEFAULT_SETTINGS['monthly_price'])
+    sessions_count = await run_sheets(SettingsManager.get_setting, 'sessions_per_month', DEFAULT_SETTINGS['sessions_per_month'])
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=f"💰 Цена абонемента: {monthly_price} сом", callback_data="edit_monthly_price")],
@@ -1279,14 +3206,14 @@ async def cmd_edit_prices(message: Message):
 @router.message(Command("edit_limits"))
 async def cmd_edit_limits(message: Message):
     """Команда /edit_limits - изменить лимиты (только админ)"""
-    print(f"🔍 Команда /edit_limits от пользователя {message.from_user.id}")
+    handlers_logger.debug("🔍 Команда /edit_limits от пользователя %s", message.from_user.id)
     
     if message.from_user.id != ADMIN_ID:
         await message.answer("❌ Доступно только администратору")
         return
     
-    free_days = SettingsManager.get_setting('free_days_limit', DEFAULT_SETTINGS['free_days_limit'])
-    sick_days = SettingsManager.get_setting('sick_days_limit', DEFAULT_SETTINGS['sick_days_limit'])
+    free_days = await run_sheets(SettingsManager.get_setting, 'free_days_limit', DEFAULT_SETTINGS['free_days_limit'])
+    sick_days = await run_sheets(SettingsManager.get_setting, 'sick_days_limit', DEFAULT_SETTINGS['sick_days_limit'])
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=f"❄️ Дней заморозки: {free_days}", callback_data="edit_free_days")],
@@ -1341,7 +3268,7 @@ async def process_monthly_price(message: Message, state: FSMContext):
             await message.answer("❌ Цена должна быть больше 0")
             return
         
-        if SettingsManager.update_setting('monthly_price', new_price):
+        if await run_sheets(SettingsManager.update_setting, 'monthly_price', new_price):
             await message.answer(f"✅ Цена абонемента изменена на {new_price} сом")
         else:
             await message.answer("❌ Ошибка при сохранении настройки")
@@ -1359,7 +3286,7 @@ async def process_min_amount(message: Message, state: FSMContext):
             await message.answer("❌ Сумма должна быть больше 0")
             return
         
-        if SettingsManager.update_setting('min_payment', new_amount):
+        if await run_sheets(SettingsManager.update_setting, 'min_payment', new_amount):
             await message.answer(f"✅ Минимальная сумма изменена на {new_amount} сом")
         else:
             await message.answer("❌ Ошибка при сохранении настройки")
@@ -1377,7 +3304,7 @@ async def process_max_amount(message: Message, state: FSMContext):
             await message.answer("❌ Сумма должна быть больше 0")
             return
         
-        if SettingsManager.update_setting('max_payment', new_amount):
+        if await run_sheets(SettingsManager.update_setting, 'max_payment', new_amount):
             await message.answer(f"✅ Максимальная сумма изменена на {new_amount} сом")
         else:
             await message.answer("❌ Ошибка при сохранении настройки")
@@ -1395,7 +3322,7 @@ async def process_sessions_count(message: Message, state: FSMContext):
             await message.answer("❌ Количество занятий должно быть больше 0")
             return
         
-        if SettingsManager.update_setting('sessions_per_month', new_count):
+        if await run_sheets(SettingsManager.update_setting, 'sessions_per_month', new_count):
             await message.answer(f"✅ Количество занятий в абонементе изменено на {new_count}")
         else:
             await message.answer("❌ Ошибка при сохранении настройки")
@@ -1413,7 +3340,7 @@ async def process_free_days(message: Message, state: FSMContext):
             await message.answer("❌ Количество дней не может быть отрицательным")
             return
         
-        if SettingsManager.update_setting('free_days_limit', new_days):
+        if await run_sheets(SettingsManager.update_setting, 'free_days_limit', new_days):
             await message.answer(f"✅ Дней заморозки изменено на {new_days}")
         else:
             await message.answer("❌ Ошибка при сохранении настройки")
@@ -1431,7 +3358,7 @@ async def process_sick_days(message: Message, state: FSMContext):
             await message.answer("❌ Количество дней не может быть отрицательным")
             return
         
-        if SettingsManager.update_setting('sick_days_limit', new_days):
+        if await run_sheets(SettingsManager.update_setting, 'sick_days_limit', new_days):
             await message.answer(f"✅ Дней по болезни изменено на {new_days}")
         else:
             await message.answer("❌ Ошибка при сохранении настройки")
@@ -1448,7 +3375,7 @@ async def process_schedule_text(message: Message, state: FSMContext):
         await message.answer("❌ Расписание не может быть пустым")
         return
     
-    if SettingsManager.update_setting('gym_schedule', new_schedule):
+    if await run_sheets(SettingsManager.update_setting, 'gym_schedule', new_schedule):
         await message.answer(f"✅ Расписание зала изменено:\n\n{new_schedule}")
     else:
         await message.answer("❌ Ошибка при сохранении настройки")
@@ -1467,7 +3394,7 @@ async def process_rules_text(message: Message, state: FSMContext):
         await message.answer("❌ Текст правил слишком длинный (максимум 4000 символов)")
         return
     
-    if SettingsManager.update_setting('gym_rules', new_rules):
+    if await run_sheets(SettingsManager.update_setting, 'gym_rules', new_rules):
         await message.answer(
             f"✅ **Правила зала успешно обновлены!**\n\n"
             f"📝 Новые правила:\n\n{new_rules}",
@@ -1475,7 +3402,7 @@ async def process_rules_text(message: Message, state: FSMContext):
         )
         
         # Уведомляем, что правила обновлены
-        print(f"✅ Правила зала обновлены администратором {message.from_user.id}")
+        handlers_logger.info("✅ Правила зала обновлены администратором %s", message.from_user.id)
     else:
         await message.answer("❌ Ошибка при сохранении правил")
     
@@ -1509,12 +3436,12 @@ async def admin_settings(message: Message):
     if message.from_user.id != ADMIN_ID:
         return
     
-    min_payment = SettingsManager.get_setting('min_payment', DEFAULT_SETTINGS['min_payment'])
-    max_payment = SettingsManager.get_setting('max_payment', DEFAULT_SETTINGS['max_payment'])
-    monthly_price = SettingsManager.get_setting('monthly_price', DEFAULT_SETTINGS['monthly_price'])
-    sessions_count = SettingsManager.get_setting('sessions_per_month', DEFAULT_SETTINGS['sessions_per_month'])
-    free_days = SettingsManager.get_setting('free_days_limit', DEFAULT_SETTINGS['free_days_limit'])
-    sick_days = SettingsManager.get_setting('sick_days_limit', DEFAULT_SETTINGS['sick_days_limit'])
+    min_payment = await run_sheets(SettingsManager.get_setting, 'min_payment', DEFAULT_SETTINGS['min_payment'])
+    max_payment = await run_sheets(SettingsManager.get_setting, 'max_payment', DEFAULT_SETTINGS['max_payment'])
+    monthly_price = await run_sheets(SettingsManager.get_setting, 'monthly_price', DEFAULT_SETTINGS['monthly_price'])
+    sessions_count = await run_sheets(SettingsManager.get_setting, 'sessions_per_month', DEFAULT_SETTINGS['sessions_per_month'])
+    free_days = await run_sheets(SettingsManager.get_setting, 'free_days_limit', DEFAULT_SETTINGS['free_days_limit'])
+    sick_days = await run_sheets(SettingsManager.get_setting, 'sick_days_limit', DEFAULT_SETTINGS['sick_days_limit'])
     
     settings_text = f"""⚙️ ТЕКУЩИЕ НАСТРОЙКИ
 
@@ -1547,7 +3474,7 @@ async def admin_edit_rules(message: Message, state: FSMContext):
         return
     
     # Получаем текущие правила
-    current_rules = SettingsManager.get_setting('gym_rules', DEFAULT_SETTINGS['gym_rules'])
+    current_rules = await run_sheets(SettingsManager.get_setting, 'gym_rules', DEFAULT_SETTINGS['gym_rules'])
     
     await message.answer(
         f"✏️ **РЕДАКТИРОВАНИЕ ПРАВИЛ ЗАЛА**\n\n"
@@ -1571,38 +3498,28 @@ async def admin_stats(message: Message):
             await message.answer("❌ Статистика недоступна (нет подключения к Google Sheets)")
             return
             
-        # Считаем статистику
-        users = users_sheet.get_all_records()
-        payments = payments_sheet.get_all_records()
-        
-        total_users = len(users)
-        active_users = len([u for u in users if u.get('status') == 'active'])
-        
-        # Платежи за текущий месяц
-        current_month = datetime.now().strftime("%Y-%m")
-        monthly_payments = [p for p in payments if p.get('timestamp', '').startswith(current_month) and p.get('status') == 'confirmed']
-        monthly_income = sum(float(p.get('amount', 0)) for p in monthly_payments if str(p.get('amount', '')).replace('.', '').isdigit())
+        stats = await run_sheets(collect_statistics)
         
         stats_text = f"""📊 СТАТИСТИКА
 
 👥 Пользователи:
-• Всего зарегистрировано: {total_users}
-• Активных: {active_users}
-• Неактивных: {total_users - active_users}
+• Всего зарегистрировано: {stats['total_users']}
+• Активных: {stats['active_users']}
+• Неактивных: {stats['inactive_users']}
 
-💰 Доходы за {current_month}:
-• Подтвержденных платежей: {len(monthly_payments)}
-• Общая сумма: {monthly_income:.0f} сом
+💰 Доходы за {stats['month']}:
+• Подтвержденных платежей: {stats['monthly_confirmed_payments']}
+• Общая сумма: {stats['monthly_income']:.0f} сом
 
 📋 Ожидают подтверждения:
-• Платежей: {len([p for p in payments if p.get('status') == 'pending'])}
+• Платежей: {stats['pending_payments']}
 
 🕐 Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"""
         
         await message.answer(stats_text)
         
     except Exception as e:
-        print(f"Ошибка получения статистики: {e}")
+        handlers_logger.error("Ошибка получения статистики: %s", e)
         await message.answer("❌ Ошибка при получении статистики")
 
 @router.message(F.text == "📋 Проверить платежи")
@@ -1617,96 +3534,11 @@ async def check_pending_payments(message: Message):
         return
     
     try:
-        await message.answer("🔍 Проверяю платежи...")
-        
-        payments = payments_sheet.get_all_records()
-        # ИЩЕМ ТОЛЬКО ПЛАТЕЖИ СО СТАТУСОМ "pending"
-        pending = [p for p in payments if str(p.get('status', '')).lower() == 'pending']
-        
-        if not pending:
-            await message.answer("✅ Нет платежей, ожидающих подтверждения")
-            return
-        
-        await message.answer(f"📋 **НАЙДЕНО {len(pending)} ПЛАТЕЖЕЙ В ОЖИДАНИИ**\n\n💡 Отправляю каждый платеж с кнопками...", parse_mode="Markdown")
-        
-        # Показываем последние 10 платежей
-        for i, p in enumerate(pending[-10:], 1):
-            user_name = p.get('name', 'Без имени')
-            amount = p.get('amount', 'Не указано')
-            user_id = p.get('telegram_id', 'Не указан')
-            timestamp = p.get('timestamp', 'Не указано')
-            payment_type = p.get('payment_type', 'Не указан')
-            
-            # Обрабатываем amount
-            try:
-                if isinstance(amount, str):
-                    amount_cleaned = str(amount).replace(' ', '').replace(',', '.')
-                    amount_float = float(amount_cleaned)
-                else:
-                    amount_float = float(amount)
-                
-                # Создаем короткие callback_data с проверкой длины
-                confirm_callback = create_short_callback_data("pay_ok", int(user_id), amount_float)
-                reject_callback = create_short_callback_data("pay_no", int(user_id), amount_float)
-                
-                print(f"🔍 Создаем кнопки для платежа #{i}:")
-                print(f"   Подтвердить: {confirm_callback} (длина: {len(confirm_callback)})")
-                print(f"   Отклонить: {reject_callback} (длина: {len(reject_callback)})")
-                
-                keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                    [
-                        InlineKeyboardButton(
-                            text=f"✅ Подтвердить", 
-                            callback_data=confirm_callback
-                        ),
-                        InlineKeyboardButton(
-                            text=f"❌ Отклонить", 
-                            callback_data=reject_callback
-                        )
-                    ]
-                ])
-                
-                # Определяем тип платежа для отображения
-                payment_type_display = "💳 Перевод" if payment_type == "transfer" else "💵 Наличные"
-                
-                # Отправляем каждый платеж отдельным сообщением с кнопками
-                payment_text = (
-                    f"**💳 Платеж #{i}**\n\n"
-                    f"👤 **Клиент:** {user_name}\n"
-                    f"💰 **Сумма:** {amount} сом\n"
-                    f"💳 **Тип:** {payment_type_display}\n"
-                    f"🆔 **ID:** `{user_id}`\n"
-                    f"📅 **Время:** {timestamp}\n"
-                    f"🔄 **Статус:** PENDING\n\n"
-                    f"❓ **Подтвердить платеж?**"
-                )
-                
-                await message.answer(payment_text, reply_markup=keyboard, parse_mode="Markdown")
-                
-            except Exception as button_error:
-                print(f"❌ Ошибка создания кнопок для платежа: {button_error}")
-                # Отправляем без кнопок с информацией об ошибке
-                payment_text = (
-                    f"**💳 Платеж #{i} (БЕЗ КНОПОК)**\n\n"
-                    f"👤 **Клиент:** {user_name}\n"
-                    f"💰 **Сумма:** {amount} сом\n"
-                    f"🆔 **ID:** `{user_id}`\n"
-                    f"⚠️ Ошибка: {str(button_error)[:100]}"
-                )
-                await message.answer(payment_text, parse_mode="Markdown")
-                continue
-        
-        # Общая сводка
-        if len(pending) > 10:
-            summary_text = f"📊 **СВОДКА**\n\n"
-            summary_text += f"Всего PENDING платежей: **{len(pending)}**\n"
-            summary_text += f"Показано последних: **{min(10, len(pending))}**\n\n"
-            summary_text += f"💡 Используйте кнопки выше для подтверждения"
-            
-            await message.answer(summary_text, parse_mode="Markdown")
+        text, keyboard = await run_sheets(load_pending_page, 0)
+        await telegram_sender.send_message(message.chat.id, text, reply_markup=keyboard, parse_mode="Markdown")
         
     except Exception as e:
-        print(f"❌ Ошибка проверки платежей: {e}")
+        handlers_logger.error("❌ Ошибка проверки платежей: %s", e)
         await message.answer(f"❌ Ошибка при проверке платежей: {str(e)[:200]}")
         
         # Отправляем отладочную информацию админу
@@ -1722,7 +3554,7 @@ async def check_pending_payments(message: Message):
             
 @router.message(F.text == "🏠 Главное меню")
 async def menu_main(message: Message):
-    user = UserManager.get_user(message.from_user.id)
+    user = await run_sheets(UserManager.get_user, message.from_user.id)
     if user:
         if message.from_user.id == ADMIN_ID:
             await message.answer(
@@ -1739,68 +3571,92 @@ async def menu_main(message: Message):
 
 # ОБРАБОТЧИКИ ПЛАТЕЖЕЙ
 
+class TelegramPhotoCache:
+    """Фото из файла, загружаемое в Telegram один раз.
+    
+    Файл читается при первой отправке, после загрузки Telegram возвращает
+    file_id - он хранится в памяти и в локальной базе (по хешу файла), и
+    дальше фото отправляется по file_id без чтения диска и повторной загрузки.
+    Файл и локальная база читаются через run_sheets, не в цикле событий.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._data = None
+        self._key = None
+        self._file_id = None
+    
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        if not data:
+            raise ValueError("QR код файл пустой")
+        self._data = data
+        self._key = f"telegram_file_id:{bot.id}:{hashlib.sha256(data).hexdigest()}"
+        self._file_id = local_store.get_meta(self._key)
+        payments_logger.info("📷 QR код загружен: %s байт, file_id %s", len(data), 'в кэше' if self._file_id else 'еще не получен')
+    
+    async def send(self, message: Message, **kwargs):
+        """Отправить фото ответом на message; FileNotFoundError - файла нет"""
+        if self._data is None:
+            await run_sheets(self._load)
+        CACHE_REQUESTS.inc(cache='qr_file_id', result='hit' if self._file_id else 'miss')
+        if self._file_id:
+            try:
+                return await message.answer_photo(photo=self._file_id, **kwargs)
+            except TelegramBadRequest as e:
+                # file_id стал недействительным - загрузим файл заново
+                payments_logger.warning("⚠️ file_id QR кода не принят Telegram: %s", e)
+                self._file_id = None
+        sent = await message.answer_photo(
+            photo=BufferedInputFile(self._data, filename=os.path.basename(self.path)), **kwargs
+        )
+        self._file_id = sent.photo[-1].file_id
+        await run_sheets(local_store.set_meta, self._key, self._file_id)
+        payments_logger.info("✅ QR код загружен в Telegram, file_id сохранен")
+        return sent
+
+qr_code_photo = TelegramPhotoCache(QR_CODE_PATH)
+
 @router.callback_query(F.data == "payment_transfer")
 async def payment_transfer_selected(callback: CallbackQuery, state: FSMContext):
     """Обработка выбора безналичной оплаты с QR кодом из репозитория"""
     try:
-        print(f"🔍 Пытаемся отправить QR код...")
-        print(f"🔍 Текущая директория: {os.getcwd()}")
-        print(f"🔍 Список файлов: {os.listdir('.')}")
-        print(f"🔍 Проверяем файл QR_CODE_PATH: {QR_CODE_PATH}")
-        print(f"🔍 Файл существует: {os.path.exists(QR_CODE_PATH)}")
-        
-        if os.path.exists(QR_CODE_PATH):
-            try:
-                # Проверяем размер файла
-                file_size = os.path.getsize(QR_CODE_PATH)
-                print(f"🔍 Размер файла QR кода: {file_size} байт")
-                
-                if file_size == 0:
-                    print("❌ Файл QR кода пустой!")
-                    raise Exception("QR код файл пустой")
-                
-                # Проверяем права доступа
-                if not os.access(QR_CODE_PATH, os.R_OK):
-                    print("❌ Нет прав на чтение файла QR кода!")
-                    raise Exception("Нет прав на чтение QR кода")
-                
-                with open(QR_CODE_PATH, 'rb') as photo:
-                    print("✅ Отправляем QR код...")
-                    await callback.message.answer_photo(
-                        photo=photo,
-                        caption=f"💳 **Безналичная оплата**\n\n"
-                                f"📱 **По номеру телефона:**\n"
-                                f"`{PAYMENT_PHONE}`\n\n"
-                                f"📋 **Инструкция:**\n"
-                                f"1️⃣ Отсканируйте QR код или переведите по номеру\n"
-                                f"2️⃣ Укажите сумму перевода\n"
-                                f"3️⃣ Пришлите скриншот чека\n\n"
-                                f"💰 Введите сумму оплаты:",
-                        parse_mode="Markdown"
-                    )
-                    print("✅ QR код успешно отправлен!")
-            except Exception as photo_error:
-                print(f"❌ Ошибка отправки фото: {photo_error}")
-                # Отправляем без фото
-                await callback.message.answer(
-                    f"💳 **Безналичная оплата**\n\n"
-                    f"📱 **По номеру телефона:**\n"
-                    f"`{PAYMENT_PHONE}`\n\n"
-                    f"⚠️ _QR код временно недоступен_\n\n"
-                    f"📋 **Инструкция:**\n"
-                    f"1️⃣ Переведите деньги по указанному номеру\n"
-                    f"2️⃣ Укажите сумму перевода\n"
-                    f"3️⃣ Пришлите скриншот чека\n\n"
-                    f"💰 Введите сумму оплаты:",
-                    parse_mode="Markdown"
-                )
-        else:
+        try:
+            await qr_code_photo.send(
+                callback.message,
+                caption=f"💳 **Безналичная оплата**\n\n"
+                        f"📱 **По номеру телефона:**\n"
+                        f"`{PAYMENT_PHONE}`\n\n"
+                        f"📋 **Инструкция:**\n"
+                        f"1️⃣ Отсканируйте QR код или переведите по номеру\n"
+                        f"2️⃣ Укажите сумму перевода\n"
+                        f"3️⃣ Пришлите скриншот чека\n\n"
+                        f"💰 Введите сумму оплаты:",
+                parse_mode="Markdown"
+            )
+        except FileNotFoundError:
             # Если файл QR кода не найден
-            print(f"❌ Файл QR кода не найден: {QR_CODE_PATH}")
+            payments_logger.error("❌ Файл QR кода не найден: %s", QR_CODE_PATH)
+            await callback.message.answer(
+                f"💳 **Безналичная оплата**\n\n"
+                f"📱 **По номеру телефона:**\n"
+                f"`{PAYMENT_PHONE}`\n\n"
+                f"📋 **Инструкция:**\n"
+                f"1️⃣ Переведите деньги по указанному номеру\n"
+                f"2️⃣ Укажите сумму перевода\n"
+                f"3️⃣ Пришлите скриншот чека\n\n"
+                f"💰 Введите сумму оплаты:",
+                parse_mode="Markdown"
+            )
+        except Exception as photo_error:
+            payments_logger.error("❌ Ошибка отправки фото: %s", photo_error)
+            # Отправляем без фото
             await callback.message.answer(
                 f"💳 **Безналичная оплата**\n\n"
                 f"📱 **По номеру телефона:**\n"
                 f"`{PAYMENT_PHONE}`\n\n"
+                f"⚠️ _QR код временно недоступен_\n\n"
                 f"📋 **Инструкция:**\n"
                 f"1️⃣ Переведите деньги по указанному номеру\n"
                 f"2️⃣ Укажите сумму перевода\n"
@@ -1813,7 +3669,7 @@ async def payment_transfer_selected(callback: CallbackQuery, state: FSMContext):
         await state.set_state(PaymentStates.waiting_for_amount)
         
     except Exception as e:
-        print(f"❌ Общая ошибка в payment_transfer_selected: {e}")
+        payments_logger.error("❌ Общая ошибка в payment_transfer_selected: %s", e)
         await callback.message.answer(
             f"💳 Безналичная оплата\n\n"
             f"📱 По номеру телефона: {PAYMENT_PHONE}\n\n"
@@ -1836,14 +3692,14 @@ async def confirm_quit_callback(callback: CallbackQuery):
     """Подтверждение выхода из программы"""
     try:
         user_id = callback.from_user.id
-        user = UserManager.get_user(user_id)
+        user = await run_sheets(UserManager.get_user, user_id)
         
         if not user:
             await callback.message.answer("❌ Пользователь не найден")
             return
         
         # Обновляем статус пользователя на 'inactive' в Google Sheets
-        success = UserManager.update_user_status(user_id, 'inactive')
+        success = await run_sheets(UserManager.update_user_status, user_id, 'inactive')
         
         if success:
             await callback.message.answer(
@@ -1875,7 +3731,7 @@ async def confirm_quit_callback(callback: CallbackQuery):
             )
         
     except Exception as e:
-        print(f"Ошибка подтверждения выхода: {e}")
+        handlers_logger.error("Ошибка подтверждения выхода: %s", e)
         await callback.message.answer("❌ Ошибка. Попробуйте еще раз.")
     
     await callback.answer()
@@ -1898,188 +3754,274 @@ async def close_settings_callback(callback: CallbackQuery):
 
 # ОБРАБОТЧИКИ ПОДТВЕРЖДЕНИЯ ПЛАТЕЖЕЙ
 
+async def decide_payment(callback: CallbackQuery, user_id: int, amount: float, payment_id, new_status: str):
+    """Подтвердить или отклонить платеж и уведомить клиента.
+    
+    Возвращает пользователя или None (тогда callback уже отвечен с ошибкой).
+    """
+    payments_logger.debug("🔍 Обрабатываем: user_id=%s, amount=%s, payment_id=%s, status=%s", user_id, amount, payment_id, new_status)
+    
+    user = await run_sheets(UserManager.get_user, user_id)
+    if not user:
+        payments_logger.error("❌ Пользователь %s не найден", user_id)
+        await callback.answer("❌ Пользователь не найден")
+        return None
+    
+    # Обновляем статус платежа в Google Sheets
+    success = await update_payment_status(user_id, amount, new_status, callback.from_user.id, payment_id)
+    if success == PAYMENT_ALREADY_PROCESSED:
+        await callback.answer("ℹ️ Платеж уже обработан")
+        return None
+    if not success:
+        payments_logger.error("❌ Не удалось обновить статус")
+        await callback.answer("❌ Ошибка при обновлении статуса")
+        return None
+    
+    if new_status == "confirmed":
+        client_text = (
+            f"✅ **Ваш платеж подтвержден!**\n\n"
+            f"💰 Сумма: **{amount} сом**\n"
+            f"👨‍💼 Подтверждено администратором\n"
+            f"📅 Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
+            f"🎉 Спасибо за оплату!\n"
+            f"💡 Используйте /profile для просмотра актуальной информации"
+        )
+    else:
+        client_text = (
+            f"❌ **Ваш платеж отклонен**\n\n"
+            f"💰 Сумма: **{amount} сом**\n"
+            f"👨‍💼 Отклонено администратором\n"
+            f"📅 Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
+            f"📞 Свяжитесь с администратором для уточнения причины"
+        )
+    
+    # Уведомляем клиента
+    try:
+        await telegram_sender.send_message(user_id, client_text, parse_mode="Markdown")
+        payments_logger.info("✅ Уведомление клиенту отправлено")
+    except Exception as notify_error:
+        payments_logger.error("❌ Ошибка отправки уведомления клиенту: %s", notify_error)
+    
+    return user
+
 @router.callback_query(F.data.startswith("pay_ok_"))
 async def confirm_payment_callback(callback: CallbackQuery):
     """Подтверждение платежа администратором"""
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer("❌ Доступно только администратору")
+        return
+    
     try:
-        print(f"🔍 Получен callback подтверждения: {callback.data}")
-        
-        # Сначала пытаемся найти в mapping
-        mapping_data = get_callback_mapping(callback.data)
-        if mapping_data:
-            user_id = mapping_data['user_id']
-            amount = mapping_data['amount']
-            print(f"🔍 Найдено в mapping: user_id={user_id}, amount={amount}")
-        else:
-            # Парсинг обычного callback_data
-            callback_parts = callback.data.split("_")
-            if len(callback_parts) < 4:
-                print(f"❌ Неверный формат callback_data: {callback.data}")
-                await callback.answer("❌ Ошибка формата данных")
-                return
-            
-            try:
-                user_id = int(callback_parts[2])
-                amount = float(callback_parts[3])
-            except (ValueError, IndexError) as e:
-                print(f"❌ Ошибка парсинга данных: {e}")
-                await callback.answer("❌ Ошибка данных платежа")
-                return
+        payments_logger.debug("🔍 Получен callback подтверждения: %s", callback.data)
         
-        print(f"🔍 Обрабатываем: user_id={user_id}, amount={amount}")
+        payment = parse_payment_callback(callback.data, "pay_ok")
+        if not payment:
+            payments_logger.error("❌ Неверный формат или подпись callback_data: %s", callback.data)
+            await callback.answer("❌ Ошибка данных платежа")
+            return
+        user_id, amount, payment_id = payment
         
-        user = UserManager.get_user(user_id)
+        user = await decide_payment(callback, user_id, amount, payment_id, "confirmed")
         if not user:
-            print(f"❌ Пользователь {user_id} не найден")
-            await callback.answer("❌ Пользователь не найден")
             return
         
-        print(f"🔍 Пользователь найден: {user.get('name', 'Без имени')}")
-        
-        # Обновляем статус платежа в Google Sheets
-        success = await update_payment_status(user_id, amount, "confirmed", callback.from_user.id)
-        
-        if success:
-            print("✅ Статус успешно обновлен, отправляем уведомления")
+        # Обновляем сообщение админа
+        try:
+            new_text = (
+                f"✅ **ПЛАТЕЖ ПОДТВЕРЖДЕН**\n\n"
+                f"👤 **Клиент:** {user['name']}\n"
+                f"💰 **Сумма:** {amount} сом\n"
+                f"🆔 **ID:** `{user_id}`\n"
+                f"📅 **Подтверждено:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+                f"👨‍💼 **Админ:** {callback.from_user.first_name or 'Администратор'}"
+            )
             
-            # Уведомляем клиента
-            try:
-                await bot.send_message(
-                    user_id,
-                    f"✅ **Ваш платеж подтвержден!**\n\n"
-                    f"💰 Сумма: **{amount} сом**\n"
-                    f"👨‍💼 Подтверждено администратором\n"
-                    f"📅 Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-                    f"🎉 Спасибо за оплату!\n"
-                    f"💡 Используйте /profile для просмотра актуальной информации",
+            if callback.message.photo:
+                # Если сообщение с фото
+                await callback.message.edit_caption(
+                    caption=new_text,
                     parse_mode="Markdown"
                 )
-                print("✅ Уведомление клиенту отправлено")
-            except Exception as notify_error:
-                print(f"❌ Ошибка отправки уведомления клиенту: {notify_error}")
-            
-            # Обновляем сообщение админа
-            try:
-                new_text = (
-                    f"✅ **ПЛАТЕЖ ПОДТВЕРЖДЕН**\n\n"
-                    f"👤 **Клиент:** {user['name']}\n"
-                    f"💰 **Сумма:** {amount} сом\n"
-                    f"🆔 **ID:** `{user_id}`\n"
-                    f"📅 **Подтверждено:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-                    f"👨‍💼 **Админ:** {callback.from_user.first_name or 'Администратор'}"
+            else:
+                # Если обычное сообщение
+                await callback.message.edit_text(
+                    text=new_text,
+                    parse_mode="Markdown"
                 )
-                
-                if callback.message.photo:
-                    # Если сообщение с фото
-                    await callback.message.edit_caption(
-                        caption=new_text,
-                        parse_mode="Markdown"
-                    )
-                else:
-                    # Если обычное сообщение
-                    await callback.message.edit_text(
-                        text=new_text,
-                        parse_mode="Markdown"
-                    )
-                print("✅ Сообщение админа обновлено")
-            except Exception as edit_error:
-                print(f"❌ Ошибка обновления сообщения админа: {edit_error}")
-            
-            await callback.answer("✅ Платеж подтвержден!")
-        else:
-            print("❌ Не удалось обновить статус")
-            await callback.answer("❌ Ошибка при обновлении статуса")
+            payments_logger.info("✅ Сообщение админа обновлено")
+        except Exception as edit_error:
+            payments_logger.error("❌ Ошибка обновления сообщения админа: %s", edit_error)
+        
+        await callback.answer("✅ Платеж подтвержден!")
             
     except Exception as e:
-        print(f"❌ Критическая ошибка подтверждения платежа: {e}")
-        import traceback
-        traceback.print_exc()
+        payments_logger.exception("❌ Критическая ошибка подтверждения платежа: %s", e)
         await callback.answer("❌ Критическая ошибка")
 
 @router.callback_query(F.data.startswith("pay_no_"))
 async def reject_payment_callback(callback: CallbackQuery):
     """Отклонение платежа администратором"""
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer("❌ Доступно только администратору")
+        return
+    
     try:
-        print(f"🔍 Получен callback отклонения: {callback.data}")
+        payments_logger.debug("🔍 Получен callback отклонения: %s", callback.data)
         
-        # Сначала пытаемся найти в mapping
-        mapping_data = get_callback_mapping(callback.data)
-        if mapping_data:
-            user_id = mapping_data['user_id']
-            amount = mapping_data['amount']
-        else:
-            # Парсинг обычного callback_data
-            callback_parts = callback.data.split("_")
-            if len(callback_parts) < 4:
-                print(f"❌ Неверный формат callback_data: {callback.data}")
-                await callback.answer("❌ Ошибка формата данных")
-                return
-                
-            try:
-                user_id = int(callback_parts[2])
-                amount = float(callback_parts[3])
-            except (ValueError, IndexError) as e:
-                print(f"❌ Ошибка парсинга данных: {e}")
-                await callback.answer("❌ Ошибка данных платежа")
-                return
+        payment = parse_payment_callback(callback.data, "pay_no")
+        if not payment:
+            payments_logger.error("❌ Неверный формат или подпись callback_data: %s", callback.data)
+            await callback.answer("❌ Ошибка данных платежа")
+            return
+        user_id, amount, payment_id = payment
         
-        user = UserManager.get_user(user_id)
+        user = await decide_payment(callback, user_id, amount, payment_id, "rejected")
         if not user:
-            await callback.answer("❌ Пользователь не найден")
             return
         
-        # Обновляем статус платежа в Google Sheets
-        success = await update_payment_status(user_id, amount, "rejected", callback.from_user.id)
-        
-        if success:
-            # Уведомляем клиента
-            try:
-                await bot.send_message(
-                    user_id,
-                    f"❌ **Ваш платеж отклонен**\n\n"
-                    f"💰 Сумма: **{amount} сом**\n"
-                    f"👨‍💼 Отклонено администратором\n"
-                    f"📅 Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-                    f"📞 Свяжитесь с администратором для уточнения причины",
+        # Обновляем сообщение админа
+        try:
+            new_text = (
+                f"❌ **ПЛАТЕЖ ОТКЛОНЕН**\n\n"
+                f"👤 **Клиент:** {user['name']}\n"
+                f"💰 **Сумма:** {amount} сом\n"
+                f"🆔 **ID:** `{user_id}`\n"
+                f"📅 **Отклонено:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+                f"👨‍💼 **Админ:** {callback.from_user.first_name or 'Администратор'}"
+            )
+            
+            if callback.message.photo:
+                await callback.message.edit_caption(
+                    caption=new_text,
                     parse_mode="Markdown"
                 )
-            except Exception as notify_error:
-                print(f"❌ Ошибка отправки уведомления клиенту: {notify_error}")
-            
-            # Обновляем сообщение админа
-            try:
-                new_text = (
-                    f"❌ **ПЛАТЕЖ ОТКЛОНЕН**\n\n"
-                    f"👤 **Клиент:** {user['name']}\n"
-                    f"💰 **Сумма:** {amount} сом\n"
-                    f"🆔 **ID:** `{user_id}`\n"
-                    f"📅 **Отклонено:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-                    f"👨‍💼 **Админ:** {callback.from_user.first_name or 'Администратор'}"
+            else:
+                await callback.message.edit_text(
+                    text=new_text,
+                    parse_mode="Markdown"
                 )
-                
-                if callback.message.photo:
-                    await callback.message.edit_caption(
-                        caption=new_text,
-                        parse_mode="Markdown"
-                    )
-                else:
-                    await callback.message.edit_text(
-                        text=new_text,
-                        parse_mode="Markdown"
-                    )
-            except Exception as edit_error:
-                print(f"❌ Ошибка обновления сообщения админа: {edit_error}")
-            
-            await callback.answer("❌ Платеж отклонен!")
-        else:
-            await callback.answer("❌ Ошибка при обновлении статуса")
+        except Exception as edit_error:
+            payments_logger.error("❌ Ошибка обновления сообщения админа: %s", edit_error)
+        
+        await callback.answer("❌ Платеж отклонен!")
             
     except Exception as e:
-        print(f"❌ Ошибка отклонения платежа: {e}")
-        import traceback
-        traceback.print_exc()
+        payments_logger.exception("❌ Ошибка отклонения платежа: %s", e)
         await callback.answer("❌ Ошибка при отклонении")
 
+# ПРОСМОТР ОЖИДАЮЩИХ ПЛАТЕЖЕЙ ПО СТРАНИЦАМ
+
+def render_pending_page(page: int):
+    """Текст и клавиатура страницы ожидающих платежей (из индекса, без запросов к таблице)"""
+    total = payment_index.pending_count()
+    pages = max(1, -(-total // PENDING_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    items = payment_index.pending_page(page * PENDING_PAGE_SIZE, PENDING_PAGE_SIZE)
+    
+    if not total:
+        return "✅ Нет платежей, ожидающих подтверждения", None
+    
+    text = f"📋 **ПЛАТЕЖИ В ОЖИДАНИИ: {total}**\nСтраница {page + 1} из {pages}\n\n"
+    buttons = []
+    for number, (row_number, p) in enumerate(items, page * PENDING_PAGE_SIZE + 1):
+        payment_type_display = "💳 Перевод" if p.get('payment_type') == "transfer" else "💵 Наличные"
+        text += (
+            f"**{number}.** 👤 {p.get('name', 'Без имени')} — 💰 {p.get('amount', 'Не указано')} сом, {payment_type_display}\n"
+            f"      🆔 `{p.get('telegram_id', 'Не указан')}` · 📅 {p.get('timestamp', 'Не указано')}\n"
+        )
+        try:
+            user_id = int(p.get('telegram_id'))
+            amount = normalize_amount(p.get('amount')) / 100
+        except (TypeError, ValueError):
+            text += "      ⚠️ Некорректные данные - обработайте в таблице\n"
+            continue
+        payment_id = str(p.get('payment_id') or "") or None
+        buttons.append([
+            InlineKeyboardButton(
+                text=f"✅ {number}",
+                callback_data=create_short_callback_data(f"pend_ok_{page}", user_id, amount, payment_id)
+            ),
+            InlineKeyboardButton(
+                text=f"❌ {number}",
+                callback_data=create_short_callback_data(f"pend_no_{page}", user_id, amount, payment_id)
+            )
+        ])
+    
+    if pages > 1:
+        buttons.append([
+            InlineKeyboardButton(text="◀", callback_data=f"pend_pg_{(page - 1) % pages}"),
+            InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="pend_pg_noop"),
+            InlineKeyboardButton(text="▶", callback_data=f"pend_pg_{(page + 1) % pages}")
+        ])
+    return text, InlineKeyboardMarkup(inline_keyboard=buttons)
+
+def load_pending_page(page: int):
+    """Догрузить индекс платежей и собрать страницу (в потоке run_sheets, не в цикле событий)"""
+    payment_index.ensure_fresh()
+    return render_pending_page(page)
+
+async def show_pending_page(callback: CallbackQuery, page: int):
+    """Перерисовать сообщение со списком ожидающих платежей"""
+    text, keyboard = await run_sheets(load_pending_page, page)
+    try:
+        await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="Markdown")
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+
+@router.callback_query(F.data.startswith("pend_pg_"))
+async def pending_page_callback(callback: CallbackQuery):
+    """Листание страниц ожидающих платежей"""
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer("❌ Доступно только администратору")
+        return
+    
+    page = callback.data[len("pend_pg_"):]
+    if page.isdigit():
+        try:
+            await show_pending_page(callback, int(page))
+        except Exception as e:
+            payments_logger.error("❌ Ошибка листания платежей: %s", e)
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("pend_ok_") | F.data.startswith("pend_no_"))
+async def pending_decision_callback(callback: CallbackQuery):
+    """Подтверждение/отклонение платежа со страницы списка"""
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer("❌ Доступно только администратору")
+        return
+    
+    try:
+        action = callback.data[:len("pend_ok")]
+        page = callback.data[len("pend_ok_"):].split("_", 1)[0]
+        payment = parse_payment_callback(callback.data, f"{action}_{page}") if page.isdigit() else None
+        if not payment:
+            payments_logger.error("❌ Неверный формат или подпись callback_data: %s", callback.data)
+            await callback.answer("❌ Ошибка данных платежа")
+            return
+        user_id, amount, payment_id = payment
+        
+        new_status = "confirmed" if action == "pend_ok" else "rejected"
+        user = await decide_payment(callback, user_id, amount, payment_id, new_status)
+        if not user:
+            # Платеж могли обработать из уведомления - убираем его из списка
+            try:
+                await show_pending_page(callback, int(page))
+            except Exception as edit_error:
+                payments_logger.error("❌ Ошибка обновления списка платежей: %s", edit_error)
+            return
+        
+        try:
+            await show_pending_page(callback, int(page))
+        except Exception as edit_error:
+            payments_logger.error("❌ Ошибка обновления списка платежей: %s", edit_error)
+        
+        await callback.answer("✅ Платеж подтвержден!" if new_status == "confirmed" else "❌ Платеж отклонен!")
+        
+    except Exception as e:
+        payments_logger.exception("❌ Ошибка обработки платежа из списка: %s", e)
+        await callback.answer("❌ Критическая ошибка")
+
 # ОБРАБОТЧИКИ СОСТОЯНИЙ РЕГИСТРАЦИИ
 
 @router.message(RegistrationStates.waiting_for_name)
@@ -2119,7 +4061,7 @@ async def process_registration_schedule(message: Message, state: FSMContext):
     username = message.from_user.username or ""
     
     # Добавляем пользователя
-    success = UserManager.add_user(
+    success = await run_sheets(UserManager.add_user, 
         telegram_id=user_id,
         username=username,
         name=data['name'],
@@ -2160,8 +4102,8 @@ async def process_payment_amount(message: Message, state: FSMContext):
         amount_text = message.text.replace(',', '.').replace(' ', '')
         amount = float(amount_text)
         
-        min_payment = SettingsManager.get_setting('min_payment', DEFAULT_SETTINGS['min_payment'])
-        max_payment = SettingsManager.get_setting('max_payment', DEFAULT_SETTINGS['max_payment'])
+        min_payment = await run_sheets(SettingsManager.get_setting, 'min_payment', DEFAULT_SETTINGS['min_payment'])
+        max_payment = await run_sheets(SettingsManager.get_setting, 'max_payment', DEFAULT_SETTINGS['max_payment'])
         
         if amount <= 0:
             await message.answer("❌ Сумма должна быть больше 0. Попробуйте еще раз:")
@@ -2194,7 +4136,7 @@ async def process_payment_amount(message: Message, state: FSMContext):
     except ValueError:
         await message.answer("❌ Введите корректную сумму (только цифры). Например: 8000")
     except Exception as e:
-        print(f"Ошибка обработки суммы: {e}")
+        payments_logger.error("Ошибка обработки суммы: %s", e)
         await message.answer("❌ Произошла ошибка. Попробуйте еще раз.")
 
 @router.message(PaymentStates.waiting_for_screenshot, F.photo)
@@ -2206,7 +4148,7 @@ async def process_payment_screenshot(message: Message, state: FSMContext):
         photo_file_id = message.photo[-1].file_id  # Берем фото в максимальном качестве
         
         # Сохраняем платеж со скриншотом
-        success = await save_payment_to_sheets(
+        payment_id = await save_payment_to_sheets(
             telegram_id=message.from_user.id,
             amount=amount,
             payment_type="transfer",
@@ -2214,7 +4156,7 @@ async def process_payment_screenshot(message: Message, state: FSMContext):
             photo_file_id=photo_file_id
         )
         
-        if success:
+        if payment_id:
             await message.answer(
                 f"✅ **Платеж принят!**\n\n"
                 f"💰 Сумма: **{amount} сом**\n"
@@ -2225,14 +4167,14 @@ async def process_payment_screenshot(message: Message, state: FSMContext):
             )
             
             # Уведомление админу с кнопками подтверждения
-            await send_payment_confirmation_to_admin(message.from_user.id, amount, photo_file_id)
+            await send_payment_confirmation_to_admin(message.from_user.id, amount, photo_file_id, payment_id)
         else:
             await message.answer("❌ Ошибка при сохранении платежа. Попробуйте еще раз.")
         
         await state.clear()
         
     except Exception as e:
-        print(f"Ошибка обработки скриншота: {e}")
+        payments_logger.error("Ошибка обработки скриншота: %s", e)
         await message.answer("❌ Произошла ошибка. Попробуйте еще раз.")
 
 @router.message(PaymentStates.waiting_for_screenshot)
@@ -2263,7 +4205,7 @@ async def handle_unknown_text(message: Message, state: FSMContext):
             reply_markup=get_admin_menu()
         )
     else:
-        user = UserManager.get_user(message.from_user.id)
+        user = await run_sheets(UserManager.get_user, message.from_user.id)
         if user:
             await message.answer(
                 "🤖 Команда не распознана.\n\n"
@@ -2278,16 +4220,20 @@ async def handle_unknown_text(message: Message, state: FSMContext):
 async def health_check(request):
     """Healthcheck endpoint для поддержания активности"""
     try:
-        # Проверяем статус бота
-        bot_info = await bot.get_me()
+        # Данные бота получены при запуске - healthcheck не обращается к Telegram
+        if bot_identity is None:
+            return web.json_response({
+                "status": "starting",
+                "timestamp": datetime.now().isoformat()
+            }, status=503)
         
         status_data = {
             "status": "ok",
             "timestamp": datetime.now().isoformat(),
-            "bot_username": bot_info.username,
-            "bot_id": bot_info.id,
+            "bot_username": bot_identity.username,
+            "bot_id": bot_identity.id,
             "uptime": "active",
-            "google_sheets": "connected" if users_sheet else "disconnected",
+            "google_sheets": google_sheets_status(),
             "admin_id": ADMIN_ID,
             "payment_phone": PAYMENT_PHONE
         }
@@ -2301,6 +4247,57 @@ async def health_check(request):
             "error": str(e)
         }, status=500)
 
+async def livez_handler(request):
+    """Liveness: процесс жив и event loop отвечает"""
+    return web.json_response({"status": "ok"})
+
+def google_sheets_status():
+    return {"ready": "connected", "starting": "connecting"}.get(sheets_state, "disconnected")
+
+def age_seconds(timestamp):
+    return round(time.time() - timestamp, 1) if timestamp else None
+
+async def readyz_handler(request):
+    """Readiness: бот запущен и синхронизация с Google Sheets не отстает.
+    
+    Пока Google Sheets подключаются в фоне, бот уже отвечает и считается готовым.
+    Только чтение состояния из памяти - без запросов к Telegram, таблице и базе.
+    """
+    sync_age = age_seconds(sheets_mirror.last_flush_at)
+    sheets_connected = sheets_state == "ready"
+    checks = {
+        "bot": bot_identity is not None,
+        "sheets_sync": not sheets_connected or (sync_age is not None and sync_age <= READY_MAX_SYNC_AGE)
+    }
+    ready = all(checks.values())
+    return web.json_response({
+        "status": "ready" if ready else "not_ready",
+        "checks": checks,
+        "bot": {"id": bot_identity.id, "username": bot_identity.username} if bot_identity else None,
+        "mode": BOT_MODE,
+        "uptime_seconds": age_seconds(bot_started_at),
+        "last_update_age_seconds": age_seconds(last_update_at),
+        "google_sheets": google_sheets_status(),
+        "sheets_startup_seconds": round(sheets_ready_at - bot_started_at, 1) if sheets_ready_at else None,
+        "sheets_sync_age_seconds": sync_age,
+        "write_queue": {
+            "pending_ops": sheets_mirror.pending_ops,
+            "oldest_age_seconds": age_seconds(sheets_mirror.oldest_pending_at)
+        }
+    }, status=200 if ready else 503)
+
+async def metrics_handler(request):
+    """Метрики в формате Prometheus.
+    
+    Собираются в пуле потоков: часть значений (например, диалоги FSM) читается из SQLite.
+    """
+    loop = asyncio.get_running_loop()
+    body = await loop.run_in_executor(None, render_metrics)
+    return web.Response(
+        body=body.encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
 async def root_handler(request):
     """Корневой маршрут"""
     return web.json_response({
@@ -2309,6 +4306,9 @@ async def root_handler(request):
         "admin_id": ADMIN_ID,
         "endpoints": {
             "health": "/health",
+            "livez": "/livez",
+            "readyz": "/readyz",
+            "metrics": "/metrics",
             "status": "/status"
         }
     })
@@ -2317,29 +4317,24 @@ async def status_handler(request):
     """Детальный статус бота"""
     try:
         if users_sheet and payments_sheet:
-            # Получаем статистику
-            users = users_sheet.get_all_records()
-            payments = payments_sheet.get_all_records()
-            
-            total_users = len(users)
-            active_users = len([u for u in users if u.get('status') == 'active'])
-            pending_payments = len([p for p in payments if p.get('status') == 'pending'])
+            # Статистика из счетчиков в памяти - запрос к /status не читает таблицу
+            stats = await run_sheets(collect_statistics, False)
             
             return web.json_response({
                 "status": "ok",
                 "timestamp": datetime.now().isoformat(),
                 "statistics": {
-                    "total_users": total_users,
-                    "active_users": active_users,
-                    "pending_payments": pending_payments
+                    "total_users": stats["total_users"],
+                    "active_users": stats["active_users"],
+                    "pending_payments": stats["pending_payments"]
                 },
-                "google_sheets": "connected"
+                "google_sheets": google_sheets_status()
             })
         else:
             return web.json_response({
                 "status": "limited",
                 "timestamp": datetime.now().isoformat(),
-                "google_sheets": "disconnected",
+                "google_sheets": google_sheets_status(),
                 "message": "Working in limited mode"
             })
             
@@ -2359,6 +4354,14 @@ async def start_web_server():
         app.router.add_get('/', root_handler)
         app.router.add_get('/health', health_check)
         app.router.add_get('/status', status_handler)
+        app.router.add_get('/livez', livez_handler)
+        app.router.add_get('/readyz', readyz_handler)
+        app.router.add_get('/metrics', metrics_handler)
+        
+        if BOT_MODE == "webhook":
+            # Обновления от Telegram обрабатываются в фоне, ответ отдается сразу
+            SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+            web_logger.info("🔗 Webhook: :%s%s", os.getenv('PORT', 8000), WEBHOOK_PATH)
         
         # Запускаем сервер
         runner = web.AppRunner(app)
@@ -2369,45 +4372,73 @@ async def start_web_server():
         site = web.TCPSite(runner, '0.0.0.0', port)
         await site.start()
         
-        print(f"🌐 Веб-сервер запущен на порту {port}")
-        print(f"🔗 Healthcheck: :{port}/health")
-        print(f"🔗 Status: :{port}/status")
+        web_logger.info("🌐 Веб-сервер запущен на порту %s", port)
+        web_logger.info("🔗 Healthcheck: :%s/health", port)
+        web_logger.info("🔗 Status: :%s/status", port)
         
         return app
         
     except Exception as e:
-        print(f"❌ Ошибка запуска веб-сервера: {e}")
+        web_logger.error("❌ Ошибка запуска веб-сервера: %s", e)
         return None
 
+async def setup_webhook():
+    """Зарегистрировать webhook в Telegram. False - работаем через polling"""
+    if not WEBHOOK_BASE_URL:
+        web_logger.warning("⚠️ BOT_MODE=webhook, но не задан WEBHOOK_BASE_URL - используем polling")
+        return False
+    try:
+        await bot.set_webhook(
+            WEBHOOK_BASE_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        web_logger.info("✅ Webhook установлен: %s%s", WEBHOOK_BASE_URL.rstrip('/'), WEBHOOK_PATH)
+        return True
+    except Exception as e:
+        web_logger.error("❌ Не удалось установить webhook, используем polling: %s", e)
+        return False
+
+async def run_webhook():
+    """Работа в режиме webhook: обновления приходят на веб-сервер"""
+    await dp.emit_startup(bot=bot)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await dp.emit_shutdown(bot=bot)
+
 # ОСНОВНАЯ ФУНКЦИЯ ЗАПУСКА
 
 async def main():
     """Основная функция запуска бота"""
+    global bot_identity
     try:
-        print("🚀 Запуск фитнес-бота на Render.com...")
-        print(f"🔑 Токен: {BOT_TOKEN[:10]}...")
-        print(f"👨‍💼 Админ ID: {ADMIN_ID}")
-        print(f"🌐 Платформа: {'Render.com' if GOOGLE_CREDENTIALS_JSON else 'Локальная разработка'}")
+        logger.info("🚀 Запуск фитнес-бота на Render.com...")
+        logger.info("🔑 Токен: %s...", BOT_TOKEN[:10])
+        logger.info("👨‍💼 Админ ID: %s", ADMIN_ID)
+        logger.info("🌐 Платформа: %s", 'Render.com' if GOOGLE_CREDENTIALS_JSON else 'Локальная разработка')
         
         # 🌐 ЗАПУСКАЕМ ВЕБ-СЕРВЕР ДЛЯ АКТИВНОСТИ 24/7
-        print("🌐 Запуск веб-сервера для поддержания активности...")
+        logger.info("🌐 Запуск веб-сервера для поддержания активности...")
         web_app = await start_web_server()
         
-        # Инициализируем Google Services
-        if not init_google_services():
-            print("⚠️ Google Sheets недоступны, работаем в упрощенном режиме")
-            await notify_admin_on_error("Google Sheets недоступны на Render.com")
-        else:
-            print("✅ Google Sheets подключены успешно")
+        asyncio.create_task(monitor_event_loop_lag())
+        bot_identity = await bot.get_me()
+        logger.info("🤖 Бот: @%s (ID: %s)", bot_identity.username, bot_identity.id)
+        
+        # Google Sheets подключаются в фоне; до этого отвечаем из локальной базы прошлого запуска
+        if await run_sheets(attach_local_sheets):
+            logger.info("💾 Данные из локальной базы доступны до подключения Google Sheets")
+        asyncio.create_task(connect_google_services())
         
         # Устанавливаем команды бота
-        print("🔧 Настройка команд бота...")
+        logger.info("🔧 Настройка команд бота...")
         await set_bot_commands()
-        print("✅ Команды бота установлены")
+        logger.info("✅ Команды бота установлены")
         
-        print("🔧 Настройка обработчиков...")
-        print(f"🔍 Зарегистрированных роутеров: {len(dp.sub_routers)}")
-        print(f"🔍 Обработчиков в роутере: {len(router.message.handlers)}")
+        logger.info("🔧 Настройка обработчиков...")
+        logger.debug("🔍 Зарегистрированных роутеров: %s", len(dp.sub_routers))
+        logger.debug("🔍 Обработчиков в роутере: %s", len(router.message.handlers))
         
         # Уведомляем админа о запуске
         try:
@@ -2418,7 +4449,7 @@ async def main():
                 ADMIN_ID,
                 f"🚀 БОТ ЗАПУЩЕН!\n\n"
                 f"📱 Все команды работают\n"
-                f"⚙️ Google Sheets: {'✅ Подключены' if users_sheet else '❌ Недоступны'}\n"
+                f"⚙️ Google Sheets: {SHEETS_STATE_TEXT[sheets_state]}\n"
                 f"🏗️ Платформа: {platform_info}\n"
                 f"💳 Платежи: ✅ QR код + подтверждения\n"
                 f"🌐 Веб-сервер: ✅ Порт {port}\n"
@@ -2427,30 +4458,31 @@ async def main():
                 f"🕐 Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
             )
         except Exception as e:
-            print(f"Не удалось уведомить админа о запуске: {e}")
-        
-        print("\n🎉 Бот успешно запущен!")
-        print("📱 Напишите боту /start для начала работы")
-        print(f"👨‍💼 Админ-панель доступна по ID: {ADMIN_ID}")
-        print("💳 Система оплаты с QR кодом и подтверждениями активна!")
-        print(f"🌐 Healthcheck: :{os.getenv('PORT', 8000)}/health")
-        print("⏰ Веб-сервер предотвращает 'засыпание' на Render.com")
-        print("🔄 Бот автоматически перезапускается при ошибках")
-        
-        # Запускаем polling бота
-        await dp.start_polling(bot)
+            logger.warning("Не удалось уведомить админа о запуске: %s", e)
+        
+        logger.info("🎉 Бот успешно запущен!")
+        logger.info("📱 Напишите боту /start для начала работы")
+        logger.info("👨‍💼 Админ-панель доступна по ID: %s", ADMIN_ID)
+        logger.info("💳 Система оплаты с QR кодом и подтверждениями активна!")
+        logger.info("🌐 Healthcheck: :%s/health", os.getenv('PORT', 8000))
+        logger.info("⏰ Веб-сервер предотвращает 'засыпание' на Render.com")
+        logger.info("🔄 Бот автоматически перезапускается при ошибках")
+        
+        if BOT_MODE == "webhook" and web_app is not None and await setup_webhook():
+            await run_webhook()
+        else:
+            # Запускаем polling бота (getUpdates не работает при установленном webhook)
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
         
     except Exception as e:
         error_msg = f"💥 Критическая ошибка запуска: {e}"
-        print(error_msg)
+        logger.exception("%s", error_msg)
         
         try:
             await notify_admin_on_error(error_msg)
         except:
             pass
-            
-        import traceback
-        traceback.print_exc()
         
         # Для Render важно завершить с кодом ошибки
         exit(1)
@@ -2459,14 +4491,22 @@ async def main():
             await bot.session.close()
         except:
             pass
+        try:
+            await storage.close()
+        except Exception as e:
+            logger.warning("⚠️ Ошибка закрытия FSM-хранилища: %s", e)
+        try:
+            # Последняя попытка отправить накопленные изменения в Google Sheets
+            await run_sheets(sheets_mirror.flush_once)
+        except Exception as e:
+            logger.warning("⚠️ Не все изменения отправлены в Google Sheets: %s", e)
+        sheets_executor.shutdown(wait=False)
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
-        print("\n👋 Бот остановлен пользователем")
+        logger.info("👋 Бот остановлен пользователем")
     except Exception as e:
-        print(f"💥 Фатальная ошибка: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("💥 Фатальная ошибка: %s", e)
         exit(1)